@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Benchmark rollout strategies against simulated clusters, see simulator.py"""
+import json
+import click
+from simulator import Latencies, simulate
+
+CLUSTERS = {
+    "small": [3, 3],
+    "medium": [10, 10, 10],
+    "large": [34, 34, 33, 33, 33, 33],
+}
+
+SCENARIOS = {
+    "sequential": [],
+    "surge": ["--max-surge", "25%"],
+    "concurrent": ["--max-surge", "25%", "--asg-concurrency", "3"],
+    "pipelined": ["--pipeline-depth", "1"],
+    "cordon-outdated": ["--max-surge", "25%", "--cordon-outdated"],
+    "drain-order": ["--max-surge", "25%", "--drain-order", "interleave"],
+}
+
+
+def run_benchmark(clusters, scenarios, speedup=100, throttle_rate=0, latencies=None, seed=0):
+    """Simulate every scenario on every cluster size, returns one row per run"""
+
+    rows = []
+    for cluster in clusters:
+        for scenario in scenarios:
+            result = simulate(CLUSTERS[cluster], args=SCENARIOS[scenario], latencies=latencies, throttle_rate=throttle_rate, speedup=speedup, seed=seed)
+            rows.append({"cluster": cluster, "nodes": sum(CLUSTERS[cluster]), "scenario": scenario, **result.as_dict()})
+    return rows
+
+
+def format_table(rows):
+    columns = ["cluster", "nodes", "scenario", "duration_seconds", "api_calls", "throttles", "kubernetes_api_calls", "peak_surge", "evictions", "up_to_date", "error"]
+    widths = {column: max(len(column), *(len(str(row[column])) for row in rows)) for column in columns}
+    lines = ["  ".join(column.ljust(widths[column]) for column in columns)]
+    for row in rows:
+        lines.append("  ".join(str(row[column]).ljust(widths[column]) for column in columns))
+    return "\n".join(lines)
+
+
+@click.command()
+@click.option("--cluster", "clusters", type=click.Choice(list(CLUSTERS)), multiple=True, default=["small", "medium"], show_default=True, help="Simulated cluster size, can be repeated")
+@click.option("--scenario", "scenarios", type=click.Choice(list(SCENARIOS)), multiple=True, default=list(SCENARIOS), show_default=True, help="Rollout strategy to simulate, can be repeated")
+@click.option("--speedup", type=float, default=100, show_default=True, help="Simulated seconds per real second, high values inflate durations as the tool's own CPU time is accelerated too")
+@click.option("--throttle-rate", type=float, default=0, show_default=True, help="Fraction of AWS API calls to throttle")
+@click.option("--launch-latency", type=float, default=Latencies().launch, show_default=True, help="Seconds from a capacity change to the instance launching")
+@click.option("--boot-latency", type=float, default=Latencies().boot, show_default=True, help="Seconds from launch to the node registering")
+@click.option("--ready-latency", type=float, default=Latencies().ready, show_default=True, help="Seconds from registration to the node being Ready")
+@click.option("--seed", type=int, default=0, show_default=True, help="Random seed for latencies and pod placement")
+@click.option("--json", "as_json", is_flag=True, help="Print results as JSON")
+def benchmark(clusters, scenarios, speedup, throttle_rate, launch_latency, boot_latency, ready_latency, seed, as_json):
+    latencies = Latencies(launch=launch_latency, boot=boot_latency, ready=ready_latency)
+    rows = run_benchmark(clusters, scenarios, speedup=speedup, throttle_rate=throttle_rate, latencies=latencies, seed=seed)
+    click.echo(json.dumps(rows, indent=2) if as_json else format_table(rows))
+
+
+if __name__ == "__main__":
+    benchmark(auto_envvar_prefix="EKS_NODE_ROLLOUT_BENCHMARK")
@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 import os
+import re
+import json
+import math
+import random
+import collections
 import sys
 import click
 from sh import kubectl
@@ -7,28 +12,608 @@ import sh
 import datetime
 from dateutil.tz import tzutc
 import boto3
+import boto3.session
+import botocore.config
+import yaml
 from pprint import pprint
 import logging
-import backoff
 import time
+import threading
+import contextlib
+import queue
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import kubernetes
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logging.getLogger('boto3').setLevel(logging.CRITICAL)
 logging.getLogger('urllib3').setLevel(logging.CRITICAL)
 logging.getLogger('sh').setLevel(logging.CRITICAL)
+logging.getLogger('kubernetes').setLevel(logging.CRITICAL)
 
+# ASGs can be rolled concurrently, so tag every log line with the ASG the current thread is working on
+log_context = threading.local()
+_default_record_factory = logging.getLogRecordFactory()
 
-def add_node(asg_client, asg_name, dry_run=True):
-    """Increment desired_count by 1"""
+
+def asg_record_factory(*args, **kwargs):
+    record = _default_record_factory(*args, **kwargs)
+    asg_name = getattr(log_context, "asg_name", None)
+    if asg_name is not None:
+        record.msg = f"[{asg_name}] {record.msg}"
+    return record
+
+
+logging.setLogRecordFactory(asg_record_factory)
+
+# used if the API server doesn't advertise a version for the pods/eviction subresource
+EVICTION_API_VERSION = "policy/v1"
+THROTTLING_ERROR_CODES = ["Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException"]
+# (phase, start event, end event) in the timeline of every replaced node
+PHASES = [
+    ("instance_launch", "capacity_requested", "instance_pending"),
+    ("node_registration", "instance_pending", "node_registered"),
+    ("node_ready", "node_registered", "node_ready"),
+    ("daemonset_readiness", "readiness_gate_started", "daemonsets_ready"),
+    ("image_prepull", "readiness_gate_started", "images_pulled"),
+    ("drain", "drain_started", "drain_finished"),
+    ("terminate", "drain_finished", "terminated"),
+]
+LAUNCH_ACTIVITY_PATTERN = re.compile(r"^Launching a new EC2 instance: (i-[0-9a-f]+)")
+# scaling activity start times come from AWS' clock rather than ours, see get_launched_instance_ids()
+ACTIVITY_CLOCK_TOLERANCE = datetime.timedelta(seconds=30)
+DRAIN_LIFECYCLE_HOOK = "eks-node-rollout-drain"
+PREPULL_POD_PREFIX = "eks-node-rollout-prepull-"
+# container waiting reasons that mean an image will not be pulled without intervention
+IMAGE_PULL_FAILED_REASONS = ["ErrImagePull", "ImagePullBackOff", "InvalidImageName", "ErrImageNeverPull"]
+INSTANCE_REFRESH_FAILED_STATUSES = ["Failed", "Cancelling", "Cancelled", "RollbackInProgress", "RollbackFailed", "RollbackSuccessful"]
+# statuses in which an instance refresh no longer replaces instances
+INSTANCE_REFRESH_ENDED_STATUSES = ["Successful", "Failed", "Cancelled", "RollbackFailed", "RollbackSuccessful"]
+
+
+class DescribeCache:
+    """Per-run snapshot of ASG and EC2 instance descriptions.
+
+    Entries expire after `ttl` seconds and are dropped as soon as we mutate the resource they describe, see
+    CachedClient.
+    """
+
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._asgs = {}
+        self._instances = {}
+
+    def _get(self, entries, keys):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = entries.get(key)
+                if entry is not None and now - entry[0] < self.ttl:
+                    found[key] = entry[1]
+            self.hits += len(found)
+            self.misses += len(set(keys) - set(found))
+        return found
+
+    def _put(self, entries, items):
+        now = time.monotonic()
+        with self._lock:
+            for key, item in items.items():
+                entries[key] = (now, item)
+
+    def get_asgs(self, names):
+        return self._get(self._asgs, names)
+
+    def put_asgs(self, asgs):
+        self._put(self._asgs, {asg["AutoScalingGroupName"]: asg for asg in asgs})
+
+    def get_instances(self, instance_ids):
+        return self._get(self._instances, instance_ids)
+
+    def put_instances(self, instances):
+        self._put(self._instances, {instance["InstanceId"]: instance for instance in instances})
+
+    def invalidate_asgs(self, names=None):
+        with self._lock:
+            if names is None:
+                self._asgs.clear()
+            for name in names or []:
+                self._asgs.pop(name, None)
+
+    def invalidate_instances(self, instance_ids):
+        with self._lock:
+            for instance_id in instance_ids:
+                self._instances.pop(instance_id, None)
+
+    def find_asg_of_instance(self, instance_id):
+        with self._lock:
+            for name, (_, asg) in self._asgs.items():
+                if instance_id in [instance["InstanceId"] for instance in asg.get("Instances", [])]:
+                    return name
+        return None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class CachedClient:
+    """Wraps a boto3 autoscaling or ec2 client so that describe calls read through a DescribeCache.
+
+    Mutating calls are passed straight through and then invalidate whatever they changed. Anything this
+    class doesn't know about (paginators, other operations) goes to the wrapped client untouched.
+    """
+
+    def __init__(self, client, cache):
+        self._client = client
+        self._cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def get_paginator(self, operation_name):
+        paginator = self._client.get_paginator(operation_name)
+        if operation_name == "describe_auto_scaling_groups":
+            return CachingPaginator(paginator, self._cache.put_asgs, "AutoScalingGroups")
+        return paginator
+
+    def describe_auto_scaling_groups(self, **kwargs):
+        names = kwargs.get("AutoScalingGroupNames")
+        if names is None or set(kwargs) != {"AutoScalingGroupNames"}:
+            response = self._client.describe_auto_scaling_groups(**kwargs)
+            self._cache.put_asgs(response["AutoScalingGroups"])
+            return response
+
+        asgs = self._cache.get_asgs(names)
+        missing = [name for name in names if name not in asgs]
+        if len(missing) > 0:
+            response = self._client.describe_auto_scaling_groups(AutoScalingGroupNames=missing)
+            self._cache.put_asgs(response["AutoScalingGroups"])
+            asgs.update({asg["AutoScalingGroupName"]: asg for asg in response["AutoScalingGroups"]})
+        return {"AutoScalingGroups": [asgs[name] for name in names if name in asgs]}
+
+    def describe_instances(self, **kwargs):
+        instance_ids = kwargs.get("InstanceIds")
+        if instance_ids is None or set(kwargs) != {"InstanceIds"}:
+            return self._client.describe_instances(**kwargs)
+
+        instances = self._cache.get_instances(instance_ids)
+        missing = [instance_id for instance_id in instance_ids if instance_id not in instances]
+        if len(missing) > 0:
+            response = self._client.describe_instances(InstanceIds=missing)
+            for reservation in response["Reservations"]:
+                self._cache.put_instances(reservation["Instances"])
+                instances.update({instance["InstanceId"]: instance for instance in reservation["Instances"]})
+        return {"Reservations": [{"Instances": [instances[instance_id] for instance_id in instance_ids if instance_id in instances]}]}
+
+    def set_desired_capacity(self, **kwargs):
+        response = self._client.set_desired_capacity(**kwargs)
+        self._cache.invalidate_asgs([kwargs["AutoScalingGroupName"]])
+        return response
+
+    def terminate_instance_in_auto_scaling_group(self, **kwargs):
+        instance_id = kwargs["InstanceId"]
+        asg_name = self._cache.find_asg_of_instance(instance_id)
+        response = self._client.terminate_instance_in_auto_scaling_group(**kwargs)
+        self._cache.invalidate_asgs(None if asg_name is None else [asg_name])
+        self._cache.invalidate_instances([instance_id])
+        return response
+
+    def create_or_update_tags(self, **kwargs):
+        response = self._client.create_or_update_tags(**kwargs)
+        self._cache.invalidate_asgs([tag["ResourceId"] for tag in kwargs["Tags"]])
+        return response
+
+    def delete_tags(self, **kwargs):
+        response = self._client.delete_tags(**kwargs)
+        self._cache.invalidate_asgs([tag["ResourceId"] for tag in kwargs["Tags"]])
+        return response
+
+    def suspend_processes(self, **kwargs):
+        response = self._client.suspend_processes(**kwargs)
+        self._cache.invalidate_asgs([kwargs["AutoScalingGroupName"]])
+        return response
+
+    def resume_processes(self, **kwargs):
+        response = self._client.resume_processes(**kwargs)
+        self._cache.invalidate_asgs([kwargs["AutoScalingGroupName"]])
+        return response
+
+
+class InFlightLimiter:
+    """Caps the number of node replacements in flight across all ASGs being rolled concurrently"""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, count, cancelled=None):
+        """Returns False without acquiring anything if the `cancelled` event is set while waiting"""
+
+        with self._condition:
+            # a batch bigger than the limit, e.g. adopted from an interrupted run, still runs on its own
+            while not (self.limit is None or self._in_flight + count <= self.limit or self._in_flight == 0):
+                if cancelled is not None and cancelled.is_set():
+                    return False
+                self._condition.wait(timeout=None if cancelled is None else 1)
+            self._in_flight += count
+            return True
+
+    def release(self, count):
+        with self._condition:
+            self._in_flight -= count
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def hold(self, count):
+        self.acquire(count)
+        try:
+            yield
+        finally:
+            self.release(count)
+
+
+class AwsRateLimiter:
+    """Token bucket shared by every AWS client, so concurrent rollouts don't throttle each other.
+
+    The rate adapts to the account's real limit: it is halved whenever a call is throttled and creeps back up
+    by `increase` per successful call, up to `max_rate`.
+    """
+
+    def __init__(self, max_rate=10, min_rate=0.5, burst=None, increase=0.05):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.burst = burst or max(1, max_rate)
+        self.increase = increase
+        self.rate = max_rate
+        self.throttles = 0
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+
+    def instrument(self, client):
+        """Rate limit the calls made by a boto3 client through botocore's event hooks.
+
+        Tokens are taken on before-send, which fires for every HTTP attempt, as botocore's retries happen
+        below before-call.
+        """
+
+        client.meta.events.register_first("before-send.*.*", self._acquire)
+        client.meta.events.register("needs-retry.*.*", self._adapt)
+        return client
+
+    def acquire(self):
+        """Block until a token is available"""
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def _acquire(self, **kwargs):
+        self.acquire()
+
+    def _adapt(self, response, operation, **kwargs):
+        if response is None:
+            return
+        code = response[1].get("Error", {}).get("Code")
+        with self._lock:
+            if code in THROTTLING_ERROR_CODES:
+                self.throttles += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._tokens = min(self._tokens, 0)
+                logging.debug(f"{operation.name} was throttled ({code}), lowered the AWS rate limit to {self.rate:.2f} calls/s, {self.throttles} throttle(s) so far")
+            elif code is None:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def stats(self):
+        return {"rate": round(self.rate, 2), "max_rate": self.max_rate, "throttles": self.throttles}
+
+
+def phase_durations(events):
+    """Seconds spent in each phase of a node's timeline, for the phases whose start and end were both recorded"""
+
+    durations = {}
+    for phase, start, end in PHASES:
+        if events.get(start) is not None and events.get(end) is not None:
+            durations[phase] = max((events[end] - events[start]).total_seconds(), 0)
+    return durations
+
+
+def prometheus_labels(**labels):
+    escaped = [f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for key, value in labels.items()]
+    return "{" + ",".join(escaped) + "}"
+
+
+class RolloutMetrics:
+    """Records a timeline for every replaced node and counts AWS API calls and throttling retries per operation"""
+
+    def __init__(self, cluster_name=None):
+        self.cluster_name = cluster_name
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.finished = None
+        self.api_calls = collections.Counter()
+        self.throttles = collections.Counter()
+        self._lock = threading.Lock()
+        self._timelines = {}
+
+    def instrument(self, client):
+        """Count the calls made by a boto3 client through botocore's event hooks"""
+
+        client.meta.events.register("before-call.*.*", self._count_call)
+        client.meta.events.register("needs-retry.*.*", self._count_throttle)
+        return client
+
+    def _count_call(self, model, **kwargs):
+        with self._lock:
+            self.api_calls[model.name] += 1
+
+    def _count_throttle(self, response, operation, **kwargs):
+        if response is not None and response[1].get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+            with self._lock:
+                self.throttles[operation.name] += 1
+
+    def mark(self, asg_name, instance, event, when=None, **fields):
+        """Record `event` in the timeline of the outdated `instance`, along with any extra `fields`"""
+
+        with self._lock:
+            timeline = self._timelines.setdefault(instance["InstanceId"], {
+                "asg": asg_name,
+                "instance_id": instance["InstanceId"],
+                "node": instance.get("PrivateDnsName"),
+                "events": {}
+            })
+            if event is not None:
+                timeline["events"][event] = when or datetime.datetime.now(datetime.timezone.utc)
+            timeline.update(fields)
+
+    def report(self):
+        with self._lock:
+            timelines = [dict(timeline, events=dict(timeline["events"])) for timeline in self._timelines.values()]
+            api_calls = dict(self.api_calls)
+            throttles = dict(self.throttles)
+        finished = self.finished or datetime.datetime.now(datetime.timezone.utc)
+
+        phases = {}
+        for timeline in timelines:
+            timeline["phases"] = phase_durations(timeline["events"])
+            timeline["events"] = {event: when.isoformat() for event, when in timeline["events"].items() if when is not None}
+            for phase, seconds in timeline["phases"].items():
+                summary = phases.setdefault(phase, {"count": 0, "sum": 0, "max": 0})
+                summary["count"] += 1
+                summary["sum"] += seconds
+                summary["max"] = max(summary["max"], seconds)
+
+        return {
+            "cluster": self.cluster_name,
+            "started": self.started.isoformat(),
+            "finished": finished.isoformat(),
+            "duration_seconds": (finished - self.started).total_seconds(),
+            "nodes_replaced": len([timeline for timeline in timelines if "terminated" in timeline["events"]]),
+            "phases": phases,
+            "api_calls": api_calls,
+            "throttles": throttles,
+            "replacements": timelines
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_prometheus(self, path):
+        report = self.report()
+        write_prometheus_textfile(path, [report], [({"cluster": report["cluster"]}, report["api_calls"], report["throttles"])])
+
+
+def write_prometheus_textfile(path, reports, api_usage):
+    """Write rollout reports in the Prometheus textfile collector format, atomically as the collector requires.
+
+    `api_usage` is a list of (labels, API calls, throttles), as AWS calls are counted per cluster or, in fleet
+    mode, per region.
+    """
+
+    lines = [
+        "# HELP eks_node_rollout_duration_seconds Wall time of the last rollout.",
+        "# TYPE eks_node_rollout_duration_seconds gauge",
+    ]
+    lines += [f"eks_node_rollout_duration_seconds{prometheus_labels(cluster=report['cluster'])} {report['duration_seconds']}" for report in reports]
+    lines += [
+        "# HELP eks_node_rollout_last_run_timestamp_seconds Time the last rollout finished.",
+        "# TYPE eks_node_rollout_last_run_timestamp_seconds gauge",
+    ]
+    lines += [f"eks_node_rollout_last_run_timestamp_seconds{prometheus_labels(cluster=report['cluster'])} {datetime.datetime.fromisoformat(report['finished']).timestamp()}" for report in reports]
+    lines += [
+        "# HELP eks_node_rollout_nodes_replaced Nodes replaced by the last rollout.",
+        "# TYPE eks_node_rollout_nodes_replaced gauge",
+    ]
+    lines += [f"eks_node_rollout_nodes_replaced{prometheus_labels(cluster=report['cluster'])} {report['nodes_replaced']}" for report in reports]
+    lines += [
+        "# HELP eks_node_rollout_phase_seconds Time spent in each phase of a node replacement.",
+        "# TYPE eks_node_rollout_phase_seconds summary",
+    ]
+    for report in reports:
+        for phase, summary in sorted(report["phases"].items()):
+            lines.append(f"eks_node_rollout_phase_seconds_sum{prometheus_labels(cluster=report['cluster'], phase=phase)} {summary['sum']}")
+            lines.append(f"eks_node_rollout_phase_seconds_count{prometheus_labels(cluster=report['cluster'], phase=phase)} {summary['count']}")
+    lines += [
+        "# HELP eks_node_rollout_aws_api_calls AWS API calls made by the last rollout.",
+        "# TYPE eks_node_rollout_aws_api_calls gauge",
+    ]
+    for labels, api_calls, throttles in api_usage:
+        for operation, count in sorted(api_calls.items()):
+            lines.append(f"eks_node_rollout_aws_api_calls{prometheus_labels(**labels, operation=operation)} {count}")
+    lines += [
+        "# HELP eks_node_rollout_aws_throttles AWS API calls throttled during the last rollout.",
+        "# TYPE eks_node_rollout_aws_throttles gauge",
+    ]
+    for labels, api_calls, throttles in api_usage:
+        for operation, count in sorted(throttles.items()):
+            lines.append(f"eks_node_rollout_aws_throttles{prometheus_labels(**labels, operation=operation)} {count}")
+
+    with open(f"{path}.tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(f"{path}.tmp", path)
+
+
+class CachingPaginator:
+    """Wraps a boto3 paginator so every page it returns is also stored in the DescribeCache"""
+
+    def __init__(self, paginator, put, result_key):
+        self._paginator = paginator
+        self._put = put
+        self._result_key = result_key
+
+    def paginate(self, **kwargs):
+        for page in self._paginator.paginate(**kwargs):
+            self._put(page[self._result_key])
+            yield page
+
+
+class RolloutState:
+    """Rollout progress checkpointed to a JSON file, so an interrupted run can be resumed.
+
+    Records the ASGs being rolled, whether we suspended cluster-autoscaler on each of them, the capacity
+    launched for each wave and which outdated instances were already terminated. The file is rewritten
+    atomically after every change and removed once the rollout completes.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, cluster_name, data=None):
+        self.path = path
+        self.cluster_name = cluster_name
+        self.data = data or {"version": self.VERSION, "cluster": cluster_name, "asg_names": None, "asgs": {}}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def load(cls, path, cluster_name):
+        if not os.path.exists(path):
+            return cls(path, cluster_name)
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != cls.VERSION or data.get("cluster") != cluster_name:
+            raise Exception(f"State file {path} is not a version {cls.VERSION} state file for cluster {cluster_name}.")
+        logging.info(f"Resuming the interrupted rollout recorded in {path}.")
+        return cls(path, cluster_name, data)
+
+    @property
+    def resumed(self):
+        return self.data["asg_names"] is not None
+
+    def save(self):
+        with self._lock:
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(self.data, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f"{self.path}.tmp", self.path)
+
+    def remove(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def asg(self, asg_name):
+        with self._lock:
+            return self.data["asgs"].setdefault(asg_name, {"autoscaler_suspended": False, "done": False, "launches": [], "terminated": []})
+
+    def set_asg_names(self, asg_names):
+        with self._lock:
+            self.data["asg_names"] = list(asg_names)
+            self.save()
+
+    def update(self, asg_name, **fields):
+        with self._lock:
+            self.asg(asg_name).update(fields)
+            self.save()
+
+    def record_launch(self, asg_name, instances, since, exclude):
+        """Record the capacity launched to replace `instances`, before we know which instances it launched"""
+
+        with self._lock:
+            self.asg(asg_name)["launches"].append({
+                "outdated": [instance["InstanceId"] for instance in instances],
+                "since": since.isoformat(),
+                "exclude": list(exclude),
+            })
+            self.save()
+
+    def rewrite_launch(self, asg_name, before, instances):
+        """Point the launch recorded for the `before` instances at `instances`, after they were swapped between waves"""
+
+        before_ids = {instance["InstanceId"] for instance in before}
+        with self._lock:
+            for launch in self.asg(asg_name)["launches"]:
+                if set(launch["outdated"]) == before_ids:
+                    launch["outdated"] = [instance["InstanceId"] for instance in instances]
+            self.save()
+
+    def find_launch(self, asg_name, instances):
+        """The capacity an earlier run launched to replace `instances`, as a (since, exclude) tuple"""
+
+        instance_ids = {instance["InstanceId"] for instance in instances}
+        with self._lock:
+            for launch in self.asg(asg_name)["launches"]:
+                if instance_ids <= set(launch["outdated"]):
+                    return datetime.datetime.fromisoformat(launch["since"]), launch["exclude"]
+        return None
+
+    def adoptable_waves(self, asg_name, instances):
+        """Group the outdated `instances` that already have replacements launched by the launch they belong to"""
+
+        by_id = {instance["InstanceId"]: instance for instance in instances}
+        with self._lock:
+            launches = [[by_id[instance_id] for instance_id in launch["outdated"] if instance_id in by_id] for launch in self.asg(asg_name)["launches"]]
+        return [launch for launch in launches if len(launch) > 0]
+
+    def record_terminated(self, asg_name, instance):
+        with self._lock:
+            state = self.asg(asg_name)
+            state["terminated"].append(instance["InstanceId"])
+            # forget launches whose outdated instances are all gone
+            state["launches"] = [launch for launch in state["launches"] if not set(launch["outdated"]) <= set(state["terminated"])]
+            self.save()
+
+    def is_terminated(self, asg_name, instance):
+        with self._lock:
+            return instance["InstanceId"] in self.asg(asg_name)["terminated"]
+
+
+def get_desired_capacity(asg_client, asg_name):
+    """Returns the DesiredCapacity of an ASG"""
 
     response = asg_client.describe_auto_scaling_groups(
         AutoScalingGroupNames=[
             asg_name
         ]
     )
-    old_capacity = response["AutoScalingGroups"][0]["DesiredCapacity"]
-    new_capacity = old_capacity + 1
+    return response["AutoScalingGroups"][0]["DesiredCapacity"]
+
+
+def get_capacity(asg_client, asg_name):
+    """Returns the DesiredCapacity and MaxSize of an ASG"""
+
+    asg = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])["AutoScalingGroups"][0]
+    return asg["DesiredCapacity"], asg["MaxSize"]
+
+
+def add_node(asg_client, asg_name, count=1, dry_run=True):
+    """Increment desired_count by `count` with a single API call"""
+
+    old_capacity = get_desired_capacity(asg_client, asg_name)
+    new_capacity = old_capacity + count
     logging.debug(f"Old capacity was {old_capacity}, setting to {new_capacity}")
     if dry_run is False:
         asg_client.set_desired_capacity(
@@ -37,23 +622,78 @@ def add_node(asg_client, asg_name, dry_run=True):
         )
     else:
         logging.info(f"--dry-run is set, not scaling up {asg_name}")
-    logging.info(f"Launched a new node in ASG {asg_name}.")
+    logging.info(f"Launched {count} new node(s) in ASG {asg_name}.")
 
 
-def get_latest_lt_version(ec2_client, lt_id):
-    response = ec2_client.describe_launch_templates(
-        LaunchTemplateIds=[
-            lt_id
-        ]
-    )
-    latest_version = response['LaunchTemplates'][0]['LatestVersionNumber']
-    return latest_version
+class LaunchTemplateResolver:
+    """Resolves the launch template versions ASGs launch instances from, memoized for the whole run.
+
+    `prefetch()` describes the templates of every ASG in one DescribeLaunchTemplates call, anything not
+    prefetched is described on first use.
+    """
+
+    def __init__(self, ec2_client):
+        self.ec2_client = ec2_client
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, asgs):
+        specs = [spec for asg in asgs for spec in get_launch_template_specs(asg)]
+        self._describe(specs)
+
+    def _describe(self, specs):
+        with self._lock:
+            ids = sorted({spec["LaunchTemplateId"] for spec in specs if "LaunchTemplateId" in spec} - set(self._templates))
+            names = sorted({spec["LaunchTemplateName"] for spec in specs if "LaunchTemplateId" not in spec} - set(self._templates))
+            for key, values in [("LaunchTemplateIds", ids), ("LaunchTemplateNames", names)]:
+                if len(values) == 0:
+                    continue
+                # the API refuses IDs and names in the same request
+                for page in self.ec2_client.get_paginator("describe_launch_templates").paginate(**{key: values}):
+                    for template in page["LaunchTemplates"]:
+                        self._templates[template["LaunchTemplateId"]] = template
+                        self._templates[template["LaunchTemplateName"]] = template
+
+    def resolve(self, spec):
+        """Returns the (launch template ID, version number) a launch template specification launches instances from"""
 
+        key = spec.get("LaunchTemplateId") or spec["LaunchTemplateName"]
+        if key not in self._templates:
+            self._describe([spec])
+        template = self._templates[key]
+        version = spec.get("Version", "$Default")
+        if version == "$Latest":
+            version = template["LatestVersionNumber"]
+        elif version == "$Default":
+            version = template["DefaultVersionNumber"]
+        return template["LaunchTemplateId"], int(version)
 
-def describe_nodes_not_matching_lt(asg_client, ec2_client, asg_name):
+
+def get_launch_template_specs(asg):
+    """The launch template specifications of an ASG, including per instance type overrides"""
+
+    if "LaunchTemplate" in asg:
+        return [asg["LaunchTemplate"]]
+    if "MixedInstancesPolicy" in asg:
+        launch_template = asg["MixedInstancesPolicy"]["LaunchTemplate"]
+        overrides = [override["LaunchTemplateSpecification"] for override in launch_template.get("Overrides", []) if "LaunchTemplateSpecification" in override]
+        return [launch_template["LaunchTemplateSpecification"]] + overrides
+    return []  # launch configuration
+
+
+def is_instance_outdated(asg, instance, resolver):
+    if "LaunchConfigurationName" in asg:
+        return instance.get("LaunchConfigurationName") != asg["LaunchConfigurationName"]
+    if "LaunchTemplate" not in instance:
+        return True  # still on a launch configuration the ASG has moved away from
+    current = {resolver.resolve(spec) for spec in get_launch_template_specs(asg)}
+    return (instance["LaunchTemplate"]["LaunchTemplateId"], int(instance["LaunchTemplate"]["Version"])) not in current
+
+
+def describe_nodes_not_matching_lt(asg_client, ec2_client, asg_name, resolver=None):
     """Get information about outdated instances"""
 
-    old_lt_instance_ids = []
+    resolver = resolver or LaunchTemplateResolver(ec2_client)
     instances = []
 
     response = asg_client.describe_auto_scaling_groups(
@@ -61,14 +701,16 @@ def describe_nodes_not_matching_lt(asg_client, ec2_client, asg_name):
             asg_name
         ]
     )
-    lt_id = response["AutoScalingGroups"][0]["MixedInstancesPolicy"]["LaunchTemplate"]["LaunchTemplateSpecification"]["LaunchTemplateId"]
-    latest_lt = get_latest_lt_version(ec2_client, lt_id)
-    logging.info(f"Latest launch template version is {latest_lt}")
+    asg = response["AutoScalingGroups"][0]
+    if "LaunchConfigurationName" in asg:
+        logging.info(f"Current launch configuration is {asg['LaunchConfigurationName']}")
+    else:
+        logging.info(f"Current launch template versions are {sorted(resolver.resolve(spec) for spec in get_launch_template_specs(asg))}")
 
-    lt_info = [{instance["InstanceId"]: instance["LaunchTemplate"]["Version"]} for instance in response["AutoScalingGroups"][0]["Instances"]]
+    lt_info = [{instance["InstanceId"]: instance["LaunchTemplate"]["Version"] if "LaunchTemplate" in instance else instance.get("LaunchConfigurationName")} for instance in asg["Instances"]]
     logging.info(f"Instances and their Launch Templates: {lt_info}")
 
-    old_lt_instance_ids = [instance["InstanceId"] for instance in response["AutoScalingGroups"][0]["Instances"] if int(instance["LaunchTemplate"]["Version"]) != latest_lt]
+    old_lt_instance_ids = [instance["InstanceId"] for instance in asg["Instances"] if is_instance_outdated(asg, instance, resolver)]
     if len(old_lt_instance_ids) == 0:
         logging.debug(f"Found no outdated instances.")
         return []
@@ -78,103 +720,274 @@ def describe_nodes_not_matching_lt(asg_client, ec2_client, asg_name):
         for instance in reservation["Instances"]:
             instances.append(instance)
 
-    node_info = [instance["PrivateDnsName"] for instance in instances if instance["State"]["Name"] in ["pending", "running"]]
+    instances = [instance for instance in instances if instance["State"]["Name"] in ["pending", "running"]]
+    node_info = [instance["PrivateDnsName"] for instance in instances]
     logging.info(f"Instances with outdated Launch Template: {node_info}")
 
     return instances
 
 
-def terminate_node(asg_client, instance_id, dry_run=True):
-    """Terminate a given instance"""
+def terminate_node(asg_client, instance_id, dry_run=True, decrement=True):
+    """Terminate a given instance. With `decrement=False` the ASG will launch a replacement for it"""
 
     if dry_run is False:
         logging.info(f"Terminating {instance_id}...")
         response = asg_client.terminate_instance_in_auto_scaling_group(
             InstanceId=instance_id,
-            ShouldDecrementDesiredCapacity=True
+            ShouldDecrementDesiredCapacity=decrement
         )
     else:
         logging.info(f"--dry-run is set, not actually terminating {instance_id}")
 
 
-@backoff.on_predicate(backoff.expo)
-def get_latest_instance(asg_client, ec2_client, asg_name, add_time, dry_run=True):
-    """Retrieve the most recently launched/launching instance. Note that this is not necessarily the same one that was launched by `add_node()`, but it's the best I could think of"""
-
-    instances = []
+def get_asg_instance_ids(asg_client, asg_name):
+    """Returns the IDs of all instances currently in an ASG"""
 
     response = asg_client.describe_auto_scaling_groups(
         AutoScalingGroupNames=[
             asg_name
         ]
     )
-    instance_ids = [instance["InstanceId"] for instance in response["AutoScalingGroups"][0]["Instances"]]
+    return [instance["InstanceId"] for instance in response["AutoScalingGroups"][0]["Instances"]]
+
+
+def get_launched_instance_ids(asg_client, asg_name, since, exclude=()):
+    """Returns the IDs of instances launched by scaling activities that started after `since`, oldest first.
+
+    `since` is widened by ACTIVITY_CLOCK_TOLERANCE to allow for clock skew, so `exclude` should hold the
+    instances that were already in the ASG before the capacity change.
+    """
+
+    instance_ids = []
+    paginator = asg_client.get_paginator("describe_scaling_activities")
+    for page in paginator.paginate(AutoScalingGroupName=asg_name):
+        for activity in page["Activities"]:  # newest first
+            if activity["StartTime"] < since - ACTIVITY_CLOCK_TOLERANCE:
+                return instance_ids[::-1]
+            match = LAUNCH_ACTIVITY_PATTERN.match(activity["Description"])
+            if match is None or activity["StatusCode"] in ["Failed", "Cancelled"]:
+                continue
+            if match.group(1) not in exclude:
+                instance_ids.append(match.group(1))
+    return instance_ids[::-1]
+
 
+def describe_instances(ec2_client, instance_ids):
+    instances = []
     response = ec2_client.describe_instances(InstanceIds=instance_ids)
     for reservation in response["Reservations"]:
         for instance in reservation["Instances"]:
             instances.append(instance)
-    instance_launch_times = [{x["PrivateDnsName"]: x["LaunchTime"]} for x in instances]
-    logging.debug(f"Node added at {add_time}")
-    logging.debug(f"Instance launch times: {instance_launch_times}")
-    if not dry_run:
-        instances_valid = [instance for instance in instances if instance["State"]["Name"] in ["pending", "running"] and instance["LaunchTime"] > add_time]
-    else:
-        instances_valid = [instance for instance in instances if instance["State"]["Name"] in ["pending", "running"]]  # just grab any old instance to make `kubectl wait` work
+    return instances
 
-    try:
-        latest_instance = sorted(instances_valid, key=lambda instance: instance["LaunchTime"])[-1]
-    except IndexError:
-        return None  # backoff.on_predicate will retry if None is returned
-    logging.info(f"Most recently launched instance is {latest_instance['PrivateDnsName']}.")
 
-    return latest_instance
+class PollTimeout(Exception):
+    """Raised by poll() when `func` didn't succeed in time"""
 
 
-def get_num_of_instances(asg_client, ec2_client, asg_name):
-    """Returns number of instances in an ASG"""
+def poll(func, timeout, description, interval=1, max_interval=16, stopped=None):
+    """Call `func` until it returns something truthy, with jittered exponential backoff between attempts.
 
-    instances = []
+    Raises PollTimeout if `func` hasn't succeeded `timeout` seconds after the first attempt, or a plain
+    Exception once the `stopped` event is set.
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        result = func()
+        if result:
+            return result
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise PollTimeout(f"Timed out after {timeout}s waiting for {description}.")
+        time.sleep(min(interval * random.uniform(0.5, 1.5), remaining))
+        if stopped is not None and stopped.is_set():
+            raise Exception(f"Stopped waiting for {description}.")
+        interval = min(interval * 2, max_interval)
+
+
+def get_launched_instances(asg_client, ec2_client, asg_name, since, count, exclude=()):
+    """Describe the `count` instances launched by the capacity change made at `since`.
+
+    Only the instance IDs named by the ASG's scaling activities are described, rather than the whole ASG.
+    """
+
+    instance_ids = get_launched_instance_ids(asg_client, asg_name, since, exclude)
+    logging.debug(f"Scaling activities since {since} launched {instance_ids}")
+    if len(instance_ids) < count:
+        return None
+
+    # a launched instance may have been replaced since, e.g. after failing a health check or a spot interruption.
+    # Filtering by ID rather than passing InstanceIds doesn't fail on instances EC2 no longer knows about.
+    response = ec2_client.describe_instances(Filters=[
+        {"Name": "instance-id", "Values": instance_ids},
+        {"Name": "instance-state-name", "Values": ["pending", "running"]},
+    ])
+    live = {instance["InstanceId"]: instance for reservation in response["Reservations"] for instance in reservation["Instances"]}
+    instances = [live[instance_id] for instance_id in instance_ids if instance_id in live][:count]
+    if len(instances) < count or not all(instance.get("PrivateDnsName") for instance in instances):
+        return None
+    logging.info(f"Launched instance(s): {[instance['PrivateDnsName'] for instance in instances]}.")
+
+    return instances
+
+
+def get_existing_instances(asg_client, ec2_client, asg_name, count):
+    """Used by --dry-run to have some nodes to wait on, as no instances are actually launched"""
 
     response = asg_client.describe_auto_scaling_groups(
         AutoScalingGroupNames=[
             asg_name
         ]
     )
-    instance_ids = [instance["InstanceId"] for instance in response["AutoScalingGroups"][0]["Instances"]]
-    response = ec2_client.describe_instances(InstanceIds=instance_ids)
-    for reservation in response["Reservations"]:
-        for instance in reservation["Instances"]:
-            instances.append(instance)
-    instances = [instance for instance in instances if instance["State"]["Name"] in ["running", "pending"]]
-    logging.debug(f"get_num_of_instances() returns {instances}")
-    return len(instances)
+    instance_ids = [instance["InstanceId"] for instance in response["AutoScalingGroups"][0]["Instances"] if instance["LifecycleState"] == "InService"]
+    return describe_instances(ec2_client, instance_ids[:count])
+
+
+def iter_matching_asgs(asg_client, cluster_name):
+    """Yields the full description of every ASG tagged for the cluster as each page arrives, AWS does the tag matching"""
+
+    paginator = asg_client.get_paginator("describe_auto_scaling_groups")
+    for page in paginator.paginate(Filters=[{"Name": "tag-key", "Values": [f"kubernetes.io/cluster/{cluster_name}"]}]):
+        for asg in page["AutoScalingGroups"]:
+            logging.info(f"Found matching ASG: {asg['AutoScalingGroupName']}")
+            yield asg
 
 
 def get_matching_asgs(asg_client, cluster_name):
-    response = asg_client.describe_auto_scaling_groups()
-    matching = []
-    for asg in response["AutoScalingGroups"]:
-        for tag in asg["Tags"]:
-            if tag["Key"] == f"kubernetes.io/cluster/{cluster_name}":
-                asg_name = asg["AutoScalingGroupName"]
-                logging.info(f"Found matching ASG: {asg_name}")
-                matching.append(asg)
-    matching_names = [x["AutoScalingGroupName"] for x in matching]
-    return matching_names
-
-
-# only using backoff here until the node has registered, after that we rely on kubectl polling
-@backoff.on_predicate(backoff.expo, lambda x: x == "NotFound")
-def wait_for_ready_node(node_name):
+    return list(iter_matching_asgs(asg_client, cluster_name))
+
+
+def get_core_v1_api(context=None):
+    """Build a Kubernetes API client from the kubeconfig, falling back to the in-cluster service account.
+
+    Each client gets its own configuration rather than the global default, so clusters with different
+    contexts can be rolled side by side. A named `context` never falls back to the in-cluster one.
+    """
+
     try:
-        kubectl.wait("--for", "condition=Ready", f"node/{node_name}", "--timeout=300s")
-    except sh.ErrorReturnCode_1 as e:
-        if "NotFound" in e.stderr.decode():  # if the node has not even been registered in the API server yet, retry the command with backoff
-            return "NotFound"
-        else:
+        api_client = kubernetes.config.new_client_from_config(context=context)
+    except kubernetes.config.ConfigException:
+        if context is not None:
             raise
-    return
+        configuration = kubernetes.client.Configuration()
+        kubernetes.config.load_incluster_config(client_configuration=configuration)
+        api_client = kubernetes.client.ApiClient(configuration)
+    return kubernetes.client.CoreV1Api(api_client)
+
+
+def get_policy_v1_api(core_v1):
+    """Shares the configuration of the client built by get_core_v1_api()"""
+
+    return kubernetes.client.PolicyV1Api(core_v1.api_client)
+
+
+def is_node_ready(node):
+    if node.status is None or node.status.conditions is None:
+        return False
+    conditions = node.status.conditions
+    return any(condition.type == "Ready" and condition.status == "True" for condition in conditions)
+
+
+class NodeReadinessTracker:
+    """Watches Node objects and resolves a future for each node as soon as it reports Ready=True.
+
+    A single watch stream serves every pending node, so waiting on a whole wave costs one connection to
+    the API server rather than one `kubectl wait` per node.
+    """
+
+    def __init__(self, core_v1, watch_timeout=60):
+        self.core_v1 = core_v1
+        self.watch_timeout = watch_timeout
+        self._lock = threading.Lock()
+        self._ready = set()
+        self._pending = {}
+        self._timelines = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="node-readiness-tracker", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def wait_for(self, node_name):
+        """Returns a future that resolves once `node_name` is Ready"""
+
+        with self._lock:
+            future = self._pending.get(node_name)
+            if future is None:
+                future = Future()
+                if node_name in self._ready:
+                    future.set_result(node_name)
+                else:
+                    self._pending[node_name] = future
+            return future
+
+    def timeline(self, node_name):
+        """When a Ready node registered and became Ready, according to the API server"""
+
+        with self._lock:
+            return dict(self._timelines.get(node_name, {}))
+
+    def handle_event(self, event_type, node):
+        node_name = node.metadata.name
+        with self._lock:
+            if event_type != "DELETED" and is_node_ready(node):
+                self._ready.add(node_name)
+                ready_condition = [condition for condition in node.status.conditions if condition.type == "Ready"][0]
+                self._timelines[node_name] = {"node_registered": node.metadata.creation_timestamp, "node_ready": ready_condition.last_transition_time}
+                future = self._pending.pop(node_name, None)
+                if future is not None:
+                    logging.debug(f"Watch reported node {node_name} as Ready")
+                    future.set_result(node_name)
+            else:
+                self._ready.discard(node_name)
+
+    def _run(self):
+        resource_version = None
+        while not self._stopped.is_set():
+            try:
+                if resource_version is None:
+                    nodes = self.core_v1.list_node()
+                    for node in nodes.items:
+                        self.handle_event("ADDED", node)
+                    resource_version = nodes.metadata.resource_version
+                for event in watch.Watch().stream(self.core_v1.list_node, resource_version=resource_version, timeout_seconds=self.watch_timeout):
+                    if self._stopped.is_set():
+                        return
+                    self.handle_event(event["type"], event["object"])
+                    resource_version = event["object"].metadata.resource_version
+            except ApiException as e:
+                if e.status == 410:  # our resource version is too old, start over with a fresh list
+                    resource_version = None
+                else:
+                    logging.warning(f"Node watch failed, restarting: {e.reason}")
+                    self._stopped.wait(1)
+            except Exception as e:
+                logging.warning(f"Node watch failed, restarting: {e}")
+                resource_version = None
+                self._stopped.wait(1)
+
+
+def wait_for_ready_node(tracker, node_name, timeout=600, stopped=None):
+    """Block until `node_name` has registered and is "Ready", raising TimeoutError after `timeout` seconds or once the `stopped` event is set"""
+
+    future = tracker.wait_for(node_name)
+    if stopped is None:
+        future.result(timeout=timeout)
+        return
+    for _ in range(math.ceil(timeout)):
+        if stopped.is_set():
+            raise Exception(f"Stopped waiting for node {node_name} to be Ready.")
+        try:
+            future.result(timeout=1)
+            return
+        except FutureTimeoutError:
+            pass
+    raise FutureTimeoutError()
 
 
 def check_is_cluster_autoscaler_tag_present(asg_client, asg_name):
@@ -225,83 +1038,1332 @@ def enable_autoscaling(asg_client, asg_name, dry_run=True):
         logging.info(f"Dry-run enabled, not actually touching tags on {asg_name}.")
 
 
-@click.command()
-@click.option('--cluster-name', envvar='EKS_NODE_ROLLOUT_CLUSTER_NAME', required=True, help="Cluster name to discover ASGs from")
-@click.option('--dry-run/--no-dry-run', envvar='EKS_NODE_ROLLOUT_DRY_RUN', default=False, help="Run with read-only API calls")
-@click.option('--debug/--no-debug', envvar='EKS_NODE_ROLLOUT_DEBUG', default=False, help="Enable debug logging")
-def rollout_nodes(cluster_name, dry_run, debug):
-    """Retrieve all outdated workers and perform a rolling update on them."""
+def is_az_rebalance_suspended(asg_client, asg_name):
+    response = asg_client.describe_auto_scaling_groups(
+        AutoScalingGroupNames=[
+            asg_name
+        ]
+    )
+    return "AZRebalance" in [process["ProcessName"] for process in response["AutoScalingGroups"][0].get("SuspendedProcesses", [])]
+
+
+def suspend_az_rebalancing(asg_client, asg_name, dry_run=True):
+    logging.info(f"Suspending AZRebalance on {asg_name}...")
+    if not dry_run:
+        asg_client.suspend_processes(AutoScalingGroupName=asg_name, ScalingProcesses=["AZRebalance"])
+    else:
+        logging.info(f"Dry-run enabled, not actually suspending processes on {asg_name}.")
+
+
+def resume_az_rebalancing(asg_client, asg_name, dry_run=True):
+    logging.info(f"Resuming AZRebalance on {asg_name}...")
+    if not dry_run:
+        asg_client.resume_processes(AutoScalingGroupName=asg_name, ScalingProcesses=["AZRebalance"])
+    else:
+        logging.info(f"Dry-run enabled, not actually resuming processes on {asg_name}.")
+
+
+def resolve_rollout_count(value, total, round_up):
+    """Resolve an absolute count or a percentage of `total` (e.g. "25%"), rounding like a Deployment does"""
+
+    value = str(value).strip()
+    if value.endswith("%"):
+        percent = int(value[:-1])
+        if round_up:
+            return -(-total * percent // 100)
+        return total * percent // 100
+    return int(value)
+
+
+def validate_rollout_count(ctx, param, value):
+    """click callback for --max-surge/--max-unavailable"""
+
+    try:
+        if resolve_rollout_count(value, 100, True) < 0:
+            raise ValueError
+    except ValueError:
+        raise click.BadParameter(f"{value} is not a non-negative integer or percentage")
+    return value
+
+
+def get_availability_zone(instance):
+    return instance.get("Placement", {}).get("AvailabilityZone")
+
+
+def order_by_az(instances):
+    """Interleave outdated instances across AZs, so every wave takes from each zone in turn"""
+
+    by_az = collections.defaultdict(list)
+    for instance in instances:
+        by_az[get_availability_zone(instance)].append(instance)
+    zones = sorted(by_az.values(), key=len, reverse=True)
+    ordered = []
+    while any(zones):
+        for zone in zones:
+            if len(zone) > 0:
+                ordered.append(zone.pop(0))
+    return ordered
+
+
+class AzScheduler:
+    """Keeps an ASG's zones balanced as waves are replaced.
+
+    The ASG launches each replacement into whichever AZ it likes, so once a wave's replacements are known,
+    outdated instances are swapped in from later waves until the wave terminates one instance in each AZ a
+    replacement landed in. Otherwise the AZRebalance process would terminate nodes to even the zones out.
+    """
+
+    def __init__(self, waves):
+        self.waves = waves
+        self._lock = threading.Lock()
+
+    def pair(self, surge, replacements):
+        """Swap instances between `surge` and later waves in place, returns whether anything was swapped"""
+
+        with self._lock:
+            index = next(i for i, (wave_surge, _) in enumerate(self.waves) if wave_surge is surge)
+            later = [wave for wave_surge, unavailable in self.waves[index + 1:] for wave in (wave_surge, unavailable)]
+            wanted = collections.Counter(get_availability_zone(replacement) for replacement in replacements)
+            have = collections.Counter(get_availability_zone(instance) for instance in surge)
+            swapped = False
+            for i, instance in enumerate(surge):
+                zone = get_availability_zone(instance)
+                if have[zone] <= wanted[zone]:
+                    continue
+                candidates = [(wave, j) for wave in later for j, other in enumerate(wave) if wanted[get_availability_zone(other)] > have[get_availability_zone(other)]]
+                if len(candidates) == 0:
+                    break  # no outdated instances left in the zones we are short of
+                wave, j = candidates[0]
+                other = wave[j]
+                logging.info(f"Terminating {other['PrivateDnsName']} ({get_availability_zone(other)}) before {instance['PrivateDnsName']} ({zone}) to match the zone of its replacement.")
+                surge[i], wave[j] = other, instance
+                have[zone] -= 1
+                have[get_availability_zone(other)] += 1
+                swapped = True
+            return swapped
+
+
+def plan_waves(instances, max_surge, max_unavailable):
+    """Split outdated instances into waves of (surge, unavailable) instances.
+
+    Surge instances are replaced before they are drained, unavailable instances are drained first and
+    backfilled by the ASG afterwards.
+    """
+
+    if max_surge + max_unavailable < 1:
+        raise ValueError("max_surge and max_unavailable cannot both be 0")
+
+    waves = []
+    remaining = list(instances)
+    while remaining:
+        surge = remaining[:max_surge]
+        unavailable = remaining[len(surge):len(surge) + max_unavailable]
+        waves.append((surge, unavailable))
+        remaining = remaining[len(surge) + len(unavailable):]
+    return waves
 
-    if debug:
-        logging.getLogger().setLevel(logging.DEBUG)
 
+def cordon_node(core_v1, node_name):
+    core_v1.patch_node(node_name, {"spec": {"unschedulable": True}})
+
+
+def is_evictable(pod):
+    """Pods `kubectl drain --force --ignore-daemonsets` would remove: anything but mirror and DaemonSet pods"""
+
+    if pod.metadata.annotations and "kubernetes.io/config.mirror" in pod.metadata.annotations:
+        return False
+    return not any(owner.kind == "DaemonSet" for owner in pod.metadata.owner_references or [])
+
+
+def list_node_pods(core_v1, node_name):
+    return core_v1.list_pod_for_all_namespaces(field_selector=f"spec.nodeName={node_name}").items
+
+
+def count_evictable_pods(core_v1, node_names):
+    """The number of evictable pods on each of `node_names`, from a single listing"""
+
+    pod_counts = dict.fromkeys(node_names, 0)
+    for pod in core_v1.list_pod_for_all_namespaces().items:
+        if pod.spec.node_name in pod_counts and is_evictable(pod):
+            pod_counts[pod.spec.node_name] += 1
+    return pod_counts
+
+
+class KubectlDrainer:
+    """Drains nodes with `kubectl drain`, `core_v1` is only used to count the pods on cordoned nodes"""
+
+    def __init__(self, core_v1, timeout=120, context=None):
+        self.core_v1 = core_v1
+        self.timeout = timeout
+        self.context_args = [f"--context={context}"] if context is not None else []
+
+    def drain(self, node_name, dry_run=True):
+        logging.info(f'Draining node {node_name} (--dry-run={dry_run})')
+        output = kubectl.drain(node_name, "--force", "--delete-local-data=true", "--ignore-daemonsets=true", f"--timeout={self.timeout}s", f"--dry-run={dry_run}", *self.context_args)
+        print(output.stdout.decode().rstrip())
+
+    def cordon(self, node_names, dry_run=True):
+        """Cordon several nodes at once, returns the number of evictable pods on each of them"""
+
+        if dry_run:
+            logging.info(f"--dry-run is set, not cordoning {node_names}")
+        else:
+            kubectl.cordon(*node_names, *self.context_args)
+        return count_evictable_pods(self.core_v1, node_names)
+
+    def uncordon(self, node_names):
+        try:
+            kubectl.uncordon(*node_names, *self.context_args)
+        except sh.ErrorReturnCode as e:
+            logging.warning(f"Failed to uncordon {node_names}: {e.stderr.decode().rstrip()}")
+
+
+class NodeDrainer:
+    """Drains nodes in-process through the Eviction API.
+
+    The node is cordoned and its pods listed once, then evictions are issued concurrently by up to `workers`
+    threads. Evictions refused by a PodDisruptionBudget (429) are retried per pod with jittered exponential
+    backoff until `timeout` seconds after the drain started.
+    """
+
+    def __init__(self, core_v1, workers=10, timeout=120, poll_interval=2):
+        self.core_v1 = core_v1
+        self.workers = workers
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._eviction_api_version = None
+
+    def eviction_api_version(self):
+        """The Eviction version the API server supports, discovered like `kubectl drain` does.
+
+        policy/v1 is only served from Kubernetes 1.22, older clusters get policy/v1beta1.
+        """
+
+        with self._lock:
+            if self._eviction_api_version is None:
+                self._eviction_api_version = EVICTION_API_VERSION
+                for resource in self.core_v1.get_api_resources().resources:
+                    if resource.name == "pods/eviction" and resource.kind == "Eviction" and resource.group and resource.version:
+                        self._eviction_api_version = f"{resource.group}/{resource.version}"
+                logging.debug(f"Evicting pods through {self._eviction_api_version}")
+            return self._eviction_api_version
+
+    def drain(self, node_name, dry_run=True):
+        """Returns how long each evicted pod took to go away, keyed by namespace/name"""
+
+        logging.info(f'Draining node {node_name} (--dry-run={dry_run})')
+        started = time.monotonic()
+        deadline = started + self.timeout
+        if not dry_run:
+            cordon_node(self.core_v1, node_name)
+        pods = [pod for pod in list_node_pods(self.core_v1, node_name) if is_evictable(pod)]
+        if dry_run:
+            logging.info(f"--dry-run is set, not evicting {[f'{pod.metadata.namespace}/{pod.metadata.name}' for pod in pods]}")
+            return {}
+
+        eviction_started = {}
+        aborted = threading.Event()
+        remaining = {pod.metadata.uid: pod for pod in pods}
+        latencies = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"evict-{node_name}") as executor:
+            futures = [executor.submit(self._evict, pod, deadline, eviction_started, aborted) for pod in pods]
+            try:
+                while len(remaining) > 0:
+                    failed = [future for future in futures if future.done() and future.exception() is not None]
+                    if len(failed) > 0:
+                        raise failed[0].exception()
+                    if time.monotonic() > deadline:
+                        raise Exception(f"Timed out after {self.timeout}s draining {node_name}, pods remaining: {[f'{pod.metadata.namespace}/{pod.metadata.name}' for pod in remaining.values()]}")
+                    time.sleep(self.poll_interval * random.uniform(0.5, 1.5))
+                    current = {pod.metadata.uid for pod in list_node_pods(self.core_v1, node_name)}
+                    now = time.monotonic()
+                    for uid in [uid for uid in remaining if uid not in current]:
+                        pod = remaining.pop(uid)
+                        latencies[f"{pod.metadata.namespace}/{pod.metadata.name}"] = now - eviction_started.get(uid, started)
+            finally:
+                aborted.set()
+                for future in futures:
+                    future.cancel()
+
+        for pod_name, latency in sorted(latencies.items(), key=lambda item: item[1]):
+            logging.debug(f"Evicted {pod_name} in {latency:.1f}s")
+        if len(latencies) > 0:
+            slowest = max(latencies, key=latencies.get)
+            logging.info(f"Evicted {len(latencies)} pods from {node_name} in {time.monotonic() - started:.1f}s, slowest was {slowest} ({latencies[slowest]:.1f}s)")
+        return latencies
+
+    def cordon(self, node_names, dry_run=True):
+        """Cordon several nodes at once, returns the number of evictable pods on each of them"""
+
+        if dry_run:
+            logging.info(f"--dry-run is set, not cordoning {node_names}")
+        else:
+            for node_name in node_names:
+                cordon_node(self.core_v1, node_name)
+        return count_evictable_pods(self.core_v1, node_names)
+
+    def uncordon(self, node_names):
+        for node_name in node_names:
+            try:
+                self.core_v1.patch_node(node_name, {"spec": {"unschedulable": False}})
+            except ApiException as e:
+                if e.status != 404:  # already terminated
+                    logging.warning(f"Failed to uncordon {node_name}: {e.reason}")
+
+    def _evict(self, pod, deadline, eviction_started, aborted):
+        name, namespace = pod.metadata.name, pod.metadata.namespace
+        api_version = self.eviction_api_version()
+        eviction_started[pod.metadata.uid] = time.monotonic()
+        delay = self.poll_interval
+        while True:
+            try:
+                self.core_v1.create_namespaced_pod_eviction(name, namespace, {
+                    "apiVersion": api_version,
+                    "kind": "Eviction",
+                    "metadata": {"name": name, "namespace": namespace}
+                })
+                return
+            except ApiException as e:
+                if e.status == 404:  # already gone
+                    return
+                if e.status != 429:
+                    raise
+            if aborted.is_set():
+                return
+            if time.monotonic() + delay > deadline:
+                raise Exception(f"Timed out evicting {namespace}/{name}, a PodDisruptionBudget is not allowing the disruption")
+            logging.debug(f"Eviction of {namespace}/{name} refused by a PodDisruptionBudget, retrying in {delay:.1f}s")
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 16)
+
+
+def is_pod_ready(pod):
+    if pod.status is None or pod.status.conditions is None:
+        return False
+    return any(condition.type == "Ready" and condition.status == "True" for condition in pod.status.conditions)
+
+
+def daemonset_of(pod):
+    """namespace/name of the DaemonSet that owns `pod`, or None"""
+
+    for owner in pod.metadata.owner_references or []:
+        if owner.kind == "DaemonSet":
+            return f"{pod.metadata.namespace}/{owner.name}"
+    return None
+
+
+class ReadinessGate:
+    """Holds back the drain of outdated nodes until their replacements can start the evicted pods quickly.
+
+    A replacement passes once every DaemonSet that had a pod on its outdated node has a Ready pod on it, and
+    every DaemonSet pod scheduled to it is Ready. With `prepull`, the images of the outdated node's pods, plus
+    `images`, are first pulled onto the replacement by a short-lived pod pinned to it in each namespace.
+    """
+
+    def __init__(self, core_v1, prepull=False, images=(), timeout=300):
+        self.core_v1 = core_v1
+        self.prepull = prepull
+        self.images = list(images)
+        self.timeout = timeout
+
+    def wait(self, pairs, dry_run=True, stopped=None):
+        """Gate the replacement in each (outdated node, replacement node) pair, returns when each gate started and was passed, keyed by replacement node"""
+
+        started = datetime.datetime.now(datetime.timezone.utc)
+        deadline = time.monotonic() + self.timeout
+        expected = {}
+        prepull_pods = []
+        try:
+            # the pre-pulls of every replacement in the wave run while we wait on the DaemonSets
+            for outdated, replacement in pairs:
+                pods = list_node_pods(self.core_v1, outdated)
+                expected[replacement] = {daemonset_of(pod) for pod in pods} - {None}
+                if self.prepull:
+                    prepull_pods += [(replacement, pod) for pod in self._start_prepull(replacement, [pod for pod in pods if is_evictable(pod)], dry_run)]
+            if dry_run:
+                for replacement, daemonsets in expected.items():
+                    logging.info(f"--dry-run is set, not waiting for DaemonSets {sorted(daemonsets)} to be Ready on {replacement}")
+                return {}
+
+            timelines = {replacement: {"readiness_gate_started": started} for replacement in expected}
+            for replacement, daemonsets in expected.items():
+                poll(lambda: self._daemonsets_ready(replacement, daemonsets), timeout=max(deadline - time.monotonic(), 0), description=f"the DaemonSet pods on {replacement} to be Ready", stopped=stopped)
+                timelines[replacement]["daemonsets_ready"] = datetime.datetime.now(datetime.timezone.utc)
+            for replacement, pod in prepull_pods:
+                try:
+                    poll(lambda: self._images_pulled(pod), timeout=max(deadline - time.monotonic(), 0), description=f"images to be pulled onto {replacement}", stopped=stopped)
+                except (PollTimeout, ApiException) as e:
+                    logging.warning(f"{e} Draining without them.")
+                timelines[replacement]["images_pulled"] = datetime.datetime.now(datetime.timezone.utc)
+        finally:
+            for replacement, pod in prepull_pods:
+                self._delete(pod)
+
+        for replacement, timeline in timelines.items():
+            gates = ", ".join(f"{event} after {(when - started).total_seconds():.1f}s" for event, when in timeline.items() if event != "readiness_gate_started")
+            logging.info(f"Node {replacement} passed the readiness gate: {gates}")
+        return timelines
+
+    def _daemonsets_ready(self, node_name, expected):
+        daemonset_pods = [pod for pod in list_node_pods(self.core_v1, node_name) if daemonset_of(pod) is not None]
+        ready = {daemonset_of(pod) for pod in daemonset_pods if is_pod_ready(pod)}
+        return expected <= ready and len(ready) == len({daemonset_of(pod) for pod in daemonset_pods})
+
+    def _start_prepull(self, node_name, pods, dry_run=True):
+        """Create a pod pinned to `node_name` per namespace, with a container for each image to pull. Returns the pods created"""
+
+        images = {}
+        pull_secrets = {}
+        for pod in pods:
+            namespace = pod.metadata.namespace
+            for container in (pod.spec.init_containers or []) + (pod.spec.containers or []):
+                images.setdefault(namespace, {})[container.image] = None
+            for secret in pod.spec.image_pull_secrets or []:
+                pull_secrets.setdefault(namespace, {})[secret.name] = None
+        if len(self.images) > 0:
+            images.setdefault("default", {}).update(dict.fromkeys(self.images))
+        if dry_run:
+            logging.info(f"--dry-run is set, not pre-pulling {sorted(image for namespace_images in images.values() for image in namespace_images)} onto {node_name}")
+            return []
+
+        created = []
+        for namespace, namespace_images in images.items():
+            logging.info(f"Pre-pulling {len(namespace_images)} image(s) from {namespace} onto {node_name}")
+            try:
+                created.append(self.core_v1.create_namespaced_pod(namespace, {
+                    "apiVersion": "v1",
+                    "kind": "Pod",
+                    "metadata": {"generateName": PREPULL_POD_PREFIX, "namespace": namespace, "labels": {"app.kubernetes.io/managed-by": "eks-node-rollout"}},
+                    "spec": {
+                        "nodeName": node_name,
+                        "restartPolicy": "Never",
+                        "tolerations": [{"operator": "Exists"}],
+                        "imagePullSecrets": [{"name": name} for name in pull_secrets.get(namespace, {})],
+                        # the image is pulled whether or not it has a `true` binary, the container only has to be started
+                        "containers": [{"name": f"image-{i}", "image": image, "command": ["true"]} for i, image in enumerate(namespace_images)],
+                    }
+                }))
+            except ApiException as e:
+                # e.g. no RBAC to create pods there, or an admission policy rejecting the pod
+                logging.warning(f"Not pre-pulling images from {namespace} onto {node_name}, failed to create the pre-pull pod: {e.reason}")
+        return created
+
+    def _images_pulled(self, pod):
+        pod = self.core_v1.read_namespaced_pod(pod.metadata.name, pod.metadata.namespace)
+        statuses = pod.status.container_statuses if pod.status is not None else None
+        if statuses is None or len(statuses) < len(pod.spec.containers):
+            return False
+        for status in statuses:
+            waiting = status.state.waiting if status.state is not None else None
+            if waiting is None:
+                continue  # started, so the image is on the node
+            if waiting.reason in IMAGE_PULL_FAILED_REASONS:
+                logging.warning(f"Failed to pre-pull {status.image} onto {pod.spec.node_name}: {waiting.reason}")
+                continue
+            return False
+        return True
+
+    def _delete(self, pod):
+        try:
+            self.core_v1.delete_namespaced_pod(pod.metadata.name, pod.metadata.namespace, grace_period_seconds=0)
+        except ApiException as e:
+            if e.status != 404:
+                logging.warning(f"Failed to delete pre-pull pod {pod.metadata.namespace}/{pod.metadata.name}: {e.reason}")
+
+
+def selector_matches(selector, labels):
+    """Whether a V1LabelSelector selects a pod with `labels`, an empty selector selects every pod"""
+
+    labels = labels or {}
+    for key, value in (selector.match_labels or {}).items():
+        if labels.get(key) != value:
+            return False
+    for expression in selector.match_expressions or []:
+        if expression.operator == "In" and labels.get(expression.key) not in expression.values:
+            return False
+        if expression.operator == "NotIn" and expression.key in labels and labels[expression.key] in expression.values:
+            return False
+        if expression.operator == "Exists" and expression.key not in labels:
+            return False
+        if expression.operator == "DoesNotExist" and expression.key in labels:
+            return False
+    return True
+
+
+class WorkloadSnapshot:
+    """A single cluster-wide listing of pods and PodDisruptionBudgets, used to estimate how long nodes take to drain.
+
+    Each pod is assumed to take POD_EVICTION_SECONDS to go away, evicted `workers` at a time. Pods beyond a
+    PodDisruptionBudget's current headroom wait POD_RECOVERY_SECONDS each for a replacement to become Ready.
+    """
+
+    POD_EVICTION_SECONDS = 10
+    POD_RECOVERY_SECONDS = 30
+
+    def __init__(self, pods, pdbs):
+        self.pdbs = [pdb for pdb in pdbs if pdb.spec.selector is not None]
+        self.pods_by_node = collections.defaultdict(list)
+        for pod in pods:
+            if pod.spec.node_name is not None and is_evictable(pod):
+                self.pods_by_node[pod.spec.node_name].append(pod)
+
+    @classmethod
+    def take(cls, core_v1, policy_v1):
+        pods = core_v1.list_pod_for_all_namespaces().items
+        try:
+            pdbs = policy_v1.list_pod_disruption_budget_for_all_namespaces().items
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            # clusters older than 1.21 only serve policy/v1beta1 PodDisruptionBudgets
+            pdbs = kubernetes.client.PolicyV1beta1Api(policy_v1.api_client).list_pod_disruption_budget_for_all_namespaces().items
+        logging.info(f"Took a snapshot of {len(pods)} pods and {len(pdbs)} PodDisruptionBudgets to plan the drains.")
+        return cls(pods, pdbs)
+
+    def pdbs_of(self, pod):
+        return [pdb for pdb in self.pdbs if pdb.metadata.namespace == pod.metadata.namespace and selector_matches(pdb.spec.selector, pod.metadata.labels)]
+
+    def drain_cost(self, node_name, workers=10):
+        """Estimated cost of draining a node: its pod count, the pods a PDB will hold back and the seconds it should take"""
+
+        pods = self.pods_by_node.get(node_name, [])
+        per_pdb = collections.Counter()
+        headroom = {}
+        for pod in pods:
+            for pdb in self.pdbs_of(pod):
+                key = f"{pdb.metadata.namespace}/{pdb.metadata.name}"
+                per_pdb[key] += 1
+                headroom[key] = (pdb.status.disruptions_allowed or 0) if pdb.status is not None else 0
+        excess = {key: max(0, count - headroom[key]) for key, count in per_pdb.items()}
+        # PDBs recover in parallel, so the most constrained one dominates
+        seconds = math.ceil(len(pods) / workers) * self.POD_EVICTION_SECONDS + max(excess.values(), default=0) * self.POD_RECOVERY_SECONDS
+        return {"pods": len(pods), "blocked": sum(excess.values()), "pdbs": {key for key, count in excess.items() if count > 0}, "seconds": seconds}
+
+
+class DrainPlanner:
+    """Orders outdated nodes by their estimated drain cost and logs the resulting waves.
+
+    `cheapest` drains the cheapest nodes first, `interleave` also avoids draining nodes held back by the same
+    PodDisruptionBudget back to back, giving the PDB time to recover in between. The waves interleave this
+    order across AZs, so the plan is logged once they are planned.
+    """
+
+    def __init__(self, snapshot, order="cheapest", workers=10, timeout=120):
+        self.snapshot = snapshot
+        self.order = order
+        self.workers = workers
+        self.timeout = timeout
+
+    def plan(self, asg_name, instances):
+        costs = {instance["InstanceId"]: self.snapshot.drain_cost(instance["PrivateDnsName"], self.workers) for instance in instances}
+        remaining = sorted(instances, key=lambda instance: costs[instance["InstanceId"]]["seconds"])
+        if self.order == "cheapest":
+            ordered = remaining
+        else:
+            ordered = []
+            previous = set()
+            while len(remaining) > 0:
+                pick = next((instance for instance in remaining if len(costs[instance["InstanceId"]]["pdbs"] & previous) == 0), remaining[0])
+                ordered.append(pick)
+                remaining.remove(pick)
+                previous = costs[pick["InstanceId"]]["pdbs"]
+        return ordered
+
+    def log_plan(self, asg_name, waves):
+        """Log the waves in the order they will be drained, with each node's estimated drain cost"""
+
+        logging.info(f"Drain plan for {asg_name}:")
+        total = 0
+        for i, (surge, unavailable) in enumerate(waves, start=1):
+            for instance in surge + unavailable:
+                cost = self.snapshot.drain_cost(instance["PrivateDnsName"], self.workers)
+                total += cost["seconds"]
+                at_risk = " (may exceed --drain-timeout)" if cost["seconds"] > self.timeout else ""
+                logging.info(f"  wave {i}: {instance['PrivateDnsName']}: {cost['pods']} pods, {cost['blocked']} held back by {sorted(cost['pdbs'])}, ~{cost['seconds']}s{at_risk}")
+        logging.info(f"Estimated drain time for {asg_name}: ~{total}s")
+
+
+def estimate_avoided_reschedules(pod_counts, total_nodes):
+    """Expected number of evicted pods that would otherwise have landed on an outdated node that is drained later.
+
+    `pod_counts` is the number of evictable pods on each outdated node in drain order, and pods are assumed
+    to be spread evenly over the `total_nodes` nodes left schedulable in the ASG.
+    """
+
+    avoided = 0
+    remaining = len(pod_counts)
+    for pods in pod_counts:
+        remaining -= 1
+        avoided += pods * remaining / max(total_nodes - 1, 1)
+    return round(avoided)
+
+
+def cordon_outdated_nodes(asg_client, drainer, asg_name, node_names, dry_run=True):
+    """Cordon every outdated node so evicted pods can only be scheduled onto up to date nodes"""
+
+    logging.info(f"Cordoning {len(node_names)} outdated node(s) before draining: {node_names}")
+    pod_counts = drainer.cordon(node_names, dry_run)
+    avoided = estimate_avoided_reschedules([pod_counts[node_name] for node_name in node_names], len(get_asg_instance_ids(asg_client, asg_name)))
+    logging.info(f"Cordoning outdated nodes up front avoids an estimated {avoided} pod reschedule(s).")
+
+
+def wait_for_new_nodes(asg_client, ec2_client, tracker, asg_name, since, count, exclude=(), launch_timeout=900, stopped=None, dry_run=True):
+    """Wait for the `count` instances launched by the capacity change made at `since` to join the cluster as "Ready" nodes"""
+
+    logging.info(f'Waiting for {count} instance(s) to be created...')
+    if not dry_run:
+        latest_instances = poll(lambda: get_launched_instances(asg_client=asg_client, ec2_client=ec2_client, asg_name=asg_name, since=since, count=count, exclude=exclude), timeout=launch_timeout, description=f"{count} instance(s) to launch in {asg_name}", stopped=stopped)
+    else:
+        latest_instances = get_existing_instances(asg_client=asg_client, ec2_client=ec2_client, asg_name=asg_name, count=count)  # just grab any old instances to make the readiness wait work
+    latest_node_names = [instance["PrivateDnsName"] for instance in latest_instances]
+    logging.info(f'Waiting for node(s) {latest_node_names} to be "Ready"...')
+    for latest_node_name in latest_node_names:
+        wait_for_ready_node(tracker, latest_node_name, stopped=stopped)
+        logging.info(f'Node {latest_node_name} is now "Ready".')
+    return latest_instances
+
+
+def record_replacements(metrics, tracker, asg_name, outdated, replacements):
+    """Pair each outdated instance with a replacement and record when the replacement launched, registered and became Ready"""
+
+    for instance, replacement in zip(outdated, replacements):
+        metrics.mark(asg_name, instance, "instance_pending", replacement.get("LaunchTime"), replacement_instance_id=replacement.get("InstanceId"), replacement_node=replacement["PrivateDnsName"])
+        for event, when in tracker.timeline(replacement["PrivateDnsName"]).items():
+            metrics.mark(asg_name, instance, event, when)
+
+
+def provision_wave(asg_client, ec2_client, tracker, asg_name, surge, capacity_lock=None, scheduler=None, gate=None, stopped=None, state=None, metrics=None, dry_run=True):
+    """Launch replacements for all `surge` instances with a single capacity change and wait for all of them to be "Ready".
+
+    If an interrupted run already launched the replacements, they are adopted instead. The `scheduler` can
+    swap outdated instances into `surge` to match the AZs the replacements landed in, and the readiness
+    `gate` then holds the wave back until the replacements are ready for the outdated nodes' pods. Waiting
+    is abandoned once the `stopped` event is set.
+    """
+
+    metrics = metrics or RolloutMetrics()
+    launch = state.find_launch(asg_name, surge) if state is not None else None
+    if launch is not None:
+        add_time, existing_instance_ids = launch
+        logging.info(f"Adopting the replacement(s) for {[instance['PrivateDnsName'] for instance in surge]} launched at {add_time} by an interrupted run.")
+    else:
+        with capacity_lock or contextlib.nullcontext():
+            existing_instance_ids = get_asg_instance_ids(asg_client, asg_name)
+            add_time = datetime.datetime.now(datetime.timezone.utc)
+            add_node(asg_client=asg_client, asg_name=asg_name, count=len(surge), dry_run=dry_run)
+            if state is not None:
+                state.record_launch(asg_name, surge, since=add_time, exclude=existing_instance_ids)
+    replacements = wait_for_new_nodes(asg_client=asg_client, ec2_client=ec2_client, tracker=tracker, asg_name=asg_name, since=add_time, count=len(surge), exclude=existing_instance_ids, stopped=stopped, dry_run=dry_run)
+    if scheduler is not None:
+        before = list(surge)
+        if scheduler.pair(surge, replacements) and state is not None:
+            state.rewrite_launch(asg_name, before, surge)
+    for instance in surge:
+        metrics.mark(asg_name, instance, "capacity_requested", add_time)
+    record_replacements(metrics, tracker, asg_name, surge, replacements)
+    if gate is not None:
+        timelines = gate.wait([(instance["PrivateDnsName"], replacement["PrivateDnsName"]) for instance, replacement in zip(surge, replacements)], dry_run, stopped=stopped)
+        for instance, replacement in zip(surge, replacements):
+            for event, when in timelines.get(replacement["PrivateDnsName"], {}).items():
+                metrics.mark(asg_name, instance, event, when)
+    return replacements
+
+
+def drain_and_terminate(asg_client, drainer, asg_name, instance, capacity_lock=None, decrement=True, state=None, metrics=None, dry_run=True):
+    metrics = metrics or RolloutMetrics()
+    metrics.mark(asg_name, instance, "drain_started")
+    evicted = drainer.drain(instance["PrivateDnsName"], dry_run)
+    metrics.mark(asg_name, instance, "drain_finished", pods_evicted=None if evicted is None else len(evicted))
+    with capacity_lock or contextlib.nullcontext():
+        terminate_node(asg_client, instance["InstanceId"], dry_run, decrement=decrement)
+        if state is not None:
+            state.record_terminated(asg_name, instance)
+    metrics.mark(asg_name, instance, "terminated")
+
+
+def retire_wave(asg_client, ec2_client, tracker, drainer, asg_name, surge, unavailable, capacity_lock=None, cordon_first=(), state=None, metrics=None, dry_run=True):
+    """Drain and terminate the outdated instances of a wave whose surge replacements are already "Ready".
+
+    Unavailable instances are terminated without decrementing the desired capacity, so we wait for the ASG
+    to backfill them before returning. Nodes in `cordon_first` are cordoned before anything is drained.
+    """
+
+    metrics = metrics or RolloutMetrics()
+    if len(cordon_first) > 0:
+        cordon_outdated_nodes(asg_client=asg_client, drainer=drainer, asg_name=asg_name, node_names=cordon_first, dry_run=dry_run)
+
+    for instance in surge:
+        drain_and_terminate(asg_client=asg_client, drainer=drainer, asg_name=asg_name, instance=instance, capacity_lock=capacity_lock, state=state, metrics=metrics, dry_run=dry_run)
+
+    if len(unavailable) > 0:
+        existing_instance_ids = get_asg_instance_ids(asg_client, asg_name)
+        remove_time = datetime.datetime.now(datetime.timezone.utc)
+        for instance in unavailable:
+            drain_and_terminate(asg_client=asg_client, drainer=drainer, asg_name=asg_name, instance=instance, decrement=False, state=state, metrics=metrics, dry_run=dry_run)
+            metrics.mark(asg_name, instance, "capacity_requested")  # the ASG backfills it as soon as it's terminated
+        replacements = wait_for_new_nodes(asg_client=asg_client, ec2_client=ec2_client, tracker=tracker, asg_name=asg_name, since=remove_time, count=len(unavailable), exclude=existing_instance_ids, dry_run=dry_run)
+        record_replacements(metrics, tracker, asg_name, unavailable, replacements)
+
+
+def replace_wave(asg_client, ec2_client, tracker, drainer, asg_name, surge, unavailable, cordon_first=(), scheduler=None, gate=None, state=None, metrics=None, dry_run=True):
+    """Replace one wave of outdated instances.
+
+    All surge replacements are launched with a single capacity change and waited on together, then the
+    whole wave is drained and terminated.
+    """
+
+    if len(surge) > 0:
+        provision_wave(asg_client=asg_client, ec2_client=ec2_client, tracker=tracker, asg_name=asg_name, surge=surge, scheduler=scheduler, gate=gate, state=state, metrics=metrics, dry_run=dry_run)
+    retire_wave(asg_client=asg_client, ec2_client=ec2_client, tracker=tracker, drainer=drainer, asg_name=asg_name, surge=surge, unavailable=unavailable, cordon_first=cordon_first, state=state, metrics=metrics, dry_run=dry_run)
+
+
+def replace_waves_pipelined(asg_client, ec2_client, tracker, drainer, asg_name, waves, depth, in_flight, cordon_first=(), scheduler=None, gate=None, state=None, metrics=None, dry_run=True):
+    """Provision the replacements for upcoming waves while the current wave is being drained.
+
+    A provisioner thread launches waves into a bounded queue and runs at most `depth` waves ahead of the
+    drain, so a warm replacement is usually "Ready" by the time the previous drain completes. Capacity
+    changes from both stages are serialised on a lock, as each one reads and then writes DesiredCapacity.
+    If a drain fails, the provisioner stops waiting on launches and readiness, so the failure is raised
+    promptly.
+    """
+
+    provisioned = queue.Queue(maxsize=depth)
+    ahead = threading.Semaphore(depth)
+    capacity_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def provision():
+        log_context.asg_name = asg_name
+        try:
+            for surge, unavailable in waves:
+                while not ahead.acquire(timeout=1):
+                    if stopped.is_set():
+                        return
+                if stopped.is_set():
+                    return
+                if not in_flight.acquire(len(surge), cancelled=stopped):
+                    return
+                try:
+                    provision_wave(asg_client=asg_client, ec2_client=ec2_client, tracker=tracker, asg_name=asg_name, surge=surge, capacity_lock=capacity_lock, scheduler=scheduler, gate=gate, stopped=stopped, state=state, metrics=metrics, dry_run=dry_run)
+                except BaseException:
+                    in_flight.release(len(surge))
+                    raise
+                provisioned.put((surge, unavailable))
+        except Exception as e:
+            provisioned.put(e)
+
+    provisioner = threading.Thread(target=provision, name=f"provision-{asg_name}", daemon=True)
+    provisioner.start()
+    try:
+        for i in range(len(waves)):
+            wave = provisioned.get()
+            if isinstance(wave, Exception):
+                raise wave
+            ahead.release()
+            surge, unavailable = wave
+            try:
+                retire_wave(asg_client=asg_client, ec2_client=ec2_client, tracker=tracker, drainer=drainer, asg_name=asg_name, surge=surge, unavailable=unavailable, capacity_lock=capacity_lock, cordon_first=cordon_first if i == 0 else (), state=state, metrics=metrics, dry_run=dry_run)
+            finally:
+                in_flight.release(len(surge))
+    finally:
+        stopped.set()
+        provisioner.join()
+        # hand back the in-flight slots of anything we provisioned but never got to drain
+        while not provisioned.empty():
+            wave = provisioned.get_nowait()
+            if not isinstance(wave, Exception):
+                in_flight.release(len(wave[0]))
+
+
+def put_drain_lifecycle_hook(asg_client, asg_name, heartbeat_timeout, dry_run=True):
+    """Hold terminating instances in Terminating:Wait until we have drained them"""
+
+    logging.info(f"Adding lifecycle hook {DRAIN_LIFECYCLE_HOOK} to {asg_name}...")
+    if not dry_run:
+        asg_client.put_lifecycle_hook(
+            LifecycleHookName=DRAIN_LIFECYCLE_HOOK,
+            AutoScalingGroupName=asg_name,
+            LifecycleTransition="autoscaling:EC2_INSTANCE_TERMINATING",
+            HeartbeatTimeout=heartbeat_timeout,
+            DefaultResult="CONTINUE"
+        )
+
+
+def delete_drain_lifecycle_hook(asg_client, asg_name, dry_run=True):
+    logging.info(f"Removing lifecycle hook {DRAIN_LIFECYCLE_HOOK} from {asg_name}...")
+    if not dry_run:
+        asg_client.delete_lifecycle_hook(LifecycleHookName=DRAIN_LIFECYCLE_HOOK, AutoScalingGroupName=asg_name)
+
+
+def start_instance_refresh(asg_client, asg_name, min_healthy_percentage, instance_warmup=None, dry_run=True):
+    """Start an instance refresh replacing only the outdated instances, or adopt the one already in progress"""
+
+    refreshes = asg_client.describe_instance_refreshes(AutoScalingGroupName=asg_name)["InstanceRefreshes"]
+    in_progress = [refresh for refresh in refreshes if refresh["Status"] in ["Pending", "InProgress"]]
+    if len(in_progress) > 0:
+        logging.info(f"Following instance refresh {in_progress[0]['InstanceRefreshId']} already in progress on {asg_name}.")
+        return in_progress[0]["InstanceRefreshId"]
+
+    preferences = {"MinHealthyPercentage": min_healthy_percentage, "SkipMatching": True}
+    if instance_warmup is not None:
+        preferences["InstanceWarmup"] = instance_warmup
+    logging.info(f"Starting an instance refresh on {asg_name} with {preferences}...")
     if dry_run:
-        logging.info("--dry-run is enabled, only running read-only API calls")
+        logging.info(f"Dry-run enabled, not actually starting an instance refresh on {asg_name}.")
+        return None
+    response = asg_client.start_instance_refresh(AutoScalingGroupName=asg_name, Strategy="Rolling", Preferences=preferences)
+    return response["InstanceRefreshId"]
+
+
+def cancel_instance_refresh(asg_client, asg_name, refresh_id, timeout, poll_interval=15, dry_run=True):
+    """Cancel an instance refresh we are giving up on, and wait until it stops replacing instances"""
+
+    logging.info(f"Cancelling instance refresh {refresh_id} on {asg_name}...")
+    if dry_run:
+        return
+    try:
+        asg_client.cancel_instance_refresh(AutoScalingGroupName=asg_name)
+    except asg_client.exceptions.ActiveInstanceRefreshNotFoundFault:
+        pass  # already cancelling, or it ended since we last looked
+
+    def refresh_ended():
+        refresh = asg_client.describe_instance_refreshes(AutoScalingGroupName=asg_name, InstanceRefreshIds=[refresh_id])["InstanceRefreshes"][0]
+        return refresh["Status"] in INSTANCE_REFRESH_ENDED_STATUSES
+
+    poll(refresh_ended, timeout=timeout, description=f"instance refresh {refresh_id} on {asg_name} to be cancelled", interval=poll_interval, max_interval=poll_interval)
+
+
+def drain_for_lifecycle_hook(asg_client, drainer, asg_name, instance, metrics=None, dry_run=True):
+    """Drain a node held in Terminating:Wait, then let the ASG go ahead and terminate it"""
+
+    log_context.asg_name = asg_name
+    metrics = metrics or RolloutMetrics()
+    metrics.mark(asg_name, instance, "drain_started")
+    try:
+        evicted = drainer.drain(instance["PrivateDnsName"], dry_run)
+        metrics.mark(asg_name, instance, "drain_finished", pods_evicted=None if evicted is None else len(evicted))
+    except Exception as e:
+        # the instance refresh terminates it regardless once the heartbeat times out
+        logging.error(f"Failed to drain {instance['PrivateDnsName']}, letting it terminate anyway: {e}")
+    if dry_run:
+        logging.info(f"Dry-run enabled, not letting {asg_name} terminate {instance['InstanceId']}.")
+        return
+    asg_client.complete_lifecycle_action(
+        LifecycleHookName=DRAIN_LIFECYCLE_HOOK,
+        AutoScalingGroupName=asg_name,
+        LifecycleActionResult="CONTINUE",
+        InstanceId=instance["InstanceId"]
+    )
+    metrics.mark(asg_name, instance, "terminated")
+
+
+def refresh_asg(asg_client, ec2_client, drainer, asg_name, min_healthy_percentage, instance_warmup=None, poll_interval=15, metrics=None, dry_run=True):
+    """Replace outdated instances with an ASG instance refresh, draining each one from a termination lifecycle hook.
+
+    Progress is tracked with one DescribeInstanceRefreshes and one (cached) DescribeAutoScalingGroups call
+    per poll, the latter to find instances waiting on the lifecycle hook.
+    """
+
+    heartbeat_timeout = drainer.timeout + 60
+    put_drain_lifecycle_hook(asg_client, asg_name, heartbeat_timeout=heartbeat_timeout, dry_run=dry_run)
+    refresh_id = None
+    ended = False
+    try:
+        refresh_id = start_instance_refresh(asg_client, asg_name, min_healthy_percentage, instance_warmup, dry_run=dry_run)
+        if refresh_id is None:
+            return
+        if dry_run:
+            # an instance refresh adopted from an earlier run, its instances are only drained for real
+            refresh = asg_client.describe_instance_refreshes(AutoScalingGroupName=asg_name, InstanceRefreshIds=[refresh_id])["InstanceRefreshes"][0]
+            logging.info(f"Dry-run enabled, not following instance refresh {refresh_id} on {asg_name}: {refresh['Status']}, {refresh.get('PercentageComplete', 0)}% complete.")
+            return
+
+        drained = set()
+        progress = None
+        # the instance refresh replaces this many instances at a time, so they may all be waiting to be drained
+        batch_size = max(1, math.ceil(get_desired_capacity(asg_client, asg_name) * (100 - min_healthy_percentage) / 100))
+        with ThreadPoolExecutor(max_workers=batch_size, thread_name_prefix=f"refresh-{asg_name}") as executor:
+            futures = []
+            while True:
+                refresh = asg_client.describe_instance_refreshes(AutoScalingGroupName=asg_name, InstanceRefreshIds=[refresh_id])["InstanceRefreshes"][0]
+                ended = refresh["Status"] in INSTANCE_REFRESH_ENDED_STATUSES
+                if refresh["Status"] == "Successful":
+                    break
+                if refresh["Status"] in INSTANCE_REFRESH_FAILED_STATUSES:
+                    raise Exception(f"Instance refresh {refresh_id} on {asg_name} ended with status {refresh['Status']}: {refresh.get('StatusReason')}")
+                if (refresh.get("PercentageComplete"), refresh.get("InstancesToUpdate")) != progress:
+                    progress = (refresh.get("PercentageComplete"), refresh.get("InstancesToUpdate"))
+                    logging.info(f"Instance refresh {refresh_id} is {refresh.get('PercentageComplete', 0)}% complete, {refresh.get('InstancesToUpdate', 'unknown')} instance(s) left to update.")
+
+                response = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
+                waiting = [instance["InstanceId"] for instance in response["AutoScalingGroups"][0]["Instances"] if instance["LifecycleState"] == "Terminating:Wait" and instance["InstanceId"] not in drained]
+                if len(waiting) > 0:
+                    for instance in describe_instances(ec2_client, waiting):
+                        drained.add(instance["InstanceId"])
+                        futures.append(executor.submit(drain_for_lifecycle_hook, asg_client=asg_client, drainer=drainer, asg_name=asg_name, instance=instance, metrics=metrics, dry_run=dry_run))
+                for future in [future for future in futures if future.done()]:
+                    futures.remove(future)
+                    future.result()  # completing the lifecycle action failed
+                time.sleep(poll_interval * random.uniform(0.5, 1.5))
+        logging.info(f"Instance refresh {refresh_id} on {asg_name} completed.")
+    finally:
+        try:
+            if refresh_id is not None and not ended and not dry_run:
+                # without the hook, instances it still replaces would be terminated undrained
+                cancel_instance_refresh(asg_client, asg_name, refresh_id, timeout=heartbeat_timeout + 900, poll_interval=poll_interval, dry_run=dry_run)
+        finally:
+            delete_drain_lifecycle_hook(asg_client, asg_name, dry_run=dry_run)
+
+
+def replace_outdated_instances(asg_client, ec2_client, tracker, drainer, asg_name, instances, max_surge, max_unavailable, in_flight, pipeline_depth=0, cordon_outdated=False, planner=None, gate=None, state=None, metrics=None, dry_run=True):
+    """Replace outdated instances client-side, in waves of surge and unavailable instances"""
 
-    asg_client = boto3.client("autoscaling")
-    ec2_client = boto3.client("ec2")
+    desired_capacity, max_size = get_capacity(asg_client, asg_name)
+    total = len(instances)
+    if "%" in max_surge + max_unavailable:
+        total = desired_capacity
+    surge_count = resolve_rollout_count(max_surge, total, round_up=True)
+    unavailable_count = resolve_rollout_count(max_unavailable, total, round_up=False)
+    if surge_count + unavailable_count < 1 and "%" in max_surge + max_unavailable:
+        surge_count = 1  # percentages can round down to 0, always make progress
+    # SetDesiredCapacity fails above MaxSize, and pipelining keeps the surge of pipeline_depth more waves up
+    headroom = max(max_size - desired_capacity, 0) // (pipeline_depth + 1)
+    if surge_count > headroom:
+        logging.warning(f"Limiting max surge for {asg_name} to {headroom}, it has a DesiredCapacity of {desired_capacity} and a MaxSize of {max_size}.")
+        surge_count = headroom
+        if surge_count + unavailable_count < 1:
+            raise Exception(f"{asg_name} has no room to surge below its MaxSize of {max_size}, raise its MaxSize or pass --max-unavailable.")
+    if in_flight.limit is not None:
+        surge_count = min(surge_count, in_flight.limit)
+        unavailable_count = min(unavailable_count, in_flight.limit - surge_count)
+    if planner is not None:
+        instances = planner.plan(asg_name, instances)
+    # replacements launched by an interrupted run are adopted as the first waves
+    adopted = state.adoptable_waves(asg_name, instances) if state is not None else []
+    adopted_ids = [instance["InstanceId"] for wave in adopted for instance in wave]
+    # interleaved across zones so each wave is balanced, the scheduler then matches the zones of the replacements
+    waves = [(wave, []) for wave in adopted] + plan_waves(order_by_az([instance for instance in instances if instance["InstanceId"] not in adopted_ids]), surge_count, unavailable_count)
+    scheduler = AzScheduler(waves)
+    logging.info(f"Replacing {len(instances)} instances in {len(waves)} wave(s) (max surge {surge_count}, max unavailable {unavailable_count})")
+    if planner is not None:
+        # the scheduler logs any instances it later swaps between waves
+        planner.log_plan(asg_name, waves)
+    # cordoned as soon as the first wave's replacements are Ready
+    cordon_first = [instance["PrivateDnsName"] for instance in instances] if cordon_outdated else []
+    if len(cordon_first) > 0 and len(waves[0][0]) == 0:
+        # e.g. a surge percentage that rounds down to 0, there would be no replacement capacity for the evicted pods
+        logging.warning("Not cordoning outdated nodes up front, the first wave has no surge replacements.")
+        cordon_first = []
+
+    if pipeline_depth > 0:
+        replace_waves_pipelined(asg_client=asg_client, ec2_client=ec2_client, tracker=tracker, drainer=drainer, asg_name=asg_name, waves=waves, depth=pipeline_depth, in_flight=in_flight, cordon_first=cordon_first, scheduler=scheduler, gate=gate, state=state, metrics=metrics, dry_run=dry_run)
+    else:
+        for i, (surge, unavailable) in enumerate(waves):
+            with in_flight.hold(len(surge) + len(unavailable)):
+                replace_wave(asg_client=asg_client, ec2_client=ec2_client, tracker=tracker, drainer=drainer, asg_name=asg_name, surge=surge, unavailable=unavailable, cordon_first=cordon_first if i == 0 else (), scheduler=scheduler, gate=gate, state=state, metrics=metrics, dry_run=dry_run)
 
-    asg_names = get_matching_asgs(asg_client=asg_client, cluster_name=cluster_name)
 
-    if len(asg_names) == 0:
-        raise Exception(f"No ASGs for cluster {cluster_name} were found.")
+def rollout_asg(asg_client, ec2_client, tracker, drainer, asg_name, max_surge, max_unavailable, in_flight, pipeline_depth=0, cordon_outdated=False, engine="client", min_healthy_percentage=90, instance_warmup=None, suspend_az_rebalance=False, planner=None, gate=None, resolver=None, state=None, metrics=None, dry_run=True):
+    """Perform a rolling update on a single ASG, suspending cluster-autoscaler (and optionally AZRebalance) on it for the duration"""
+
+    log_context.asg_name = asg_name
+    try:
+        if state is not None and state.asg(asg_name)["done"]:
+            logging.info(f"{asg_name} was completed by an interrupted run, skipping it.")
+            return
 
-    for asg_name in asg_names:
         logging.info(f"Beginning rolling updates on ASG {asg_name}...")
-        instances = describe_nodes_not_matching_lt(asg_client=asg_client, ec2_client=ec2_client, asg_name=asg_name)
+        instances = describe_nodes_not_matching_lt(asg_client=asg_client, ec2_client=ec2_client, asg_name=asg_name, resolver=resolver)
+        if state is not None:
+            # instances we terminated can still be shutting down
+            instances = [instance for instance in instances if not state.is_terminated(asg_name, instance)]
+        # an interrupted run may have removed the tag itself, it is restored once this run is done
+        autoscaler_suspended = state is not None and state.asg(asg_name)["autoscaler_suspended"]
+        az_rebalance_suspended = state is not None and state.asg(asg_name).get("az_rebalance_suspended", False)
 
         if len(instances) == 0:
+            if autoscaler_suspended:
+                enable_autoscaling(asg_client=asg_client, asg_name=asg_name, dry_run=dry_run)
+            if az_rebalance_suspended:
+                resume_az_rebalancing(asg_client=asg_client, asg_name=asg_name, dry_run=dry_run)
+            if state is not None:
+                state.update(asg_name, autoscaler_suspended=False, az_rebalance_suspended=False, done=True)
             logging.info(f"All instances in {asg_name} are already up to date.")
-            continue
+            return
 
-        is_cluster_autoscaler_tag_present = check_is_cluster_autoscaler_tag_present(asg_client=asg_client, asg_name=asg_name)
+        is_cluster_autoscaler_tag_present = autoscaler_suspended or check_is_cluster_autoscaler_tag_present(asg_client=asg_client, asg_name=asg_name)
 
         if is_cluster_autoscaler_tag_present:
+            if state is not None:
+                # recorded first, so the tag is restored even if we are killed right after removing it
+                state.update(asg_name, autoscaler_suspended=True)
             # Prevent cluster-autoscaler from interrupting our rollout
             disable_autoscaling(asg_client=asg_client, asg_name=asg_name, dry_run=dry_run)
 
+        # left alone if someone else suspended it, as we would otherwise resume it afterwards
+        if suspend_az_rebalance and not az_rebalance_suspended and not is_az_rebalance_suspended(asg_client, asg_name):
+            if state is not None:
+                state.update(asg_name, az_rebalance_suspended=True)
+            suspend_az_rebalancing(asg_client=asg_client, asg_name=asg_name, dry_run=dry_run)
+            az_rebalance_suspended = True
+
         try:
-            for instance in instances:
-                before_instance_count = 0
-                after_instance_count = 0
-
-                before_instance_count = get_num_of_instances(asg_client=asg_client, ec2_client=ec2_client, asg_name=asg_name)
-                add_time = datetime.datetime.now(datetime.timezone.utc)
-                add_node(asg_client=asg_client, asg_name=asg_name, dry_run=dry_run)
-                logging.info(f'Waiting for instance to be created...')
-                logging.info(f'Sleeping 25s before polling for instance creation.')
-                time.sleep(25)  # new instance takes a bit to show up in API, don't bother polling yet
-                latest_instance = get_latest_instance(asg_client=asg_client, ec2_client=ec2_client, asg_name=asg_name, add_time=add_time, dry_run=dry_run)
-                latest_node_name = latest_instance["PrivateDnsName"]
-                logging.info(f'Waiting for node {latest_node_name} to be "Ready"...')
-                logging.info(f'Sleeping 40s before polling for node to be "Ready".')
-                time.sleep(40)  # instance will never be ready before this, don't bother polling yet
-                wait_for_ready_node(latest_node_name)
-                logging.info(f'Node {latest_node_name} is now "Ready".')
-                after_instance_count = get_num_of_instances(asg_client=asg_client, ec2_client=ec2_client, asg_name=asg_name)
-
-                # because get_latest_instance() doesn't necessarily return the instance launched by add_node(), this is just a safety precaution to ensure we've actually launched a node
-                logging.info(f"Had {before_instance_count} instances in {asg_name} before, now have {after_instance_count} instances")
-                if not dry_run:
-                    assert after_instance_count > before_instance_count
-
-                node_name = instance["PrivateDnsName"]
-                logging.info(f'Draining node {node_name} (--dry-run={dry_run})')
-                output = kubectl.drain(node_name, "--force", "--delete-local-data=true", "--ignore-daemonsets=true", "--timeout=120s", f"--dry-run={dry_run}")
-                print(output.stdout.decode().rstrip())
-
-                terminate_node(asg_client, instance["InstanceId"], dry_run)
+            if engine == "instance-refresh":
+                refresh_asg(asg_client=asg_client, ec2_client=ec2_client, drainer=drainer, asg_name=asg_name, min_healthy_percentage=min_healthy_percentage, instance_warmup=instance_warmup, metrics=metrics, dry_run=dry_run)
+            else:
+                replace_outdated_instances(asg_client=asg_client, ec2_client=ec2_client, tracker=tracker, drainer=drainer, asg_name=asg_name, instances=instances, max_surge=max_surge, max_unavailable=max_unavailable, in_flight=in_flight, pipeline_depth=pipeline_depth, cordon_outdated=cordon_outdated, planner=planner, gate=gate, state=state, metrics=metrics, dry_run=dry_run)
         except Exception:
             logging.critical(f"Failed to upgrade all nodes in {asg_name}.")
+            if cordon_outdated and not dry_run:
+                # don't leave the cluster short of capacity, the remaining outdated nodes get replaced on the next run
+                drainer.uncordon([instance["PrivateDnsName"] for instance in instances])
             raise
         finally:
             # always re-enable cluster-autoscaler even if we fail partway through
             if is_cluster_autoscaler_tag_present:
                 enable_autoscaling(asg_client=asg_client, asg_name=asg_name, dry_run=dry_run)
+                if state is not None:
+                    state.update(asg_name, autoscaler_suspended=False)
+            if az_rebalance_suspended:
+                resume_az_rebalancing(asg_client=asg_client, asg_name=asg_name, dry_run=dry_run)
+                if state is not None:
+                    state.update(asg_name, az_rebalance_suspended=False)
 
+        if state is not None:
+            state.update(asg_name, done=True)
         logging.info(f"All instances in {asg_name} are up to date.")
+    finally:
+        log_context.asg_name = None
+
+
+def rollout_cluster(cluster_name, asg_client, ec2_client, core_v1, max_surge, max_unavailable, context=None, engine="client", min_healthy_percentage=90, instance_warmup=None, asg_concurrency=1, max_in_flight=None, pipeline_depth=0, drain_method="eviction", drain_timeout=120, eviction_workers=10, drain_order="listed", wait_for_daemonsets=False, prepull_images=False, prepull_image_list=(), readiness_timeout=300, cordon_outdated=False, suspend_az_rebalance=False, state_file=None, metrics=None, dry_run=True):
+    """Roll the outdated nodes in every ASG of one cluster, `context` is the kubeconfig context `core_v1` was built from"""
+
+    metrics = metrics or RolloutMetrics(cluster_name)
+    tracker = NodeReadinessTracker(core_v1).start()
+    if drain_method == "eviction":
+        drainer = NodeDrainer(core_v1, workers=eviction_workers, timeout=drain_timeout)
+    else:
+        drainer = KubectlDrainer(core_v1, timeout=drain_timeout, context=context)
+    in_flight = InFlightLimiter(max_in_flight)
+    gate = None
+    if wait_for_daemonsets or prepull_images:
+        gate = ReadinessGate(core_v1, prepull=prepull_images, images=prepull_image_list, timeout=readiness_timeout)
+    state = None
+    if state_file is not None:
+        if dry_run:
+            logging.info(f"--dry-run is set, not checkpointing to {state_file}")
+        else:
+            state = RolloutState.load(state_file, cluster_name)
+
+    resolver = LaunchTemplateResolver(ec2_client)
+
+    errors = {}
+    try:
+        if state is not None and state.resumed:
+            asg_names = state.data["asg_names"]
+            logging.info(f"Rolling the ASGs recorded by the interrupted run: {asg_names}")
+        else:
+            asgs = get_matching_asgs(asg_client=asg_client, cluster_name=cluster_name)
+            # one DescribeLaunchTemplates call for all ASGs, however many share a template
+            resolver.prefetch(asgs)
+            asg_names = [asg["AutoScalingGroupName"] for asg in asgs]
+
+            if len(asg_names) == 0:
+                raise Exception(f"No ASGs for cluster {cluster_name} were found.")
+            if state is not None:
+                state.set_asg_names(asg_names)
+
+        planner = None
+        if drain_order != "listed":
+            # one snapshot for the whole run, the estimates only have to rank nodes against each other
+            planner = DrainPlanner(WorkloadSnapshot.take(core_v1, get_policy_v1_api(core_v1)), order=drain_order, workers=eviction_workers, timeout=drain_timeout)
+
+        aborted = threading.Event()
 
+        def roll(asg_name):
+            # don't start rolling any more ASGs once one failed, but let the ones in progress finish
+            if aborted.is_set():
+                logging.info(f"Not rolling {asg_name}, as another ASG failed.")
+                return
+            try:
+                rollout_asg(asg_client=asg_client, ec2_client=ec2_client, tracker=tracker, drainer=drainer, asg_name=asg_name, max_surge=max_surge, max_unavailable=max_unavailable, in_flight=in_flight, pipeline_depth=pipeline_depth, cordon_outdated=cordon_outdated, engine=engine, min_healthy_percentage=min_healthy_percentage, instance_warmup=instance_warmup, suspend_az_rebalance=suspend_az_rebalance, planner=planner, gate=gate, resolver=resolver, state=state, metrics=metrics, dry_run=dry_run)
+            except BaseException:
+                aborted.set()
+                raise
+
+        with ThreadPoolExecutor(max_workers=asg_concurrency, thread_name_prefix="rollout") as executor:
+            futures = {executor.submit(roll, asg_name): asg_name for asg_name in asg_names}
+            for future, asg_name in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[asg_name] = e
+    finally:
+        tracker.stop()
+        metrics.finished = datetime.datetime.now(datetime.timezone.utc)
+
+    if len(errors) > 0:
+        logging.critical(f"Failed to roll out ASGs {list(errors)} in EKS cluster {cluster_name}.")
+        raise next(iter(errors.values()))
+    if state is not None:
+        state.remove()
     logging.info(f"All instances in EKS cluster {cluster_name} are up to date.")
 
+
+def load_fleet_manifest(path):
+    """Read the clusters to roll from a YAML (or JSON) manifest like:
+
+        clusters:
+          - name: prod-apse2
+            region: ap-southeast-2
+            context: prod-apse2  # kubeconfig context, the current one if omitted
+    """
+
+    with open(path) as f:
+        manifest = yaml.safe_load(f)
+    clusters = manifest.get("clusters") if isinstance(manifest, dict) else None
+    if not isinstance(clusters, list) or len(clusters) == 0:
+        raise click.UsageError(f"{path} doesn't list any clusters under `clusters`")
+    for i, cluster in enumerate(clusters):
+        if not isinstance(cluster, dict) or not cluster.get("name") or not cluster.get("region"):
+            raise click.UsageError(f"Cluster {i + 1} in {path} needs a name and a region")
+        unknown = set(cluster) - {"name", "region", "context"}
+        if len(unknown) > 0:
+            raise click.UsageError(f"Unknown key(s) {sorted(unknown)} for cluster {cluster['name']} in {path}")
+    names = [cluster["name"] for cluster in clusters]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if len(duplicates) > 0:
+        raise click.UsageError(f"Clusters {duplicates} are listed more than once in {path}")
+    return [{"name": cluster["name"], "region": cluster["region"], "context": cluster.get("context")} for cluster in clusters]
+
+
+class AwsClientPool:
+    """One boto3 session per region, and one rate limited, cached client per service shared by every cluster rolled there.
+
+    Credentials are resolved and service models loaded once per region rather than once per cluster. AWS
+    throttles per account and region, so the clusters of a region share one AwsRateLimiter, and their API
+    calls are counted per region.
+    """
+
+    def __init__(self, max_rate=10, cache_ttl=10, config=None):
+        self.max_rate = max_rate
+        self.cache_ttl = cache_ttl
+        self.config = config
+        self._lock = threading.Lock()
+        self._regions = {}
+        self._clients = {}
+
+    def client(self, service_name, region_name):
+        # sessions aren't thread safe, the clients built from them are
+        with self._lock:
+            if region_name not in self._regions:
+                self._regions[region_name] = {
+                    "session": boto3.session.Session(region_name=region_name),
+                    "cache": DescribeCache(ttl=self.cache_ttl),
+                    "rate_limiter": AwsRateLimiter(max_rate=self.max_rate),
+                    "metrics": RolloutMetrics(),  # only counts API calls, timelines are recorded per cluster
+                }
+            if (service_name, region_name) not in self._clients:
+                region = self._regions[region_name]
+                client = region["session"].client(service_name, config=self.config)
+                self._clients[(service_name, region_name)] = CachedClient(region["metrics"].instrument(region["rate_limiter"].instrument(client)), region["cache"])
+            return self._clients[(service_name, region_name)]
+
+    def usage(self):
+        """AWS API calls and throttles, and the rate limiter's state, per region"""
+
+        with self._lock:
+            regions = dict(self._regions)
+        return {
+            region_name: {"api_calls": dict(region["metrics"].api_calls), "throttles": dict(region["metrics"].throttles), "rate_limiter": region["rate_limiter"].stats(), "cache": region["cache"].stats()}
+            for region_name, region in regions.items()
+        }
+
+
+def schedule_clusters(clusters, roll, concurrency, region_concurrency):
+    """Call `roll` on every cluster, with at most `concurrency` running at once overall and `region_concurrency` per region.
+
+    A cluster is only started once its region has a free slot, so a busy region never holds up the others. A
+    failed cluster doesn't stop the rest, the exception of each failed cluster is returned keyed by its name.
+    """
+
+    pending = list(clusters)
+    running = collections.Counter()
+    errors = {}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fleet") as executor:
+        futures = {}
+        while len(pending) + len(futures) > 0:
+            for cluster in list(pending):
+                if len(futures) < concurrency and running[cluster["region"]] < region_concurrency:
+                    pending.remove(cluster)
+                    running[cluster["region"]] += 1
+                    futures[executor.submit(roll, cluster)] = cluster
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                cluster = futures.pop(future)
+                running[cluster["region"]] -= 1
+                if future.exception() is not None:
+                    errors[cluster["name"]] = future.exception()
+    return errors
+
+
+def fleet_report(clusters, metrics, errors, usage, started):
+    """Consolidate the reports of every cluster in the fleet, AWS API calls are reported per region"""
+
+    finished = datetime.datetime.now(datetime.timezone.utc)
+    entries = []
+    for cluster in clusters:
+        entry = {"cluster": cluster["name"], "region": cluster["region"], "context": cluster["context"], "status": "not started", "error": None}
+        if cluster["name"] in metrics:
+            report = metrics[cluster["name"]].report()
+            # the clients are shared by every cluster in a region
+            del report["api_calls"], report["throttles"]
+            entry.update(report, status="succeeded")
+        if cluster["name"] in errors:
+            entry.update(status="failed", error=str(errors[cluster["name"]]))
+        entries.append(entry)
+    return {
+        "started": started.isoformat(),
+        "finished": finished.isoformat(),
+        "duration_seconds": (finished - started).total_seconds(),
+        "clusters_succeeded": len([entry for entry in entries if entry["status"] == "succeeded"]),
+        "clusters_failed": len([entry for entry in entries if entry["status"] == "failed"]),
+        "nodes_replaced": sum(entry.get("nodes_replaced", 0) for entry in entries),
+        "regions": usage,
+        "clusters": entries
+    }
+
+
+def rollout_fleet(clusters, pool, concurrency, region_concurrency, options, state_file=None, report_json=None, prometheus_textfile=None, dry_run=True):
+    """Roll every cluster in a fleet manifest with rollout_cluster(), writing one report for all of them.
+
+    `options` are passed on to rollout_cluster(), and `state_file` is formatted with each cluster's `name`.
+    """
+
+    started = datetime.datetime.now(datetime.timezone.utc)
+    metrics = {}
+    errors = {}
+
+    def roll(cluster):
+        logging.info(f"Rolling out EKS cluster {cluster['name']} in {cluster['region']}...")
+        metrics[cluster["name"]] = RolloutMetrics(cluster["name"])
+        rollout_cluster(
+            cluster["name"],
+            asg_client=pool.client("autoscaling", cluster["region"]),
+            ec2_client=pool.client("ec2", cluster["region"]),
+            core_v1=get_core_v1_api(cluster["context"]),
+            context=cluster["context"],
+            state_file=state_file.format(name=cluster["name"]) if state_file is not None else None,
+            metrics=metrics[cluster["name"]],
+            dry_run=dry_run,
+            **options
+        )
+
+    try:
+        errors = schedule_clusters(clusters, roll, concurrency=concurrency, region_concurrency=region_concurrency)
+    finally:
+        report = fleet_report(clusters, metrics, errors, pool.usage(), started)
+        for region_name, usage in report["regions"].items():
+            logging.debug(f"AWS API calls in {region_name}: {usage['api_calls']}, throttled: {usage['throttles']}, rate limiter: {usage['rate_limiter']}, describe cache: {usage['cache']}")
+        if report_json is not None:
+            with open(report_json, "w") as f:
+                json.dump(report, f, indent=2)
+        if prometheus_textfile is not None:
+            write_prometheus_textfile(prometheus_textfile, [entry for entry in report["clusters"] if entry["status"] != "not started"], [({"region": region_name}, usage["api_calls"], usage["throttles"]) for region_name, usage in report["regions"].items()])
+
+    logging.info(f"Rolled out {report['clusters_succeeded']} of {len(clusters)} EKS clusters, replacing {report['nodes_replaced']} nodes in {report['duration_seconds']:.0f}s.")
+    if len(errors) > 0:
+        logging.critical(f"Failed to roll out EKS clusters {list(errors)}.")
+        raise next(iter(errors.values()))
+
+
+@click.command()
+@click.option('--cluster-name', envvar='EKS_NODE_ROLLOUT_CLUSTER_NAME', default=None, help="Cluster name to discover ASGs from")
+@click.option('--fleet-manifest', envvar='EKS_NODE_ROLLOUT_FLEET_MANIFEST', default=None, type=click.Path(exists=True, dir_okay=False), help="Roll every cluster listed in this YAML manifest instead of --cluster-name")
+@click.option('--cluster-concurrency', envvar='EKS_NODE_ROLLOUT_CLUSTER_CONCURRENCY', default=4, type=click.IntRange(min=1), help="Number of clusters in the --fleet-manifest to roll in parallel")
+@click.option('--region-concurrency', envvar='EKS_NODE_ROLLOUT_REGION_CONCURRENCY', default=2, type=click.IntRange(min=1), help="Number of clusters in the same region to roll in parallel")
+@click.option('--dry-run/--no-dry-run', envvar='EKS_NODE_ROLLOUT_DRY_RUN', default=False, help="Run with read-only API calls")
+@click.option('--debug/--no-debug', envvar='EKS_NODE_ROLLOUT_DEBUG', default=False, help="Enable debug logging")
+@click.option('--engine', envvar='EKS_NODE_ROLLOUT_ENGINE', default="client", type=click.Choice(["client", "instance-refresh"]), help="Replace nodes client-side in waves, or with an ASG instance refresh that drains nodes from a lifecycle hook")
+@click.option('--min-healthy-percentage', envvar='EKS_NODE_ROLLOUT_MIN_HEALTHY_PERCENTAGE', default=90, type=click.IntRange(min=0, max=100), help="Percentage of the ASG that must stay healthy during an instance refresh")
+@click.option('--instance-warmup', envvar='EKS_NODE_ROLLOUT_INSTANCE_WARMUP', default=None, type=click.IntRange(min=0), help="Seconds an instance refresh waits after a new instance is healthy  [default: the ASG's health check grace period]")
+@click.option('--max-surge', envvar='EKS_NODE_ROLLOUT_MAX_SURGE', default="1", callback=validate_rollout_count, help="Number or percentage of extra nodes launched per wave")
+@click.option('--max-unavailable', envvar='EKS_NODE_ROLLOUT_MAX_UNAVAILABLE', default="0", callback=validate_rollout_count, help="Number or percentage of outdated nodes drained per wave before their replacement is ready")
+@click.option('--aws-max-rate', envvar='EKS_NODE_ROLLOUT_AWS_MAX_RATE', default=10, type=click.FloatRange(min=0.5), help="Maximum AWS API calls per second across all ASGs, lowered automatically when throttled")
+@click.option('--cache-ttl', envvar='EKS_NODE_ROLLOUT_CACHE_TTL', default=10, type=int, help="Seconds to reuse ASG and EC2 instance descriptions for")
+@click.option('--asg-concurrency', envvar='EKS_NODE_ROLLOUT_ASG_CONCURRENCY', default=1, type=click.IntRange(min=1), help="Number of ASGs to roll in parallel")
+@click.option('--max-in-flight', envvar='EKS_NODE_ROLLOUT_MAX_IN_FLIGHT', default=None, type=click.IntRange(min=1), help="Maximum number of node replacements in flight across all ASGs  [default: unlimited]")
+@click.option('--pipeline-depth', envvar='EKS_NODE_ROLLOUT_PIPELINE_DEPTH', default=0, type=click.IntRange(min=0), help="Number of waves to provision ahead of the wave being drained, 0 disables pipelining")
+@click.option('--drain-method', envvar='EKS_NODE_ROLLOUT_DRAIN_METHOD', default="eviction", type=click.Choice(["eviction", "kubectl"]), help="Evict pods in-process through the Eviction API, or shell out to `kubectl drain`")
+@click.option('--drain-timeout', envvar='EKS_NODE_ROLLOUT_DRAIN_TIMEOUT', default=120, type=click.IntRange(min=1), help="Seconds to wait for a node to drain")
+@click.option('--eviction-workers', envvar='EKS_NODE_ROLLOUT_EVICTION_WORKERS', default=10, type=click.IntRange(min=1), help="Number of pods to evict concurrently per node")
+@click.option('--drain-order', envvar='EKS_NODE_ROLLOUT_DRAIN_ORDER', default="listed", type=click.Choice(["listed", "cheapest", "interleave"]), help="Drain outdated nodes in the order EC2 lists them, cheapest first by pod count and PodDisruptionBudget headroom, or cheapest first without draining nodes held back by the same PodDisruptionBudget back to back")
+@click.option('--wait-for-daemonsets/--no-wait-for-daemonsets', envvar='EKS_NODE_ROLLOUT_WAIT_FOR_DAEMONSETS', default=False, help="Before draining an outdated node, wait for its replacement to run a Ready pod of every DaemonSet the outdated node runs")
+@click.option('--prepull-images/--no-prepull-images', envvar='EKS_NODE_ROLLOUT_PREPULL_IMAGES', default=False, help="Before draining an outdated node, pull the images of its pods onto its replacement. Implies --wait-for-daemonsets")
+@click.option('--prepull-image', 'prepull_image_list', envvar='EKS_NODE_ROLLOUT_PREPULL_IMAGE', multiple=True, help="Additional image to pre-pull onto every replacement, can be repeated")
+@click.option('--readiness-timeout', envvar='EKS_NODE_ROLLOUT_READINESS_TIMEOUT', default=300, type=click.IntRange(min=1), help="Seconds to wait for a wave's replacements to pass --wait-for-daemonsets and --prepull-images")
+@click.option('--cordon-outdated/--no-cordon-outdated', envvar='EKS_NODE_ROLLOUT_CORDON_OUTDATED', default=False, help="Cordon all outdated nodes in an ASG once its first replacements are Ready, so pods are only evicted once")
+@click.option('--suspend-az-rebalance/--no-suspend-az-rebalance', envvar='EKS_NODE_ROLLOUT_SUSPEND_AZ_REBALANCE', default=False, help="Suspend the ASG's AZRebalance process during the rollout, so it doesn't terminate nodes to even out zones")
+@click.option('--state-file', envvar='EKS_NODE_ROLLOUT_STATE_FILE', default=None, type=click.Path(dir_okay=False), help="Checkpoint progress to this file, and resume the rollout recorded in it if it exists")
+@click.option('--report-json', envvar='EKS_NODE_ROLLOUT_REPORT_JSON', default=None, type=click.Path(dir_okay=False), help="Write a JSON report with the timeline of every replaced node to this file")
+@click.option('--prometheus-textfile', envvar='EKS_NODE_ROLLOUT_PROMETHEUS_TEXTFILE', default=None, type=click.Path(dir_okay=False), help="Write rollout metrics to this file for the Prometheus textfile collector")
+def rollout_nodes(cluster_name, fleet_manifest, cluster_concurrency, region_concurrency, dry_run, debug, engine, min_healthy_percentage, instance_warmup, max_surge, max_unavailable, aws_max_rate, cache_ttl, asg_concurrency, max_in_flight, pipeline_depth, drain_method, drain_timeout, eviction_workers, drain_order, wait_for_daemonsets, prepull_images, prepull_image_list, readiness_timeout, cordon_outdated, suspend_az_rebalance, state_file, report_json, prometheus_textfile):
+    """Retrieve all outdated workers and perform a rolling update on them."""
+
+    if debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    if dry_run:
+        logging.info("--dry-run is enabled, only running read-only API calls")
+
+    if (cluster_name is None) == (fleet_manifest is None):
+        raise click.UsageError("Either --cluster-name or --fleet-manifest is required")
+
+    if fleet_manifest is not None and state_file is not None and "{name}" not in state_file:
+        raise click.UsageError("--state-file needs a {name} placeholder with --fleet-manifest, each cluster is checkpointed to its own file")
+
+    # at 100 nodes, only 0 and 0% resolve to 0
+    if resolve_rollout_count(max_surge, 100, round_up=True) == 0 and resolve_rollout_count(max_unavailable, 100, round_up=False) == 0:
+        raise click.UsageError("--max-surge and --max-unavailable cannot both be 0")
+
+    if pipeline_depth > 0 and resolve_rollout_count(max_unavailable, 100, round_up=False) > 0:
+        raise click.UsageError("--pipeline-depth cannot be combined with --max-unavailable, unavailable nodes have to be drained before they are replaced")
+
+    if cordon_outdated and resolve_rollout_count(max_surge, 100, round_up=True) == 0:
+        raise click.UsageError("--cordon-outdated requires --max-surge, outdated nodes are only cordoned once replacement capacity is Ready")
+
+    if len(prepull_image_list) > 0 and not prepull_images:
+        raise click.UsageError("--prepull-image requires --prepull-images")
+
+    if engine == "instance-refresh" and (pipeline_depth > 0 or cordon_outdated or drain_order != "listed" or wait_for_daemonsets or prepull_images):
+        raise click.UsageError("--pipeline-depth, --cordon-outdated, --drain-order, --wait-for-daemonsets and --prepull-images only apply to --engine=client, an instance refresh decides itself which instances to replace when")
+
+    options = dict(max_surge=max_surge, max_unavailable=max_unavailable, engine=engine, min_healthy_percentage=min_healthy_percentage, instance_warmup=instance_warmup, asg_concurrency=asg_concurrency, max_in_flight=max_in_flight, pipeline_depth=pipeline_depth, drain_method=drain_method, drain_timeout=drain_timeout, eviction_workers=eviction_workers, drain_order=drain_order, wait_for_daemonsets=wait_for_daemonsets, prepull_images=prepull_images, prepull_image_list=prepull_image_list, readiness_timeout=readiness_timeout, cordon_outdated=cordon_outdated, suspend_az_rebalance=suspend_az_rebalance)
+    # botocore's standard retry mode backs off with jitter, the shared rate limiter slows every other call down too
+    aws_config = botocore.config.Config(retries={"mode": "standard", "max_attempts": 10})
+
+    if fleet_manifest is not None:
+        pool = AwsClientPool(max_rate=aws_max_rate, cache_ttl=cache_ttl, config=aws_config)
+        rollout_fleet(load_fleet_manifest(fleet_manifest), pool, concurrency=cluster_concurrency, region_concurrency=region_concurrency, options=options, state_file=state_file, report_json=report_json, prometheus_textfile=prometheus_textfile, dry_run=dry_run)
+        return
+
+    metrics = RolloutMetrics(cluster_name)
+    cache = DescribeCache(ttl=cache_ttl)
+    rate_limiter = AwsRateLimiter(max_rate=aws_max_rate)
+    asg_client = CachedClient(metrics.instrument(rate_limiter.instrument(boto3.client("autoscaling", config=aws_config))), cache)
+    ec2_client = CachedClient(metrics.instrument(rate_limiter.instrument(boto3.client("ec2", config=aws_config))), cache)
+    try:
+        rollout_cluster(cluster_name, asg_client=asg_client, ec2_client=ec2_client, core_v1=get_core_v1_api(), state_file=state_file, metrics=metrics, dry_run=dry_run, **options)
+    finally:
+        logging.debug(f"Describe cache stats: {cache.stats()}")
+        logging.debug(f"AWS API calls: {dict(metrics.api_calls)}, throttled: {dict(metrics.throttles)}")
+        logging.debug(f"AWS rate limiter: {rate_limiter.stats()}")
+        if report_json is not None:
+            metrics.write_json(report_json)
+        if prometheus_textfile is not None:
+            metrics.write_prometheus(prometheus_textfile)
+
 if __name__ == '__main__':
     rollout_nodes()
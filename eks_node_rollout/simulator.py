@@ -0,0 +1,666 @@
+#!/usr/bin/env python3
+"""Offline simulation backend for eks-node-rollout.
+
+Runs the real `rollout_nodes` command against an in-memory model of a cluster's ASGs, EC2 instances, nodes
+and pods, in accelerated time. The AWS side is served to real boto3 clients through botocore's before-call
+hook, so parameter validation, event hooks and pagination all behave as they do against AWS. The Kubernetes
+side is a fake CoreV1Api and watch returning real kubernetes client models.
+"""
+import os
+import json
+import types
+import functools
+import random
+import datetime
+import tempfile
+import threading
+import itertools
+import collections
+import time as real_time
+from unittest.mock import patch
+import boto3
+import botocore.exceptions
+from botocore.awsrequest import AWSResponse
+from kubernetes import client as k8s
+from kubernetes.client.rest import ApiException
+import eks_node_rollout
+
+CLUSTER_NAME = "simulated"
+LAUNCH_TEMPLATE_ID = "lt-0000000000000000"
+DAEMONSET_NAME = "aws-node"
+
+
+class VirtualClock:
+    """Accelerated time, every real second is `speedup` simulated seconds.
+
+    Note that CPU time spent by the tool is accelerated too, so very high speedups inflate simulated durations.
+    """
+
+    def __init__(self, speedup=100, start=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)):
+        self.speedup = speedup
+        self.start = start
+        self._real_start = real_time.monotonic()
+
+    def monotonic(self):
+        return (real_time.monotonic() - self._real_start) * self.speedup
+
+    def time(self):
+        return self.start.timestamp() + self.monotonic()
+
+    def sleep(self, seconds):
+        real_time.sleep(max(seconds, 0) / self.speedup)
+
+    def now(self, tz=None):
+        now = self.start + datetime.timedelta(seconds=self.monotonic())
+        if tz is None:
+            return now.replace(tzinfo=None)
+        return now.astimezone(tz)
+
+    def at(self, seconds):
+        """The datetime `seconds` into the simulation"""
+
+        return self.start + datetime.timedelta(seconds=seconds)
+
+    def time_module(self):
+        return types.SimpleNamespace(sleep=self.sleep, monotonic=self.monotonic, time=self.time)
+
+    def datetime_module(self):
+        clock = self
+
+        class VirtualDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.now(tz)
+
+        return types.SimpleNamespace(datetime=VirtualDatetime, timezone=datetime.timezone, timedelta=datetime.timedelta)
+
+
+class Latencies:
+    """Simulated latencies in seconds, each one varies by +/- `jitter`"""
+
+    def __init__(self, launch=10, boot=50, ready=20, terminate=30, pod_termination=5, pod_startup=10, jitter=0.2):
+        self.launch = launch
+        self.boot = boot
+        self.ready = ready
+        self.terminate = terminate
+        self.pod_termination = pod_termination
+        self.pod_startup = pod_startup
+        self.jitter = jitter
+
+
+class SimulatedError(Exception):
+    def __init__(self, code, message, status_code=400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status_code = status_code
+
+
+class SimulatedCluster:
+    """In-memory state of the ASGs, instances, nodes and pods of one cluster.
+
+    Nothing runs in the background, state transitions are applied lazily by `advance()` whenever the
+    simulated AWS or Kubernetes APIs are called.
+    """
+
+    def __init__(self, clock, asg_sizes, latencies=None, pods_per_node=10, pods_per_app=5, azs=("a", "b", "c"), seed=0):
+        self.clock = clock
+        self.latencies = latencies or Latencies()
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.launch_template_version = 2
+        self.instances = {}
+        self.asgs = {}
+        self.pods = {}
+        self.unschedulable = set()
+        self.node_events = []
+        self.evictions = 0
+        self.peak_surge = 0
+        self._ids = itertools.count(1)
+
+        for index, size in enumerate(asg_sizes):
+            name = f"{CLUSTER_NAME}-asg-{index}"
+            self.asgs[name] = {
+                "name": name,
+                "index": index,
+                "desired": size,
+                "min": 0,
+                "max": size * 3 + 10,
+                "azs": [f"us-east-1{az}" for az in azs],
+                "instance_ids": [],
+                "activities": [],
+                "tags": {f"kubernetes.io/cluster/{CLUSTER_NAME}": "owned", "k8s.io/cluster-autoscaler/enabled": "true"},
+                "suspended_processes": set(),
+            }
+            for _ in range(size):
+                self._launch(self.asgs[name], at=-3600, version=1, record_activity=False)
+        self.initial_instances = len(self.instances)
+
+        node_names = [instance["node_name"] for instance in self.instances.values()]
+        for app in range(max(1, len(node_names) * pods_per_node // pods_per_app)):
+            for replica in range(pods_per_app):
+                self._create_pod(f"app-{app}", f"app-{app}-{replica}", self.random.choice(node_names), ready_at=-1800)
+        self.advance()
+
+    def _jitter(self, seconds):
+        return seconds * self.random.uniform(1 - self.latencies.jitter, 1 + self.latencies.jitter)
+
+    def _launch(self, asg, at, version, record_activity=True):
+        number = next(self._ids)
+        instance_id = f"i-{number:017x}"
+        az_counts = collections.Counter(self.instances[instance_id]["az"] for instance_id in asg["instance_ids"])
+        az = min(asg["azs"], key=lambda az: az_counts[az])  # an ASG keeps its AZs balanced
+        pending_at = at + (self._jitter(self.latencies.launch) if record_activity else 0)
+        registered_at = pending_at + self._jitter(self.latencies.boot)
+        self.instances[instance_id] = {
+            "id": instance_id,
+            "asg": asg["name"],
+            "az": az,
+            "version": version,
+            "node_name": f"ip-10-{asg['index']}-{number // 256}-{number % 256}.ec2.internal",
+            "pending_at": pending_at,
+            "running_at": pending_at + (registered_at - pending_at) / 2,
+            "registered_at": registered_at,
+            "ready_at": registered_at + self._jitter(self.latencies.ready),
+            "terminating_at": None,
+            "terminated_at": None,
+            "registered": False,
+            "ready": False,
+        }
+        asg["instance_ids"].append(instance_id)
+        if record_activity:
+            self._activity(asg, f"Launching a new EC2 instance: {instance_id}", pending_at)
+        return instance_id
+
+    def _activity(self, asg, description, at):
+        asg["activities"].insert(0, {
+            "ActivityId": f"activity-{next(self._ids)}",
+            "AutoScalingGroupName": asg["name"],
+            "Description": description,
+            "Cause": "Simulated",
+            "StartTime": self.clock.at(at),
+            "StatusCode": "Successful",
+            "Progress": 100,
+        })
+
+    def _create_pod(self, app, name, node_name, ready_at, daemonset=False):
+        uid = f"pod-{next(self._ids)}"
+        self.pods[uid] = {"uid": uid, "app": app, "name": name, "node": node_name, "ready_at": ready_at, "terminating_until": None, "daemonset": daemonset}
+        return uid
+
+    def _node_event(self, event_type, instance, at):
+        self.node_events.append((event_type, instance["id"], at))
+
+    def active_instances(self, asg):
+        return [self.instances[instance_id] for instance_id in asg["instance_ids"] if self.instances[instance_id]["terminating_at"] is None]
+
+    def schedulable_nodes(self, now):
+        return [instance["node_name"] for instance in self.instances.values() if instance["ready"] and instance["terminating_at"] is None and instance["node_name"] not in self.unschedulable]
+
+    def _schedule(self, now):
+        nodes = self.schedulable_nodes(now)
+        for pod in self.pods.values():
+            if pod["node"] is None and len(nodes) > 0:
+                pod["node"] = self.random.choice(nodes)
+                pod["ready_at"] = now + self._jitter(self.latencies.pod_startup)
+
+    def advance(self):
+        """Apply every state transition that is due by now"""
+
+        with self.lock:
+            now = self.clock.monotonic()
+            for asg in self.asgs.values():
+                for _ in range(asg["desired"] - len(self.active_instances(asg))):
+                    self._launch(asg, at=now, version=self.launch_template_version)
+
+            for instance in self.instances.values():
+                if not instance["registered"] and instance["terminating_at"] is None and instance["registered_at"] <= now:
+                    instance["registered"] = True
+                    self._node_event("ADDED", instance, instance["registered_at"])
+                    self._create_pod(DAEMONSET_NAME, f"{DAEMONSET_NAME}-{instance['id']}", instance["node_name"], ready_at=instance["ready_at"], daemonset=True)
+                if instance["registered"] and not instance["ready"] and instance["terminating_at"] is None and instance["ready_at"] <= now:
+                    instance["ready"] = True
+                    self._node_event("MODIFIED", instance, instance["ready_at"])
+                if instance["terminating_at"] is not None and instance["terminated_at"] is None and instance["terminating_at"] + self._jitter(self.latencies.terminate) <= now:
+                    instance["terminated_at"] = now
+                    self.asgs[instance["asg"]]["instance_ids"].remove(instance["id"])
+                    if instance["registered"]:
+                        self._node_event("DELETED", instance, now)
+                    for pod in self.pods.values():
+                        if pod["node"] == instance["node_name"]:
+                            pod["node"] = None if not pod["daemonset"] else pod["node"]
+                    self.pods = {uid: pod for uid, pod in self.pods.items() if not (pod["daemonset"] and pod["node"] == instance["node_name"])}
+
+            self.pods = {uid: pod for uid, pod in self.pods.items() if pod["terminating_until"] is None or pod["terminating_until"] > now}
+            self._schedule(now)
+            surge = len([instance for instance in self.instances.values() if instance["terminating_at"] is None]) - self.initial_instances
+            self.peak_surge = max(self.peak_surge, surge)
+
+    def evict(self, uid):
+        """Evict a pod if its app's PodDisruptionBudget (maxUnavailable: 1) allows it"""
+
+        with self.lock:
+            self.advance()
+            now = self.clock.monotonic()
+            pod = self.pods.get(uid)
+            if pod is None or pod["terminating_until"] is not None:
+                return
+            disrupted = [other for other in self.pods.values() if other["app"] == pod["app"] and other["uid"] != uid and (other["terminating_until"] is not None or other["node"] is None or other["ready_at"] > now)]
+            if len(disrupted) > 0:
+                raise ApiException(status=429, reason="Too Many Requests")
+            self.evictions += 1
+            pod["terminating_until"] = now + self._jitter(self.latencies.pod_termination)
+            self._create_pod(pod["app"], f"{pod['app']}-{next(self._ids)}", None, ready_at=None)
+            self._schedule(now)
+
+    def is_up_to_date(self):
+        with self.lock:
+            return all(instance["version"] == self.launch_template_version for instance in self.instances.values() if instance["terminating_at"] is None)
+
+
+class SimulatedAws:
+    """Auto Scaling and EC2 API backed by a SimulatedCluster, with optional injected throttling"""
+
+    def __init__(self, cluster, throttle_rate=0, max_attempts=5, seed=0):
+        self.cluster = cluster
+        self.clock = cluster.clock
+        self.throttle_rate = throttle_rate
+        self.max_attempts = max_attempts
+        self.random = random.Random(seed)
+        self.api_calls = collections.Counter()
+        self.throttles = collections.Counter()
+        self._session = boto3.session.Session(aws_access_key_id="simulated", aws_secret_access_key="simulated", region_name="us-east-1")
+        self._lock = threading.Lock()
+
+    def client(self, service_name, *args, **kwargs):
+        """A real boto3 client whose requests are answered by the simulation instead of AWS"""
+
+        client = self._session.client(service_name)
+        client.meta.events.register("before-parameter-build.*.*", self._capture_params)
+        # registered last so any other before-call handlers, e.g. eks_node_rollout's metrics, still see the call
+        client.meta.events.register_last("before-call.*.*", functools.partial(self._respond, client.meta.events))
+        client.meta.events.register("before-send.*.*", self._refuse_to_send)
+        return client
+
+    def _capture_params(self, params, context, **kwargs):
+        context["simulated_params"] = dict(params)
+
+    def _refuse_to_send(self, simulated=False, **kwargs):
+        if not simulated:
+            raise RuntimeError("The simulation never sends requests to AWS")
+
+    def _respond(self, events, model, params, context, **kwargs):
+        operation = botocore.xform_name(model.name)
+        with self._lock:
+            self.api_calls[model.name] += 1
+        for attempt in range(1, self.max_attempts + 1):
+            # every attempt would be sent, e.g. eks_node_rollout's rate limiter takes a token for each of them
+            events.emit(f"before-send.{model.service_model.service_id.hyphenize()}.{model.name}", request=None, simulated=True)
+            with self._lock:
+                throttled = self.random.random() < self.throttle_rate
+            if not throttled:
+                break
+            with self._lock:
+                self.throttles[model.name] += 1
+            response = self._error_response(SimulatedError("Throttling", "Rate exceeded"))
+            if attempt == self.max_attempts:
+                return response
+            # emulate botocore's own retries, which would happen below the before-call hook
+            events.emit(f"needs-retry.{model.service_model.service_id.hyphenize()}.{model.name}", response=response, endpoint=None, operation=model, attempts=attempt, caught_exception=None, request_dict=params)
+            self.clock.sleep(min(2 ** attempt * self.random.uniform(0, 0.5), 20))
+
+        try:
+            self.cluster.advance()
+            with self.cluster.lock:
+                parsed = getattr(self, operation)(**context["simulated_params"])
+        except SimulatedError as e:
+            return self._error_response(e)
+        parsed.setdefault("ResponseMetadata", {"HTTPStatusCode": 200, "RequestId": "simulated"})
+        return AWSResponse(None, 200, {}, None), parsed
+
+    def _error_response(self, error):
+        parsed = {"Error": {"Code": error.code, "Message": error.message}, "ResponseMetadata": {"HTTPStatusCode": error.status_code, "RequestId": "simulated"}}
+        return AWSResponse(None, error.status_code, {}, None), parsed
+
+    def _paginate(self, items, key, max_records, next_token):
+        start = int(next_token or 0)
+        page = {key: items[start:start + max_records]}
+        if start + max_records < len(items):
+            page["NextToken"] = str(start + max_records)
+        return page
+
+    def _asg(self, name):
+        if name not in self.cluster.asgs:
+            raise SimulatedError("ValidationError", f"AutoScalingGroup name not found - {name}")
+        return self.cluster.asgs[name]
+
+    def _instance(self, instance_id):
+        if instance_id not in self.cluster.instances:
+            raise SimulatedError("InvalidInstanceID.NotFound", f"The instance ID '{instance_id}' does not exist")
+        return self.cluster.instances[instance_id]
+
+    def _describe_asg(self, asg):
+        now = self.clock.monotonic()
+        instances = []
+        for instance_id in asg["instance_ids"]:
+            instance = self.cluster.instances[instance_id]
+            if instance["terminating_at"] is not None:
+                state = "Terminating"
+            elif instance["running_at"] > now:
+                state = "Pending"
+            else:
+                state = "InService"
+            instances.append({
+                "InstanceId": instance_id,
+                "InstanceType": "m5.large",
+                "AvailabilityZone": instance["az"],
+                "LifecycleState": state,
+                "HealthStatus": "Healthy",
+                "LaunchTemplate": {"LaunchTemplateId": LAUNCH_TEMPLATE_ID, "LaunchTemplateName": CLUSTER_NAME, "Version": str(instance["version"])},
+                "ProtectedFromScaleIn": False,
+            })
+        return {
+            "AutoScalingGroupName": asg["name"],
+            "MixedInstancesPolicy": {"LaunchTemplate": {"LaunchTemplateSpecification": {"LaunchTemplateId": LAUNCH_TEMPLATE_ID, "LaunchTemplateName": CLUSTER_NAME, "Version": "$Latest"}}},
+            "MinSize": asg["min"],
+            "MaxSize": asg["max"],
+            "DesiredCapacity": asg["desired"],
+            "DefaultCooldown": 300,
+            "AvailabilityZones": asg["azs"],
+            "HealthCheckType": "EC2",
+            "CreatedTime": self.clock.at(-86400),
+            "Instances": instances,
+            "SuspendedProcesses": [{"ProcessName": process, "SuspensionReason": "User suspended"} for process in sorted(asg["suspended_processes"])],
+            "Tags": [{"ResourceId": asg["name"], "ResourceType": "auto-scaling-group", "Key": key, "Value": value, "PropagateAtLaunch": False} for key, value in asg["tags"].items()],
+        }
+
+    # Auto Scaling
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames=None, Filters=(), MaxRecords=50, NextToken=None):
+        asgs = [asg for asg in self.cluster.asgs.values() if AutoScalingGroupNames is None or asg["name"] in AutoScalingGroupNames]
+        for asg_filter in Filters:
+            if asg_filter["Name"] == "tag-key":
+                asgs = [asg for asg in asgs if any(key in asg["tags"] for key in asg_filter["Values"])]
+            elif asg_filter["Name"].startswith("tag:"):
+                asgs = [asg for asg in asgs if asg["tags"].get(asg_filter["Name"][4:]) in asg_filter["Values"]]
+            else:
+                raise SimulatedError("ValidationError", f"Filter {asg_filter['Name']} is not simulated")
+        return self._paginate([self._describe_asg(asg) for asg in asgs], "AutoScalingGroups", MaxRecords, NextToken)
+
+    def describe_scaling_activities(self, AutoScalingGroupName, MaxRecords=100, NextToken=None):
+        return self._paginate(self._asg(AutoScalingGroupName)["activities"], "Activities", MaxRecords, NextToken)
+
+    def set_desired_capacity(self, AutoScalingGroupName, DesiredCapacity, HonorCooldown=False):
+        asg = self._asg(AutoScalingGroupName)
+        if not asg["min"] <= DesiredCapacity <= asg["max"]:
+            raise SimulatedError("ValidationError", f"New SetDesiredCapacity value {DesiredCapacity} is outside of the group's min and max")
+        asg["desired"] = DesiredCapacity
+        return {}
+
+    def terminate_instance_in_auto_scaling_group(self, InstanceId, ShouldDecrementDesiredCapacity):
+        instance = self._instance(InstanceId)
+        asg = self._asg(instance["asg"])
+        if instance["terminating_at"] is None:
+            now = self.clock.monotonic()
+            instance["terminating_at"] = now
+            if ShouldDecrementDesiredCapacity:
+                asg["desired"] -= 1
+            self.cluster._activity(asg, f"Terminating EC2 instance: {InstanceId}", now)
+        return {"Activity": dict(asg["activities"][0])}
+
+    def create_or_update_tags(self, Tags):
+        for tag in Tags:
+            self._asg(tag["ResourceId"])["tags"][tag["Key"]] = tag.get("Value", "")
+        return {}
+
+    def delete_tags(self, Tags):
+        for tag in Tags:
+            self._asg(tag["ResourceId"])["tags"].pop(tag["Key"], None)
+        return {}
+
+    def suspend_processes(self, AutoScalingGroupName, ScalingProcesses=()):
+        self._asg(AutoScalingGroupName)["suspended_processes"].update(ScalingProcesses)
+        return {}
+
+    def resume_processes(self, AutoScalingGroupName, ScalingProcesses=()):
+        self._asg(AutoScalingGroupName)["suspended_processes"].difference_update(ScalingProcesses)
+        return {}
+
+    # EC2
+
+    def describe_instances(self, InstanceIds=(), Filters=(), MaxResults=None, NextToken=None):
+        now = self.clock.monotonic()
+        filters = {f["Name"]: set(f["Values"]) for f in Filters}
+        instances = []
+        # unlike InstanceIds, an instance-id filter skips IDs that don't exist
+        for instance_id in InstanceIds or [instance_id for instance_id in filters.get("instance-id", []) if instance_id in self.cluster.instances]:
+            instance = self._instance(instance_id)
+            if instance["terminated_at"] is not None:
+                state = "terminated"
+            elif instance["terminating_at"] is not None:
+                state = "shutting-down"
+            elif instance["running_at"] > now:
+                state = "pending"
+            else:
+                state = "running"
+            if "instance-state-name" in filters and state not in filters["instance-state-name"]:
+                continue
+            instances.append({
+                "InstanceId": instance_id,
+                "InstanceType": "m5.large",
+                "PrivateDnsName": instance["node_name"],
+                "LaunchTime": self.clock.at(instance["pending_at"]),
+                "State": {"Name": state},
+                "Placement": {"AvailabilityZone": instance["az"]},
+            })
+        return {"Reservations": [{"ReservationId": "r-simulated", "Instances": instances}]}
+
+    def describe_launch_templates(self, LaunchTemplateIds=(), LaunchTemplateNames=(), MaxResults=None, NextToken=None):
+        return {"LaunchTemplates": [{
+            "LaunchTemplateId": LAUNCH_TEMPLATE_ID,
+            "LaunchTemplateName": CLUSTER_NAME,
+            "DefaultVersionNumber": 1,
+            "LatestVersionNumber": self.cluster.launch_template_version,
+        }]}
+
+
+class SimulatedCoreV1Api:
+    """The subset of kubernetes.client.CoreV1Api used by eks_node_rollout, backed by a SimulatedCluster"""
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.clock = cluster.clock
+        self.api_calls = collections.Counter()
+
+    def _node(self, instance, resource_version=None):
+        ready = instance["ready"] and instance["terminating_at"] is None
+        return k8s.V1Node(
+            metadata=k8s.V1ObjectMeta(
+                name=instance["node_name"],
+                resource_version=resource_version or str(len(self.cluster.node_events)),
+                creation_timestamp=self.clock.at(instance["registered_at"]),
+                labels={"topology.kubernetes.io/zone": instance["az"]},
+            ),
+            spec=k8s.V1NodeSpec(unschedulable=instance["node_name"] in self.cluster.unschedulable or None, provider_id=f"aws:///{instance['az']}/{instance['id']}"),
+            status=k8s.V1NodeStatus(conditions=[k8s.V1NodeCondition(
+                type="Ready",
+                status="True" if ready else "False",
+                last_transition_time=self.clock.at(instance["ready_at"] if ready else instance["registered_at"]),
+            )]),
+        )
+
+    def _pod(self, pod):
+        now = self.clock.monotonic()
+        owner_kind = "DaemonSet" if pod["daemonset"] else "ReplicaSet"
+        ready = pod["node"] is not None and pod["ready_at"] is not None and pod["ready_at"] <= now and pod["terminating_until"] is None
+        return k8s.V1Pod(
+            metadata=k8s.V1ObjectMeta(
+                name=pod["name"],
+                namespace="default",
+                uid=pod["uid"],
+                labels={"app": pod["app"]},
+                owner_references=[k8s.V1OwnerReference(api_version="apps/v1", kind=owner_kind, name=pod["app"], uid=pod["app"])],
+                deletion_timestamp=None if pod["terminating_until"] is None else self.clock.now(datetime.timezone.utc),
+            ),
+            spec=k8s.V1PodSpec(node_name=pod["node"], containers=[k8s.V1Container(name=pod["app"], image=f"registry.local/{pod['app']}:1")]),
+            status=k8s.V1PodStatus(phase="Running" if pod["node"] else "Pending", conditions=[k8s.V1PodCondition(type="Ready", status="True" if ready else "False")]),
+        )
+
+    def _call(self, name):
+        self.api_calls[name] += 1
+        self.cluster.advance()
+
+    def get_api_resources(self):
+        self._call("get_api_resources")
+        return k8s.V1APIResourceList(group_version="v1", resources=[k8s.V1APIResource(name="pods/eviction", kind="Eviction", group="policy", version="v1", namespaced=True, singular_name="", verbs=["create"])])
+
+    def list_node(self, **kwargs):
+        self._call("list_node")
+        with self.cluster.lock:
+            nodes = [self._node(instance) for instance in self.cluster.instances.values() if instance["registered"] and instance["terminated_at"] is None]
+            return k8s.V1NodeList(items=nodes, metadata=k8s.V1ListMeta(resource_version=str(len(self.cluster.node_events))))
+
+    def read_node(self, name, **kwargs):
+        self._call("read_node")
+        with self.cluster.lock:
+            for instance in self.cluster.instances.values():
+                if instance["node_name"] == name and instance["registered"] and instance["terminated_at"] is None:
+                    return self._node(instance)
+        raise ApiException(status=404, reason="Not Found")
+
+    def patch_node(self, name, body, **kwargs):
+        self._call("patch_node")
+        with self.cluster.lock:
+            if name not in [instance["node_name"] for instance in self.cluster.instances.values() if instance["registered"] and instance["terminated_at"] is None]:
+                raise ApiException(status=404, reason="Not Found")
+            if body.get("spec", {}).get("unschedulable"):
+                self.cluster.unschedulable.add(name)
+            else:
+                self.cluster.unschedulable.discard(name)
+        return self.read_node(name)
+
+    def list_pod_for_all_namespaces(self, field_selector=None, **kwargs):
+        self._call("list_pod_for_all_namespaces")
+        with self.cluster.lock:
+            pods = list(self.cluster.pods.values())
+            if field_selector is not None and field_selector.startswith("spec.nodeName="):
+                pods = [pod for pod in pods if pod["node"] == field_selector[len("spec.nodeName="):]]
+            return k8s.V1PodList(items=[self._pod(pod) for pod in pods])
+
+    def list_pod_disruption_budget_for_all_namespaces(self, **kwargs):
+        """Stands in for PolicyV1Api, every app has a PodDisruptionBudget with maxUnavailable: 1"""
+
+        self._call("list_pod_disruption_budget_for_all_namespaces")
+        now = self.clock.monotonic()
+        with self.cluster.lock:
+            apps = collections.defaultdict(list)
+            for pod in self.cluster.pods.values():
+                if not pod["daemonset"]:
+                    apps[pod["app"]].append(pod)
+            pdbs = []
+            for app, pods in sorted(apps.items()):
+                healthy = len([pod for pod in pods if pod["node"] is not None and pod["ready_at"] is not None and pod["ready_at"] <= now and pod["terminating_until"] is None])
+                pdbs.append(k8s.V1PodDisruptionBudget(
+                    metadata=k8s.V1ObjectMeta(name=app, namespace="default"),
+                    spec=k8s.V1PodDisruptionBudgetSpec(max_unavailable=1, selector=k8s.V1LabelSelector(match_labels={"app": app})),
+                    status=k8s.V1PodDisruptionBudgetStatus(disruptions_allowed=max(0, healthy - (len(pods) - 1)), current_healthy=healthy, desired_healthy=len(pods) - 1, expected_pods=len(pods)),
+                ))
+            return k8s.V1PodDisruptionBudgetList(items=pdbs)
+
+    def create_namespaced_pod_eviction(self, name, namespace, body, **kwargs):
+        self._call("create_namespaced_pod_eviction")
+        with self.cluster.lock:
+            uids = [uid for uid, pod in self.cluster.pods.items() if pod["name"] == name]
+        if len(uids) == 0:
+            raise ApiException(status=404, reason="Not Found")
+        self.cluster.evict(uids[0])
+
+    def watch_nodes(self, resource_version=None, timeout_seconds=60):
+        """Generator behind SimulatedWatch.stream(), yields node events after `resource_version`"""
+
+        position = int(resource_version or 0)
+        deadline = self.clock.monotonic() + (timeout_seconds or 60)
+        while self.clock.monotonic() < deadline:
+            self.cluster.advance()
+            with self.cluster.lock:
+                events = self.cluster.node_events[position:]
+            for event_type, instance_id, _ in events:
+                position += 1
+                with self.cluster.lock:
+                    node = self._node(self.cluster.instances[instance_id], resource_version=str(position))
+                yield {"type": event_type, "object": node}
+            self.clock.sleep(1)
+
+
+class SimulatedWatch:
+    def stream(self, func, *args, resource_version=None, timeout_seconds=None, **kwargs):
+        return func.__self__.watch_nodes(resource_version=resource_version, timeout_seconds=timeout_seconds)
+
+
+class SimulationResult:
+    def __init__(self, duration, wall_time, api_calls, throttles, kubernetes_api_calls, peak_surge, evictions, up_to_date, report, error=None):
+        self.duration = duration
+        self.wall_time = wall_time
+        self.api_calls = api_calls
+        self.throttles = throttles
+        self.kubernetes_api_calls = kubernetes_api_calls
+        self.peak_surge = peak_surge
+        self.evictions = evictions
+        self.up_to_date = up_to_date
+        self.report = report
+        self.error = error
+
+    def as_dict(self):
+        return {
+            "duration_seconds": round(self.duration, 1),
+            "wall_time_seconds": round(self.wall_time, 2),
+            "api_calls": sum(self.api_calls.values()),
+            "throttles": sum(self.throttles.values()),
+            "kubernetes_api_calls": sum(self.kubernetes_api_calls.values()),
+            "peak_surge": self.peak_surge,
+            "evictions": self.evictions,
+            "up_to_date": self.up_to_date,
+            "error": None if self.error is None else str(self.error),
+        }
+
+
+def simulate(asg_sizes, args=(), latencies=None, throttle_rate=0, speedup=100, pods_per_node=10, seed=0):
+    """Roll a simulated cluster with `rollout_nodes` and the given command line `args`"""
+
+    clock = VirtualClock(speedup=speedup)
+    cluster = SimulatedCluster(clock, asg_sizes, latencies=latencies, pods_per_node=pods_per_node, seed=seed)
+    aws = SimulatedAws(cluster, throttle_rate=throttle_rate, seed=seed)
+    core_v1 = SimulatedCoreV1Api(cluster)
+
+    with tempfile.TemporaryDirectory() as directory, \
+            patch.object(eks_node_rollout.boto3, "client", side_effect=aws.client), \
+            patch.object(eks_node_rollout, "get_core_v1_api", return_value=core_v1), \
+            patch.object(eks_node_rollout, "get_policy_v1_api", return_value=core_v1), \
+            patch.object(eks_node_rollout, "watch", types.SimpleNamespace(Watch=SimulatedWatch)), \
+            patch.object(eks_node_rollout, "time", clock.time_module()), \
+            patch.object(eks_node_rollout, "datetime", clock.datetime_module()):
+        report_path = os.path.join(directory, "report.json")
+        started, real_started = clock.monotonic(), real_time.monotonic()
+        error = None
+        try:
+            eks_node_rollout.rollout_nodes.main(["--cluster-name", CLUSTER_NAME, "--report-json", report_path] + list(args), standalone_mode=False)
+        except Exception as e:
+            error = e
+        duration, wall_time = clock.monotonic() - started, real_time.monotonic() - real_started
+        report = None
+        if os.path.exists(report_path):
+            with open(report_path) as f:
+                report = json.load(f)
+
+    return SimulationResult(
+        duration=duration,
+        wall_time=wall_time,
+        api_calls=aws.api_calls,
+        throttles=aws.throttles,
+        kubernetes_api_calls=core_v1.api_calls,
+        peak_surge=cluster.peak_surge,
+        evictions=cluster.evictions,
+        up_to_date=cluster.is_up_to_date(),
+        report=report,
+        error=error,
+    )
@@ -5,7 +5,8 @@ import pytest
 from eks_node_rollout import *
 from botocore.stub import Stubber, ANY
 import botocore.exceptions
-from unittest.mock import Mock, patch
+import botocore.hooks
+from unittest.mock import Mock, call, patch
 from click.testing import CliRunner
 
 
@@ -33,8 +34,7 @@ def test_add_node():
     assert add_node(asg_client=asg_client, asg_name="foobar") is None
 
 
-@patch('eks_node_rollout.get_latest_lt_version', return_value="1")
-def test_describe_nodes_not_matching_lt(*args):
+def test_describe_nodes_not_matching_lt():
     asg_client = boto3.client("autoscaling", region_name="ap-southeast-2")
     asg_stubber = Stubber(asg_client)
     ec2_client = boto3.client("ec2", region_name="ap-southeast-2")
@@ -123,7 +123,10 @@ def test_describe_nodes_not_matching_lt(*args):
         ]
     }
 
-    ec2_stubber.add_response('describe_instances', mock_response)
+    ec2_stubber.add_response('describe_launch_templates', {
+        "LaunchTemplates": [{"LaunchTemplateId": "new", "LaunchTemplateName": "foobar", "DefaultVersionNumber": 1, "LatestVersionNumber": 2}]
+    }, {"LaunchTemplateIds": ["new"]})
+    ec2_stubber.add_response('describe_instances', mock_response, {"InstanceIds": ["oldest", "newer"]})
 
     asg_stubber.activate()
     ec2_stubber.activate()
@@ -132,19 +135,76 @@ def test_describe_nodes_not_matching_lt(*args):
     assert len(instances) == 2
 
 
-@patch('eks_node_rollout.kubectl', create=True)
-def test_wait_for_ready_node_rollout(*args):
-    args[0].side_effect = [sh.ErrorReturnCode_1(full_cmd="foo", stdout="".encode(), stderr="blah blah NotFound blah".encode())]*20 + [None]
-    start_time = datetime.datetime.now(datetime.timezone.utc)
-    assert wait_for_ready_node("somenode") is None
-    end_time = datetime.datetime.now(datetime.timezone.utc)
-    duration = end_time - start_time
-    assert duration > datetime.timedelta(seconds=3)
+def test_launch_template_resolver():
+    ec2_client = boto3.client("ec2", region_name="ap-southeast-2")
+    stubber = Stubber(ec2_client)
+    stubber.add_response('describe_launch_templates', {"LaunchTemplates": [
+        {"LaunchTemplateId": "lt-a", "LaunchTemplateName": "nodes-a", "DefaultVersionNumber": 3, "LatestVersionNumber": 5},
+        {"LaunchTemplateId": "lt-b", "LaunchTemplateName": "nodes-b", "DefaultVersionNumber": 1, "LatestVersionNumber": 1},
+    ]}, {"LaunchTemplateIds": ["lt-a", "lt-b"]})
+    stubber.activate()
+    asgs = [
+        {"LaunchTemplate": {"LaunchTemplateId": "lt-a", "Version": "$Latest"}},
+        {"MixedInstancesPolicy": {"LaunchTemplate": {
+            "LaunchTemplateSpecification": {"LaunchTemplateId": "lt-a", "Version": "$Default"},
+            "Overrides": [{"InstanceType": "m5.large", "LaunchTemplateSpecification": {"LaunchTemplateId": "lt-b", "Version": "1"}}],
+        }}},
+        {"LaunchConfigurationName": "lc-2"},
+    ]
+    resolver = LaunchTemplateResolver(ec2_client)
+    resolver.prefetch(asgs)  # a single call for all ASGs
+    stubber.assert_no_pending_responses()
+
+    assert resolver.resolve({"LaunchTemplateId": "lt-a", "Version": "$Latest"}) == ("lt-a", 5)
+    assert resolver.resolve({"LaunchTemplateName": "nodes-a"}) == ("lt-a", 3)
+    assert resolver.resolve({"LaunchTemplateId": "lt-a", "Version": "4"}) == ("lt-a", 4)
+    assert is_instance_outdated(asgs[0], {"LaunchTemplate": {"LaunchTemplateId": "lt-a", "Version": "3"}}, resolver)
+    assert not is_instance_outdated(asgs[1], {"LaunchTemplate": {"LaunchTemplateId": "lt-a", "Version": "3"}}, resolver)
+    assert not is_instance_outdated(asgs[1], {"LaunchTemplate": {"LaunchTemplateId": "lt-b", "Version": "1"}}, resolver)
+    assert is_instance_outdated(asgs[2], {"LaunchConfigurationName": "lc-1"}, resolver)
+    assert not is_instance_outdated(asgs[2], {"LaunchConfigurationName": "lc-2"}, resolver)
+
+
+def mock_node(name, ready, resource_version="1"):
+    return kubernetes.client.V1Node(
+        metadata=kubernetes.client.V1ObjectMeta(name=name, resource_version=resource_version),
+        status=kubernetes.client.V1NodeStatus(conditions=[
+            kubernetes.client.V1NodeCondition(type="Ready", status="True" if ready else "False")
+        ])
+    )
+
 
+def test_node_readiness_tracker():
+    tracker = NodeReadinessTracker(core_v1=None)
+    tracker.handle_event("ADDED", mock_node("old", ready=True))
+    assert tracker.wait_for("old").done()
 
-@patch('boto3.client', return_value=None)
-@patch('time.sleep', return_value=None)
-@patch('eks_node_rollout.get_matching_asgs', return_value=["asg1", "asg2", "asg3"])
+    future = tracker.wait_for("new")
+    tracker.handle_event("ADDED", mock_node("new", ready=False))
+    assert not future.done()
+    tracker.handle_event("MODIFIED", mock_node("new", ready=True))
+    assert future.result(timeout=0) == "new"
+
+
+@patch('eks_node_rollout.watch.Watch')
+def test_wait_for_ready_node(mock_watch):
+    core_v1 = Mock()
+    core_v1.list_node.return_value = kubernetes.client.V1NodeList(items=[], metadata=kubernetes.client.V1ListMeta(resource_version="1"))
+    mock_watch.return_value.stream.return_value = iter([
+        {"type": "ADDED", "object": mock_node("somenode", ready=False, resource_version="2")},
+        {"type": "MODIFIED", "object": mock_node("somenode", ready=True, resource_version="3")},
+    ])
+    tracker = NodeReadinessTracker(core_v1).start()
+    assert wait_for_ready_node(tracker, "somenode", timeout=5) is None
+    tracker.stop()
+    mock_watch.return_value.stream.assert_any_call(core_v1.list_node, resource_version="1", timeout_seconds=60)
+
+
+@patch('eks_node_rollout.get_capacity', return_value=(5, 10))
+@patch('boto3.client')
+@patch('eks_node_rollout.get_core_v1_api', return_value=None)
+@patch('eks_node_rollout.NodeReadinessTracker')
+@patch('eks_node_rollout.get_matching_asgs', return_value=[{"AutoScalingGroupName": "asg1"}, {"AutoScalingGroupName": "asg2"}, {"AutoScalingGroupName": "asg3"}])
 @patch('eks_node_rollout.describe_nodes_not_matching_lt', return_value=[  # same instances each of the 3 ASGs
         {"PrivateDnsName": "instance1", "InstanceId": "i-asdfasdfasdf"},
         {"PrivateDnsName": "instance2", "InstanceId": "i-fdsaasdfdsasdf"},
@@ -153,11 +213,11 @@ def test_wait_for_ready_node_rollout(*args):
 )
 @patch('eks_node_rollout.check_is_cluster_autoscaler_tag_present', return_value=True)
 @patch('eks_node_rollout.disable_autoscaling', return_value=None)
-@patch('eks_node_rollout.get_num_of_instances', side_effect=[3, 4]*9)  # function is run twice for each of the 9 instances
+@patch('eks_node_rollout.get_asg_instance_ids', return_value=["i-asdfasdfasdf", "i-fdsaasdfdsasdf", "i-dsadfasdfdsafa"])
 @patch('eks_node_rollout.add_node', return_value=None)
-@patch('eks_node_rollout.get_latest_instance', return_value={"PrivateDnsName": "instance4"})
+@patch('eks_node_rollout.get_launched_instances', return_value=[{"PrivateDnsName": "instance4"}])
 @patch('eks_node_rollout.wait_for_ready_node', return_value=None)
-@patch('eks_node_rollout.kubectl', return_value="evicting pod foobar", create=True)
+@patch('eks_node_rollout.NodeDrainer')
 @patch('eks_node_rollout.terminate_node', return_value=None)
 @patch('eks_node_rollout.enable_autoscaling', return_value=None)
 def test_rollout_nodes_happy(*args):
@@ -166,3 +226,787 @@ def test_rollout_nodes_happy(*args):
     result = runner.invoke(rollout_nodes, [f"--cluster-name={cluster_name}"])
     assert result.exit_code == 0
     assert result.output is not None
+
+
+def test_get_launched_instance_ids():
+    asg_client = boto3.client("autoscaling", region_name="ap-southeast-2")
+    stubber = Stubber(asg_client)
+    add_time = datetime.datetime.now(datetime.timezone.utc)
+
+    def activity(description, start_time, status_code="Successful"):
+        return {
+            "ActivityId": description,
+            "AutoScalingGroupName": "foobar",
+            "Cause": "At 2020-01-01T00:00:00Z a user request explicitly set group desired capacity changing the desired capacity from 3 to 5.",
+            "Description": description,
+            "StartTime": start_time,
+            "StatusCode": status_code
+        }
+    mock_response = {
+        "Activities": [
+            activity("Launching a new EC2 instance: i-0000000000000000c", add_time + datetime.timedelta(seconds=3)),
+            activity("Launching a new EC2 instance: i-0000000000000000b", add_time + datetime.timedelta(seconds=2), status_code="Failed"),
+            activity("Launching a new EC2 instance: i-0000000000000000a", add_time + datetime.timedelta(seconds=1)),
+            activity("Terminating EC2 instance: i-00000000000000009", add_time - datetime.timedelta(seconds=1)),
+            activity("Launching a new EC2 instance: i-00000000000000008", add_time - datetime.timedelta(seconds=20)),
+            activity("Launching a new EC2 instance: i-00000000000000007", add_time - datetime.timedelta(hours=1)),
+        ]
+    }
+    stubber.add_response('describe_scaling_activities', mock_response, {"AutoScalingGroupName": "foobar"})
+    stubber.activate()
+    instance_ids = get_launched_instance_ids(asg_client, "foobar", since=add_time, exclude=["i-00000000000000008"])
+    assert instance_ids == ["i-0000000000000000a", "i-0000000000000000c"]
+
+
+def test_get_launched_instances():
+    asg_client = boto3.client("autoscaling", region_name="ap-southeast-2")
+    asg_stubber = Stubber(asg_client)
+    ec2_client = boto3.client("ec2", region_name="ap-southeast-2")
+    ec2_stubber = Stubber(ec2_client)
+    add_time = datetime.datetime.now(datetime.timezone.utc)
+    # i-...a failed its health check and the ASG replaced it with i-...b
+    asg_stubber.add_response('describe_scaling_activities', {"Activities": [
+        {"ActivityId": "3", "AutoScalingGroupName": "foobar", "Cause": "health check", "Description": "Launching a new EC2 instance: i-0000000000000000b", "StartTime": add_time + datetime.timedelta(minutes=5), "StatusCode": "Successful"},
+        {"ActivityId": "2", "AutoScalingGroupName": "foobar", "Cause": "health check", "Description": "Terminating EC2 instance: i-0000000000000000a", "StartTime": add_time + datetime.timedelta(minutes=4), "StatusCode": "Successful"},
+        {"ActivityId": "1", "AutoScalingGroupName": "foobar", "Cause": "health check", "Description": "Launching a new EC2 instance: i-0000000000000000a", "StartTime": add_time, "StatusCode": "Successful"},
+    ]}, {"AutoScalingGroupName": "foobar"})
+    ec2_stubber.add_response('describe_instances', {"Reservations": [{"Instances": [
+        {"InstanceId": "i-0000000000000000b", "PrivateDnsName": "b.aws.local", "State": {"Name": "running"}},
+    ]}]}, {"Filters": [
+        {"Name": "instance-id", "Values": ["i-0000000000000000a", "i-0000000000000000b"]},
+        {"Name": "instance-state-name", "Values": ["pending", "running"]},
+    ]})
+    asg_stubber.activate()
+    ec2_stubber.activate()
+    instances = get_launched_instances(asg_client, ec2_client, "foobar", since=add_time, count=1)
+    assert [instance["InstanceId"] for instance in instances] == ["i-0000000000000000b"]
+
+
+def test_cached_client():
+    asg_client = boto3.client("autoscaling", region_name="ap-southeast-2")
+    stubber = Stubber(asg_client)
+    mock_response = {
+        'AutoScalingGroups': [
+            {
+                "AutoScalingGroupName": "foobar",
+                "DesiredCapacity": 5,
+                "MinSize": 1,
+                "MaxSize": 10,
+                "DefaultCooldown": 20,
+                "AvailabilityZones": ["ap-southeast-2a"],
+                "HealthCheckType": "EC2",
+                "CreatedTime": datetime.datetime.now() - datetime.timedelta(days=1)
+            }
+        ]
+    }
+    stubber.add_response('describe_auto_scaling_groups', mock_response, {"AutoScalingGroupNames": ["foobar"]})
+    stubber.add_response('set_desired_capacity', {}, {"AutoScalingGroupName": "foobar", "DesiredCapacity": 6})
+    stubber.add_response('describe_auto_scaling_groups', mock_response, {"AutoScalingGroupNames": ["foobar"]})
+    stubber.activate()
+
+    cache = DescribeCache(ttl=60)
+    cached_client = CachedClient(asg_client, cache)
+    assert get_desired_capacity(cached_client, "foobar") == 5
+    add_node(asg_client=cached_client, asg_name="foobar", dry_run=False)  # served from the cache, then invalidates it
+    assert get_desired_capacity(cached_client, "foobar") == 5
+    stubber.assert_no_pending_responses()
+    assert cache.stats() == {"hits": 1, "misses": 2}
+
+
+def test_get_matching_asgs():
+    asg_client = boto3.client("autoscaling", region_name="ap-southeast-2")
+    stubber = Stubber(asg_client)
+
+    def mock_asg(name):
+        return {
+            "AutoScalingGroupName": name,
+            "DesiredCapacity": 5,
+            "MinSize": 1,
+            "MaxSize": 10,
+            "DefaultCooldown": 20,
+            "AvailabilityZones": ["ap-southeast-2a"],
+            "HealthCheckType": "EC2",
+            "CreatedTime": datetime.datetime.now() - datetime.timedelta(days=1)
+        }
+    filters = [{"Name": "tag-key", "Values": ["kubernetes.io/cluster/foo"]}]
+    stubber.add_response('describe_auto_scaling_groups', {"AutoScalingGroups": [mock_asg("asg1")], "NextToken": "page2"}, {"Filters": filters})
+    stubber.add_response('describe_auto_scaling_groups', {"AutoScalingGroups": [mock_asg("asg2")]}, {"Filters": filters, "NextToken": "page2"})
+    stubber.activate()
+
+    cache = DescribeCache(ttl=60)
+    cached_client = CachedClient(asg_client, cache)
+    asgs = get_matching_asgs(cached_client, "foo")
+    assert [asg["AutoScalingGroupName"] for asg in asgs] == ["asg1", "asg2"]
+    assert get_desired_capacity(cached_client, "asg2") == 5  # no describe call left in the stubber, so this must come from the cache
+
+
+def test_asg_log_context(caplog):
+    caplog.set_level(logging.INFO)
+    log_context.asg_name = "asg1"
+    try:
+        logging.info("Draining node foo")
+    finally:
+        log_context.asg_name = None
+    logging.info("All done")
+    assert [record.getMessage() for record in caplog.records] == ["[asg1] Draining node foo", "All done"]
+
+
+def test_in_flight_limiter():
+    limiter = InFlightLimiter(limit=3)
+    acquired = threading.Event()
+
+    def hold_two():
+        with limiter.hold(2):
+            acquired.set()
+
+    with limiter.hold(2):
+        thread = threading.Thread(target=hold_two)
+        thread.start()
+        assert not acquired.wait(0.2)  # would be 4 in flight
+    assert acquired.wait(5)
+    thread.join()
+
+    cancelled = threading.Event()
+    with limiter.hold(3):
+        threading.Timer(0.1, cancelled.set).start()
+        assert limiter.acquire(1, cancelled=cancelled) is False
+    assert limiter._in_flight == 0
+
+
+def mock_pod(name, owner_kind="ReplicaSet"):
+    return kubernetes.client.V1Pod(metadata=kubernetes.client.V1ObjectMeta(
+        name=name, namespace="default", uid=name,
+        owner_references=[kubernetes.client.V1OwnerReference(api_version="apps/v1", kind=owner_kind, name="owner", uid="owner")]
+    ))
+
+
+def test_node_drainer():
+    core_v1 = Mock()
+    # a cluster older than 1.22 only serves policy/v1beta1 evictions
+    core_v1.get_api_resources.return_value = kubernetes.client.V1APIResourceList(group_version="v1", resources=[
+        kubernetes.client.V1APIResource(name="pods", kind="Pod", namespaced=True, singular_name="", verbs=[]),
+        kubernetes.client.V1APIResource(name="pods/eviction", kind="Eviction", group="policy", version="v1beta1", namespaced=True, singular_name="", verbs=[]),
+    ])
+    pods = [mock_pod("app-1"), mock_pod("app-2"), mock_pod("aws-node", owner_kind="DaemonSet")]
+    evicted = set()
+    core_v1.list_pod_for_all_namespaces.side_effect = lambda field_selector: kubernetes.client.V1PodList(items=[pod for pod in pods if pod.metadata.name not in evicted])
+    pdb_refusals = {"app-2": 2}
+
+    def evict(name, namespace, body):
+        assert body["apiVersion"] == "policy/v1beta1"
+        if pdb_refusals.get(name, 0) > 0:
+            pdb_refusals[name] -= 1
+            raise ApiException(status=429, reason="Too Many Requests")
+        evicted.add(name)
+    core_v1.create_namespaced_pod_eviction.side_effect = evict
+
+    drainer = NodeDrainer(core_v1, workers=4, timeout=10, poll_interval=0.01)
+    latencies = drainer.drain("node1", dry_run=False)
+    core_v1.patch_node.assert_called_once_with("node1", {"spec": {"unschedulable": True}})
+    assert sorted(latencies) == ["default/app-1", "default/app-2"]
+    assert core_v1.create_namespaced_pod_eviction.call_count == 4  # app-1 once, app-2 refused twice
+    assert pdb_refusals["app-2"] == 0
+    core_v1.get_api_resources.assert_called_once()
+
+
+def scheduled_pod(name, node_name, app):
+    pod = mock_pod(name)
+    pod.metadata.labels = {"app": app}
+    pod.spec = kubernetes.client.V1PodSpec(node_name=node_name, containers=[])
+    return pod
+
+
+def mock_pdb(app, disruptions_allowed):
+    return kubernetes.client.V1PodDisruptionBudget(
+        metadata=kubernetes.client.V1ObjectMeta(name=app, namespace="default"),
+        spec=kubernetes.client.V1PodDisruptionBudgetSpec(selector=kubernetes.client.V1LabelSelector(match_labels={"app": app})),
+        status=kubernetes.client.V1PodDisruptionBudgetStatus(disruptions_allowed=disruptions_allowed, current_healthy=3, desired_healthy=2, expected_pods=3)
+    )
+
+
+def test_selector_matches():
+    selector = kubernetes.client.V1LabelSelector(match_labels={"app": "web"}, match_expressions=[
+        kubernetes.client.V1LabelSelectorRequirement(key="tier", operator="In", values=["frontend"]),
+        kubernetes.client.V1LabelSelectorRequirement(key="canary", operator="DoesNotExist"),
+    ])
+    assert selector_matches(selector, {"app": "web", "tier": "frontend"})
+    assert not selector_matches(selector, {"app": "web", "tier": "backend"})
+    assert not selector_matches(selector, {"app": "web", "tier": "frontend", "canary": "true"})
+    assert selector_matches(kubernetes.client.V1LabelSelector(), {"anything": "goes"})
+
+
+def test_drain_planner(caplog):
+    caplog.set_level(logging.INFO)
+    pods = [scheduled_pod(f"web-{i}", "busy", "web") for i in range(3)] + [scheduled_pod(f"db-{i}", "blocked", "db") for i in range(2)] + [scheduled_pod("api-0", "quiet", "api"), scheduled_pod("api-1", "other", "api")]
+    snapshot = WorkloadSnapshot(pods, [mock_pdb("web", 3), mock_pdb("db", 0), mock_pdb("api", 0)])
+    assert snapshot.drain_cost("busy", workers=2) == {"pods": 3, "blocked": 0, "pdbs": set(), "seconds": 20}
+    assert snapshot.drain_cost("blocked", workers=2) == {"pods": 2, "blocked": 2, "pdbs": {"default/db"}, "seconds": 70}
+
+    # a cluster older than 1.21 only serves policy/v1beta1 PodDisruptionBudgets
+    core_v1 = Mock()
+    core_v1.list_pod_for_all_namespaces.return_value = kubernetes.client.V1PodList(items=pods)
+    policy_v1 = Mock()
+    policy_v1.list_pod_disruption_budget_for_all_namespaces.side_effect = ApiException(status=404, reason="Not Found")
+    with patch('kubernetes.client.PolicyV1beta1Api', create=True) as policy_v1beta1:  # dropped by clients newer than the one we pin
+        policy_v1beta1.return_value.list_pod_disruption_budget_for_all_namespaces.return_value = Mock(items=[mock_pdb("db", 0)])
+        assert WorkloadSnapshot.take(core_v1, policy_v1).drain_cost("blocked", workers=2)["pdbs"] == {"default/db"}
+    policy_v1beta1.assert_called_once_with(policy_v1.api_client)
+
+    instances = [{"InstanceId": f"i-{name}", "PrivateDnsName": name} for name in ["blocked", "busy", "quiet", "other"]]
+    planner = DrainPlanner(snapshot, order="cheapest", workers=2, timeout=60)
+    ordered = planner.plan("asg1", instances)
+    assert [instance["PrivateDnsName"] for instance in ordered] == ["busy", "quiet", "other", "blocked"]
+    planner.log_plan("asg1", plan_waves(ordered, max_surge=2, max_unavailable=0))
+    assert "wave 1: quiet: 1 pods" in caplog.text
+    assert "wave 2: blocked: 2 pods, 2 held back by ['default/db'], ~70s (may exceed --drain-timeout)" in caplog.text
+    assert "Estimated drain time for asg1: ~170s" in caplog.text
+
+    # quiet and other are both held back by the api PDB, so they are split up
+    planner = DrainPlanner(snapshot, order="interleave", workers=2, timeout=60)
+    assert [instance["PrivateDnsName"] for instance in planner.plan("asg1", instances)] == ["busy", "quiet", "blocked", "other"]
+
+
+def gated_pod(name, node_name, owner_kind="ReplicaSet", ready=True, image=None):
+    pod = mock_pod(name, owner_kind=owner_kind)
+    pod.metadata.owner_references[0].name = name
+    pod.spec = kubernetes.client.V1PodSpec(node_name=node_name, containers=[kubernetes.client.V1Container(name=name, image=image or f"{name}:1")], image_pull_secrets=[kubernetes.client.V1LocalObjectReference(name="registry")])
+    pod.status = kubernetes.client.V1PodStatus(conditions=[kubernetes.client.V1PodCondition(type="Ready", status="True" if ready else "False")])
+    return pod
+
+
+@patch('eks_node_rollout.time.sleep')
+def test_readiness_gate(sleep):
+    core_v1 = Mock()
+    outdated_pods = [gated_pod("app", "old"), gated_pod("aws-node", "old", owner_kind="DaemonSet")]
+    replacement_pods = iter([
+        [],  # the DaemonSet controller hasn't created its pod yet
+        [gated_pod("aws-node", "new", owner_kind="DaemonSet", ready=False)],
+        [gated_pod("aws-node", "new", owner_kind="DaemonSet")],
+    ])
+    core_v1.list_pod_for_all_namespaces.side_effect = lambda field_selector: kubernetes.client.V1PodList(items=outdated_pods if field_selector == "spec.nodeName=old" else next(replacement_pods))
+
+    prepull_pod = kubernetes.client.V1Pod(metadata=kubernetes.client.V1ObjectMeta(name="eks-node-rollout-prepull-abc", namespace="default"), spec=kubernetes.client.V1PodSpec(node_name="new", containers=[kubernetes.client.V1Container(name="image-0", image="app:1"), kubernetes.client.V1Container(name="image-1", image="private:1")]))
+    core_v1.create_namespaced_pod.return_value = prepull_pod
+    pulled = kubernetes.client.V1Pod(metadata=prepull_pod.metadata, spec=prepull_pod.spec, status=kubernetes.client.V1PodStatus(container_statuses=[
+        kubernetes.client.V1ContainerStatus(name="image-0", image="app:1", image_id="", ready=False, restart_count=0, state=kubernetes.client.V1ContainerState(terminated=kubernetes.client.V1ContainerStateTerminated(exit_code=0))),
+        kubernetes.client.V1ContainerStatus(name="image-1", image="private:1", image_id="", ready=False, restart_count=0, state=kubernetes.client.V1ContainerState(waiting=kubernetes.client.V1ContainerStateWaiting(reason="ImagePullBackOff"))),
+    ]))
+    core_v1.read_namespaced_pod.side_effect = [kubernetes.client.V1Pod(metadata=prepull_pod.metadata, spec=prepull_pod.spec, status=kubernetes.client.V1PodStatus()), pulled]
+
+    gate = ReadinessGate(core_v1, prepull=True, images=["private:1"], timeout=60)
+    timelines = gate.wait([("old", "new")], dry_run=False)
+    assert list(timelines["new"]) == ["readiness_gate_started", "daemonsets_ready", "images_pulled"]
+    namespace, body = core_v1.create_namespaced_pod.call_args.args
+    assert namespace == "default"
+    assert body["spec"]["nodeName"] == "new"
+    assert body["spec"]["imagePullSecrets"] == [{"name": "registry"}]
+    assert [container["image"] for container in body["spec"]["containers"]] == ["app:1", "private:1"]  # not the DaemonSet's image
+    core_v1.delete_namespaced_pod.assert_called_once_with("eks-node-rollout-prepull-abc", "default", grace_period_seconds=0)
+
+    # pre-pulling is skipped where we may not create pods, the gate still waits for the DaemonSets
+    core_v1.reset_mock()
+    core_v1.create_namespaced_pod.side_effect = ApiException(status=403, reason="Forbidden")
+    replacement_pods = iter([[gated_pod("aws-node", "new", owner_kind="DaemonSet")]])
+    timelines = ReadinessGate(core_v1, prepull=True, timeout=60).wait([("old", "new")], dry_run=False)
+    assert list(timelines["new"]) == ["readiness_gate_started", "daemonsets_ready"]
+    core_v1.read_namespaced_pod.assert_not_called()
+    core_v1.delete_namespaced_pod.assert_not_called()
+    core_v1.create_namespaced_pod.side_effect = None
+
+    # a failed drain elsewhere in the pipeline aborts the gate rather than draining without the images
+    core_v1.reset_mock()
+    core_v1.create_namespaced_pod.return_value = prepull_pod
+    core_v1.read_namespaced_pod.side_effect = None
+    core_v1.read_namespaced_pod.return_value = kubernetes.client.V1Pod(metadata=prepull_pod.metadata, spec=prepull_pod.spec, status=kubernetes.client.V1PodStatus())
+    replacement_pods = iter([[gated_pod("aws-node", "new", owner_kind="DaemonSet")]])
+    stopped = threading.Event()
+    stopped.set()
+    with pytest.raises(Exception, match="Stopped waiting for images"):
+        ReadinessGate(core_v1, prepull=True, timeout=60).wait([("old", "new")], dry_run=False, stopped=stopped)
+    core_v1.delete_namespaced_pod.assert_called_once()
+
+    # a replacement without the outdated node's DaemonSet pod never passes
+    core_v1.reset_mock()
+    replacement_pods = iter([[]] * 10)
+    with pytest.raises(Exception, match="DaemonSet pods on new"):
+        ReadinessGate(core_v1, timeout=0).wait([("old", "new")], dry_run=False)
+    core_v1.create_namespaced_pod.assert_not_called()
+
+
+@patch('eks_node_rollout.kubectl')
+def test_kubectl_drainer_cordon(kubectl):
+    core_v1 = Mock()
+    core_v1.list_pod_for_all_namespaces.return_value = kubernetes.client.V1PodList(items=[gated_pod("app", "old"), gated_pod("aws-node", "old", owner_kind="DaemonSet"), gated_pod("other", "new")])
+    drainer = KubectlDrainer(core_v1, context="prod")
+    # the pods are counted through the API whichever drain method is used
+    assert drainer.cordon(["old"], dry_run=False) == {"old": 1}
+    kubectl.cordon.assert_called_once_with("old", "--context=prod")
+
+
+def test_estimate_avoided_reschedules():
+    # pods from the first of 3 outdated nodes could land on 2 of the other 4 nodes, from the second on 1 of them
+    assert estimate_avoided_reschedules([10, 10, 10], total_nodes=5) == 8
+    assert estimate_avoided_reschedules([10], total_nodes=5) == 0
+
+
+def test_rollout_metrics(tmp_path):
+    asg_client = boto3.client("autoscaling", region_name="ap-southeast-2")
+    metrics = RolloutMetrics("foo")
+    metrics.instrument(asg_client)  # before the stubber, which short-circuits any before-call handler registered after it
+    stubber = Stubber(asg_client)
+    stubber.add_client_error('set_desired_capacity', service_error_code="Throttling", http_status_code=400)
+    stubber.activate()
+    with pytest.raises(botocore.exceptions.ClientError):
+        asg_client.set_desired_capacity(AutoScalingGroupName="foobar", DesiredCapacity=2)
+
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    instance = {"InstanceId": "i-old", "PrivateDnsName": "old.aws.local"}
+    for event, seconds in [("capacity_requested", 0), ("instance_pending", 5), ("node_registered", 60), ("node_ready", 80), ("drain_started", 81), ("drain_finished", 111), ("terminated", 112)]:
+        metrics.mark("asg1", instance, event, start + datetime.timedelta(seconds=seconds))
+
+    report = metrics.report()
+    assert report["api_calls"] == {"SetDesiredCapacity": 1}
+    assert report["replacements"][0]["phases"] == {"instance_launch": 5, "node_registration": 55, "node_ready": 20, "drain": 30, "terminate": 1}
+    assert report["nodes_replaced"] == 1
+
+    metrics.write_json(tmp_path / "report.json")
+    assert json.loads((tmp_path / "report.json").read_text())["phases"]["drain"] == {"count": 1, "sum": 30, "max": 30}
+    metrics.write_prometheus(tmp_path / "rollout.prom")
+    assert 'eks_node_rollout_phase_seconds_sum{cluster="foo",phase="node_registration"} 55' in (tmp_path / "rollout.prom").read_text()
+
+
+def test_aws_rate_limiter():
+    clock = Mock(monotonic=Mock(return_value=0.0))
+    clock.sleep.side_effect = lambda seconds: setattr(clock.monotonic, "return_value", clock.monotonic.return_value + seconds)
+    with patch('eks_node_rollout.time', clock):
+        limiter = AwsRateLimiter(max_rate=4, burst=2, increase=1)
+        for _ in range(4):
+            limiter.acquire()
+        assert clock.monotonic.return_value == pytest.approx(0.5)  # 2 burst tokens, then 2 more at 4 calls/s
+
+        asg_client = limiter.instrument(Mock(meta=Mock(events=botocore.hooks.HierarchicalEmitter())))
+        operation = boto3.client("autoscaling", region_name="ap-southeast-2").meta.service_model.operation_model("DescribeAutoScalingGroups")
+        throttled = (None, {"Error": {"Code": "Throttling"}})
+        asg_client.meta.events.emit("needs-retry.auto-scaling.DescribeAutoScalingGroups", response=throttled, operation=operation, attempts=1)
+        asg_client.meta.events.emit("needs-retry.auto-scaling.DescribeAutoScalingGroups", response=throttled, operation=operation, attempts=2)
+        assert limiter.stats() == {"rate": 1, "max_rate": 4, "throttles": 2}
+        asg_client.meta.events.emit("needs-retry.auto-scaling.DescribeAutoScalingGroups", response=(None, {}), operation=operation, attempts=3)
+        assert limiter.rate == 2
+
+        # every HTTP attempt takes a token, including botocore's retries
+        started = clock.monotonic.return_value
+        asg_client.meta.events.emit("before-send.auto-scaling.DescribeAutoScalingGroups", request=None)
+        assert clock.monotonic.return_value - started == pytest.approx(0.5)  # the throttles used up the burst
+
+
+def test_poll():
+    clock = Mock(monotonic=Mock(return_value=0.0))
+    clock.sleep.side_effect = lambda seconds: setattr(clock.monotonic, "return_value", clock.monotonic.return_value + seconds)
+    with patch('eks_node_rollout.time', clock):
+        results = iter([None, [], ["i-1"]])
+        assert poll(lambda: next(results), timeout=60, description="instances") == ["i-1"]
+        assert len(clock.sleep.call_args_list) == 2
+        with pytest.raises(PollTimeout, match="Timed out after 60s waiting for instances"):
+            poll(lambda: None, timeout=60, description="instances")
+        assert clock.sleep.call_args_list[-1][0][0] <= 60
+        stopped = threading.Event()
+        stopped.set()
+        with pytest.raises(Exception, match="Stopped waiting for instances"):
+            poll(lambda: None, timeout=60, description="instances", stopped=stopped)
+
+
+def az_instance(name, zone):
+    return {"InstanceId": f"i-{name}", "PrivateDnsName": name, "Placement": {"AvailabilityZone": zone}}
+
+
+def test_order_by_az():
+    instances = [az_instance("a1", "a"), az_instance("a2", "a"), az_instance("a3", "a"), az_instance("b1", "b"), az_instance("c1", "c")]
+    assert [instance["PrivateDnsName"] for instance in order_by_az(instances)] == ["a1", "b1", "c1", "a2", "a3"]
+
+
+def test_az_scheduler():
+    waves = plan_waves([az_instance("a1", "a"), az_instance("b1", "b"), az_instance("a2", "a"), az_instance("c1", "c"), az_instance("b2", "b")], max_surge=2, max_unavailable=0)
+    scheduler = AzScheduler(waves)
+    surge = waves[0][0]
+    assert scheduler.pair(surge, [az_instance("new1", "c"), az_instance("new2", "b")])
+    assert sorted(instance["PrivateDnsName"] for instance in surge) == ["b1", "c1"]
+    assert "a1" in [instance["PrivateDnsName"] for instance in waves[1][0]]
+    assert not scheduler.pair(waves[1][0], [az_instance("new3", "a"), az_instance("new4", "a")])  # no more outdated instances in a to swap in
+
+
+def test_resolve_rollout_count():
+    assert resolve_rollout_count("2", 60, round_up=True) == 2
+    assert resolve_rollout_count("25%", 10, round_up=True) == 3
+    assert resolve_rollout_count("25%", 10, round_up=False) == 2
+
+
+def test_plan_waves():
+    instances = [{"InstanceId": f"i-{i}"} for i in range(7)]
+    waves = plan_waves(instances, max_surge=2, max_unavailable=1)
+    assert [(len(surge), len(unavailable)) for surge, unavailable in waves] == [(2, 1), (2, 1), (1, 0)]
+    with pytest.raises(ValueError):
+        plan_waves(instances, max_surge=0, max_unavailable=0)
+
+
+@patch('eks_node_rollout.get_capacity', return_value=(5, 10))
+@patch('boto3.client')
+@patch('eks_node_rollout.get_core_v1_api', return_value=None)
+@patch('eks_node_rollout.NodeReadinessTracker')
+@patch('eks_node_rollout.get_matching_asgs', return_value=[{"AutoScalingGroupName": "asg1"}])
+@patch('eks_node_rollout.describe_nodes_not_matching_lt', return_value=[
+        {"PrivateDnsName": f"instance{i}", "InstanceId": f"i-{i}"} for i in range(5)
+    ]
+)
+@patch('eks_node_rollout.check_is_cluster_autoscaler_tag_present', return_value=False)
+@patch('eks_node_rollout.get_asg_instance_ids', return_value=[])
+@patch('eks_node_rollout.add_node', return_value=None)
+@patch('eks_node_rollout.get_launched_instances', side_effect=lambda **kwargs: [{"PrivateDnsName": "new"}] * kwargs["count"])
+@patch('eks_node_rollout.wait_for_ready_node', return_value=None)
+@patch('eks_node_rollout.NodeDrainer')
+@patch('eks_node_rollout.terminate_node', return_value=None)
+def test_rollout_nodes_surge(terminate_node, node_drainer, wait_for_ready_node, get_launched_instances, add_node, *args):
+    runner = CliRunner()
+    result = runner.invoke(rollout_nodes, ["--cluster-name=foo", "--max-surge=3", "--no-dry-run"])
+    assert result.exit_code == 0
+    assert [c.kwargs["count"] for c in add_node.call_args_list] == [3, 2]
+    assert wait_for_ready_node.call_count == 5
+    assert terminate_node.call_count == 5
+    assert node_drainer.return_value.drain.call_count == 5
+
+    result = runner.invoke(rollout_nodes, ["--cluster-name=foo", "--max-surge=0", "--max-unavailable=0%"])
+    assert result.exit_code == 2
+    assert "cannot both be 0" in result.output
+
+    # the surge is limited to what fits below the ASG's MaxSize
+    get_capacity = args[-1]
+    get_capacity.return_value = (5, 7)
+    add_node.reset_mock()
+    result = runner.invoke(rollout_nodes, ["--cluster-name=foo", "--max-surge=3", "--no-dry-run"])
+    assert result.exit_code == 0
+    assert [c.kwargs["count"] for c in add_node.call_args_list] == [2, 2, 1]
+
+    get_capacity.return_value = (5, 5)
+    add_node.reset_mock()
+    result = runner.invoke(rollout_nodes, ["--cluster-name=foo", "--max-surge=3", "--no-dry-run"])
+    assert result.exit_code == 1
+    assert "no room to surge below its MaxSize of 5" in str(result.exception)
+    add_node.assert_not_called()
+
+
+@patch('eks_node_rollout.get_capacity', return_value=(5, 10))
+@patch('boto3.client')
+@patch('eks_node_rollout.get_core_v1_api', return_value=None)
+@patch('eks_node_rollout.NodeReadinessTracker')
+@patch('eks_node_rollout.get_matching_asgs', return_value=[{"AutoScalingGroupName": "asg1"}])
+@patch('eks_node_rollout.describe_nodes_not_matching_lt', return_value=[
+        {"PrivateDnsName": f"instance{i}", "InstanceId": f"i-{i}"} for i in range(2)
+    ]
+)
+@patch('eks_node_rollout.check_is_cluster_autoscaler_tag_present', return_value=False)
+@patch('eks_node_rollout.get_asg_instance_ids', return_value=[])
+@patch('eks_node_rollout.add_node', return_value=None)
+@patch('eks_node_rollout.get_launched_instances', side_effect=lambda **kwargs: [{"PrivateDnsName": f"new{i}"} for i in range(kwargs["count"])])
+@patch('eks_node_rollout.wait_for_ready_node', return_value=None)
+@patch('eks_node_rollout.NodeDrainer')
+@patch('eks_node_rollout.terminate_node', return_value=None)
+@patch('eks_node_rollout.ReadinessGate')
+def test_rollout_nodes_readiness_gate(readiness_gate, *args):
+    runner = CliRunner()
+    result = runner.invoke(rollout_nodes, ["--cluster-name=foo", "--max-surge=2", "--prepull-images", "--prepull-image=busybox", "--no-dry-run"])
+    assert result.exit_code == 0
+    readiness_gate.assert_called_once_with(None, prepull=True, images=("busybox",), timeout=300)
+    readiness_gate.return_value.wait.assert_called_once_with([("instance0", "new0"), ("instance1", "new1")], False, stopped=None)
+
+    result = runner.invoke(rollout_nodes, ["--cluster-name=foo", "--prepull-image=busybox"])
+    assert result.exit_code == 2
+
+
+@patch('eks_node_rollout.get_capacity', return_value=(5, 10))
+@patch('boto3.client')
+@patch('eks_node_rollout.get_core_v1_api', return_value=None)
+@patch('eks_node_rollout.NodeReadinessTracker')
+@patch('eks_node_rollout.get_matching_asgs')
+@patch('eks_node_rollout.describe_nodes_not_matching_lt', return_value=[
+        {"PrivateDnsName": f"instance{i}", "InstanceId": f"i-{i}"} for i in range(4)
+    ]
+)
+@patch('eks_node_rollout.check_is_cluster_autoscaler_tag_present', return_value=False)  # removed by the interrupted run
+@patch('eks_node_rollout.disable_autoscaling', return_value=None)
+@patch('eks_node_rollout.enable_autoscaling', return_value=None)
+@patch('eks_node_rollout.get_asg_instance_ids', return_value=[])
+@patch('eks_node_rollout.add_node', return_value=None)
+@patch('eks_node_rollout.get_launched_instances', side_effect=lambda **kwargs: [{"PrivateDnsName": "new"}] * kwargs["count"])
+@patch('eks_node_rollout.wait_for_ready_node', return_value=None)
+@patch('eks_node_rollout.NodeDrainer')
+@patch('eks_node_rollout.terminate_node', return_value=None)
+def test_rollout_nodes_resume(terminate_node, node_drainer, wait_for_ready_node, get_launched_instances, add_node, get_asg_instance_ids, enable_autoscaling, disable_autoscaling, check_is_cluster_autoscaler_tag_present, describe_nodes_not_matching_lt, get_matching_asgs, tracker, get_core_v1_api, boto3_client, get_capacity, tmp_path):
+    runner = CliRunner()
+    state_file = str(tmp_path / "state.json")
+    state = RolloutState(state_file, "foo")
+    state.set_asg_names(["asg0", "asg1"])
+    state.update("asg0", done=True)
+    state.update("asg1", autoscaler_suspended=True)
+    state.record_launch("asg1", [{"InstanceId": "i-0"}, {"InstanceId": "i-1"}], since=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc), exclude=["i-0", "i-1", "i-2", "i-3"])
+    state.record_terminated("asg1", {"InstanceId": "i-0"})
+
+    result = runner.invoke(rollout_nodes, ["--cluster-name=foo", "--max-surge=2", "--no-dry-run", f"--state-file={state_file}"])
+    assert result.exit_code == 0
+    assert not os.path.exists(state_file)
+
+    get_matching_asgs.assert_not_called()
+    describe_nodes_not_matching_lt.assert_called_once()  # asg0 was already done
+    # i-1's replacement is adopted, only i-2 and i-3 get new capacity
+    assert [c.kwargs["count"] for c in add_node.call_args_list] == [2]
+    assert get_launched_instances.call_args_list[0].kwargs["since"] == datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    assert [c.args[1] for c in terminate_node.call_args_list] == ["i-1", "i-2", "i-3"]
+    enable_autoscaling.assert_called_once()
+
+
+def test_rollout_state_concurrent(tmp_path):
+    state = RolloutState(str(tmp_path / "state.json"), "foo")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        # ASGs first seen by one worker while another worker checkpoints
+        futures = [executor.submit(state.asg, f"asg{i}") for i in range(200)]
+        futures += [executor.submit(state.update, "asg0", done=True) for _ in range(50)]
+        for future in futures:
+            future.result()
+    assert len(state.data["asgs"]) == 200
+
+
+@patch('boto3.client')
+@patch('eks_node_rollout.get_core_v1_api', return_value=None)
+@patch('eks_node_rollout.NodeReadinessTracker')
+@patch('eks_node_rollout.get_matching_asgs', return_value=[{"AutoScalingGroupName": f"asg{i}"} for i in range(3)])
+@patch('eks_node_rollout.rollout_asg')
+def test_rollout_nodes_concurrent(rollout_asg, *args):
+    all_started = threading.Barrier(3, timeout=5)
+
+    def roll(asg_name, **kwargs):
+        all_started.wait()
+        if asg_name == "asg1":
+            raise Exception("asg1 broke")
+    rollout_asg.side_effect = roll
+    runner = CliRunner()
+    result = runner.invoke(rollout_nodes, ["--cluster-name=foo", "--asg-concurrency=3"])
+    assert rollout_asg.call_count == 3  # all 3 were already in progress
+    assert result.exit_code == 1
+    assert str(result.exception) == "asg1 broke"
+
+
+@patch('boto3.client')
+@patch('eks_node_rollout.get_core_v1_api', return_value=None)
+@patch('eks_node_rollout.NodeReadinessTracker')
+@patch('eks_node_rollout.get_matching_asgs', return_value=[{"AutoScalingGroupName": f"asg{i}"} for i in range(3)])
+@patch('eks_node_rollout.rollout_asg', side_effect=[None, Exception("asg1 broke"), None])
+def test_rollout_nodes_asg_failed(rollout_asg, *args):
+    runner = CliRunner()
+    result = runner.invoke(rollout_nodes, ["--cluster-name=foo", "--asg-concurrency=1"])
+    assert [c.kwargs["asg_name"] for c in rollout_asg.call_args_list] == ["asg0", "asg1"]  # asg2 is never started
+    assert result.exit_code == 1
+    assert str(result.exception) == "asg1 broke"
+
+
+@patch('eks_node_rollout.provision_wave')
+@patch('eks_node_rollout.retire_wave')
+def test_replace_waves_pipelined(retire_wave, provision_wave):
+    waves = plan_waves([{"InstanceId": f"i-{i}"} for i in range(3)], max_surge=1, max_unavailable=0)
+    second_wave_provisioning = threading.Event()
+    provision_wave.side_effect = lambda **kwargs: provision_wave.call_count == 2 and second_wave_provisioning.set()
+    # the first drain only finishes once the next wave is being provisioned, which would never happen without pipelining
+    retire_wave.side_effect = lambda **kwargs: second_wave_provisioning.wait(5) or pytest.fail("wave 2 was not provisioned during the drain of wave 1")
+    in_flight = InFlightLimiter(limit=2)
+
+    replace_waves_pipelined(asg_client=None, ec2_client=None, tracker=None, drainer=None, asg_name="asg1", waves=waves, depth=1, in_flight=in_flight, dry_run=False)
+    assert provision_wave.call_count == 3
+    assert [c.kwargs["surge"] for c in retire_wave.call_args_list] == [surge for surge, _ in waves]
+    assert in_flight._in_flight == 0
+
+
+@patch('eks_node_rollout.provision_wave')
+@patch('eks_node_rollout.retire_wave', side_effect=Exception("drain failed"))
+def test_replace_waves_pipelined_failure(retire_wave, provision_wave):
+    waves = plan_waves([{"InstanceId": f"i-{i}"} for i in range(3)], max_surge=1, max_unavailable=0)
+    # the second wave never becomes Ready
+    provision_wave.side_effect = lambda **kwargs: provision_wave.call_count > 1 and poll(lambda: None, timeout=900, description="a node that never launches", stopped=kwargs["stopped"])
+    in_flight = InFlightLimiter(limit=2)
+
+    started = time.monotonic()
+    with pytest.raises(Exception, match="drain failed"):
+        replace_waves_pipelined(asg_client=None, ec2_client=None, tracker=None, drainer=None, asg_name="asg1", waves=waves, depth=1, in_flight=in_flight, dry_run=False)
+    assert time.monotonic() - started < 10
+    assert in_flight._in_flight == 0
+
+
+@patch('eks_node_rollout.get_capacity', return_value=(5, 10))
+@patch('boto3.client')
+@patch('eks_node_rollout.get_core_v1_api', return_value=None)
+@patch('eks_node_rollout.NodeReadinessTracker')
+@patch('eks_node_rollout.get_matching_asgs', return_value=[{"AutoScalingGroupName": "asg1"}])
+@patch('eks_node_rollout.describe_nodes_not_matching_lt', return_value=[
+        {"PrivateDnsName": f"instance{i}", "InstanceId": f"i-{i}"} for i in range(3)
+    ]
+)
+@patch('eks_node_rollout.check_is_cluster_autoscaler_tag_present', return_value=False)
+@patch('eks_node_rollout.get_asg_instance_ids', return_value=[f"i-{i}" for i in range(4)])
+@patch('eks_node_rollout.add_node', return_value=None)
+@patch('eks_node_rollout.get_launched_instances', return_value=[{"PrivateDnsName": "new"}])
+@patch('eks_node_rollout.wait_for_ready_node', return_value=None)
+@patch('eks_node_rollout.NodeDrainer')
+@patch('eks_node_rollout.terminate_node', return_value=None)
+def test_rollout_nodes_cordon_outdated(terminate_node, node_drainer, *args):
+    drainer = node_drainer.return_value
+    drainer.cordon.return_value = {f"instance{i}": 5 for i in range(3)}
+    runner = CliRunner()
+    result = runner.invoke(rollout_nodes, ["--cluster-name=foo", "--cordon-outdated"])
+    assert result.exit_code == 0
+    assert drainer.method_calls[0] == call.cordon(["instance0", "instance1", "instance2"], False)
+    assert drainer.cordon.call_count == 1
+    assert drainer.drain.call_count == 3
+
+    # nothing would be ready to take the pods of the cordoned nodes
+    result = runner.invoke(rollout_nodes, ["--cluster-name=foo", "--cordon-outdated", "--max-surge=0", "--max-unavailable=1"])
+    assert result.exit_code == 2
+
+
+@patch('eks_node_rollout.get_desired_capacity', return_value=10)
+@patch('eks_node_rollout.describe_instances', side_effect=lambda ec2_client, ids: [{"InstanceId": i, "PrivateDnsName": f"{i}.aws.local"} for i in ids])
+def test_refresh_asg(*args):
+    asg_client = Mock()
+    asg_client.describe_instance_refreshes.side_effect = [
+        {"InstanceRefreshes": [{"InstanceRefreshId": "old", "Status": "Successful"}]},
+        {"InstanceRefreshes": [{"InstanceRefreshId": "r-1", "Status": "InProgress", "PercentageComplete": 0, "InstancesToUpdate": 2}]},
+        {"InstanceRefreshes": [{"InstanceRefreshId": "r-1", "Status": "InProgress", "PercentageComplete": 50, "InstancesToUpdate": 1}]},
+        {"InstanceRefreshes": [{"InstanceRefreshId": "r-1", "Status": "Successful", "PercentageComplete": 100, "InstancesToUpdate": 0}]},
+    ]
+    asg_client.start_instance_refresh.return_value = {"InstanceRefreshId": "r-1"}
+    waiting = {"AutoScalingGroups": [{"Instances": [
+        {"InstanceId": "i-1", "LifecycleState": "Terminating:Wait"},
+        {"InstanceId": "i-2", "LifecycleState": "InService"},
+    ]}]}
+    asg_client.describe_auto_scaling_groups.return_value = waiting
+    drainer = Mock(timeout=120)
+
+    refresh_asg(asg_client, Mock(), drainer, "asg1", min_healthy_percentage=80, poll_interval=0, dry_run=False)
+
+    assert asg_client.put_lifecycle_hook.call_args.kwargs["HeartbeatTimeout"] == 180
+    asg_client.start_instance_refresh.assert_called_once_with(AutoScalingGroupName="asg1", Strategy="Rolling", Preferences={"MinHealthyPercentage": 80, "SkipMatching": True})
+    drainer.drain.assert_called_once_with("i-1.aws.local", False)  # drained once, although it was waiting on both polls
+    asg_client.complete_lifecycle_action.assert_called_once_with(LifecycleHookName=DRAIN_LIFECYCLE_HOOK, AutoScalingGroupName="asg1", LifecycleActionResult="CONTINUE", InstanceId="i-1")
+    asg_client.delete_lifecycle_hook.assert_called_once_with(LifecycleHookName=DRAIN_LIFECYCLE_HOOK, AutoScalingGroupName="asg1")
+
+
+def test_refresh_asg_failed():
+    asg_client = Mock()
+    asg_client.describe_instance_refreshes.side_effect = [
+        {"InstanceRefreshes": [{"InstanceRefreshId": "r-1", "Status": "InProgress"}]},  # adopted from an earlier run
+        {"InstanceRefreshes": [{"InstanceRefreshId": "r-1", "Status": "Failed", "StatusReason": "broken"}]},
+    ]
+    with patch('eks_node_rollout.get_desired_capacity', return_value=3), pytest.raises(Exception, match="ended with status Failed: broken"):
+        refresh_asg(asg_client, Mock(), Mock(timeout=120), "asg1", min_healthy_percentage=90, poll_interval=0, dry_run=False)
+    asg_client.start_instance_refresh.assert_not_called()
+    asg_client.cancel_instance_refresh.assert_not_called()  # it already ended
+    asg_client.delete_lifecycle_hook.assert_called_once()
+
+
+def test_refresh_asg_dry_run():
+    asg_client = Mock()
+    # adopted from an earlier run that was killed with its lifecycle hook in place
+    asg_client.describe_instance_refreshes.return_value = {"InstanceRefreshes": [{"InstanceRefreshId": "r-1", "Status": "InProgress", "PercentageComplete": 50}]}
+    asg_client.describe_auto_scaling_groups.return_value = {"AutoScalingGroups": [{"Instances": [{"InstanceId": "i-1", "LifecycleState": "Terminating:Wait"}]}]}
+    refresh_asg(asg_client, Mock(), Mock(timeout=120), "asg1", min_healthy_percentage=90, poll_interval=0, dry_run=True)
+    asg_client.complete_lifecycle_action.assert_not_called()
+    asg_client.cancel_instance_refresh.assert_not_called()
+    asg_client.delete_lifecycle_hook.assert_not_called()
+
+    asg_client.reset_mock()
+    drain_for_lifecycle_hook(asg_client, Mock(), "asg1", {"InstanceId": "i-1", "PrivateDnsName": "i-1.aws.local"}, dry_run=True)
+    asg_client.complete_lifecycle_action.assert_not_called()
+
+
+def test_refresh_asg_interrupted():
+    asg_client = Mock()
+    asg_client.describe_instance_refreshes.side_effect = [
+        {"InstanceRefreshes": [{"InstanceRefreshId": "r-1", "Status": "InProgress"}]},  # adopted from an earlier run
+        {"InstanceRefreshes": [{"InstanceRefreshId": "r-1", "Status": "InProgress"}]},
+        {"InstanceRefreshes": [{"InstanceRefreshId": "r-1", "Status": "Cancelling"}]},
+        {"InstanceRefreshes": [{"InstanceRefreshId": "r-1", "Status": "Cancelled"}]},
+    ]
+    asg_client.describe_auto_scaling_groups.side_effect = Exception("throttled")
+    with patch('eks_node_rollout.get_desired_capacity', return_value=3), pytest.raises(Exception, match="throttled"):
+        refresh_asg(asg_client, Mock(), Mock(timeout=120), "asg1", min_healthy_percentage=90, poll_interval=0, dry_run=False)
+    asg_client.cancel_instance_refresh.assert_called_once_with(AutoScalingGroupName="asg1")
+    # the hook is only removed once the refresh stopped replacing instances
+    assert [name for name, _, _ in asg_client.method_calls][-4:] == ["cancel_instance_refresh", "describe_instance_refreshes", "describe_instance_refreshes", "delete_lifecycle_hook"]
+
+
+def test_load_fleet_manifest(tmp_path):
+    manifest = tmp_path / "fleet.yaml"
+    manifest.write_text("clusters:\n  - name: prod-apse2\n    region: ap-southeast-2\n    context: prod\n  - name: prod-use1\n    region: us-east-1\n")
+    assert load_fleet_manifest(manifest) == [
+        {"name": "prod-apse2", "region": "ap-southeast-2", "context": "prod"},
+        {"name": "prod-use1", "region": "us-east-1", "context": None},
+    ]
+    manifest.write_text("clusters:\n  - name: prod-apse2\n")
+    with pytest.raises(click.UsageError, match="needs a name and a region"):
+        load_fleet_manifest(manifest)
+    manifest.write_text('{"clusters": [{"name": "a", "region": "r"}, {"name": "a", "region": "s"}]}')
+    with pytest.raises(click.UsageError, match="listed more than once"):
+        load_fleet_manifest(manifest)
+
+
+def test_schedule_clusters():
+    clusters = [{"name": f"{region}-{i}", "region": region} for region in ["apse2", "use1"] for i in range(3)]
+    lock = threading.Lock()
+    running = collections.Counter()
+    peaks = collections.Counter()
+
+    def roll(cluster):
+        with lock:
+            running[cluster["region"]] += 1
+            running["total"] += 1
+            for key in [cluster["region"], "total"]:
+                peaks[key] = max(peaks[key], running[key])
+        time.sleep(0.05)
+        with lock:
+            running[cluster["region"]] -= 1
+            running["total"] -= 1
+        if cluster["name"] == "use1-1":
+            raise Exception("boom")
+
+    errors = schedule_clusters(clusters, roll, concurrency=3, region_concurrency=2)
+    assert list(errors) == ["use1-1"]
+    assert peaks == {"apse2": 2, "use1": 2, "total": 3}
+
+
+@patch('boto3.session.Session')
+@patch('eks_node_rollout.get_core_v1_api', side_effect=lambda context: f"core_v1-{context}")
+@patch('eks_node_rollout.rollout_cluster')
+def test_rollout_nodes_fleet(rollout_cluster, get_core_v1_api, session, tmp_path):
+    def roll(cluster_name, metrics, **kwargs):
+        metrics.finished = datetime.datetime.now(datetime.timezone.utc)
+        if cluster_name == "b":
+            raise Exception("boom")
+    rollout_cluster.side_effect = roll
+    manifest = tmp_path / "fleet.yaml"
+    manifest.write_text("clusters:\n  - {name: a, region: r1, context: ctx-a}\n  - {name: b, region: r1, context: ctx-b}\n  - {name: c, region: r2, context: ctx-c}\n")
+
+    runner = CliRunner()
+    result = runner.invoke(rollout_nodes, [f"--fleet-manifest={manifest}", f"--state-file={tmp_path}/{{name}}.json", f"--report-json={tmp_path}/report.json", "--no-dry-run"])
+    assert result.exit_code == 1
+    # sessions and clients are pooled per region
+    assert sorted(c.kwargs["region_name"] for c in session.call_args_list) == ["r1", "r2"]
+    clients = {c.args[0]: c.kwargs for c in rollout_cluster.call_args_list}
+    assert clients["a"]["asg_client"] is clients["b"]["asg_client"]
+    assert clients["a"]["asg_client"] is not clients["c"]["asg_client"]
+    assert clients["c"]["core_v1"] == "core_v1-ctx-c" and clients["c"]["context"] == "ctx-c"
+    assert clients["c"]["state_file"] == f"{tmp_path}/c.json"
+
+    report = json.loads((tmp_path / "report.json").read_text())
+    assert (report["clusters_succeeded"], report["clusters_failed"]) == (2, 1)
+    assert [(entry["cluster"], entry["status"], entry["error"]) for entry in report["clusters"]] == [("a", "succeeded", None), ("b", "failed", "boom"), ("c", "succeeded", None)]
+    assert sorted(report["regions"]) == ["r1", "r2"]
+
+    result = runner.invoke(rollout_nodes, [f"--fleet-manifest={manifest}", "--cluster-name=a"])
+    assert result.exit_code == 2
+    result = runner.invoke(rollout_nodes, [f"--fleet-manifest={manifest}", f"--state-file={tmp_path}/state.json"])
+    assert result.exit_code == 2
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+from simulator import *
+from benchmark import run_benchmark, format_table
+
+
+def test_simulate_rollout():
+    result = simulate([2, 1], args=["--max-surge", "1", "--drain-timeout", "600"], pods_per_node=4, speedup=200)
+    assert result.error is None
+    assert result.up_to_date
+    assert result.peak_surge == 1
+    assert result.report["nodes_replaced"] == 3
+    assert result.api_calls["SetDesiredCapacity"] == 3
+    assert result.api_calls["TerminateInstanceInAutoScalingGroup"] == 3
+    assert 0 < result.duration
+
+
+def test_simulate_throttling():
+    result = simulate([1], args=["--drain-timeout", "600"], throttle_rate=0.3, pods_per_node=2, speedup=200, seed=1)
+    assert result.error is None
+    assert result.up_to_date
+    assert sum(result.throttles.values()) > 0
+    assert result.report["throttles"] == result.throttles
+
+
+def test_run_benchmark():
+    rows = run_benchmark(["small"], ["surge"], speedup=200)
+    assert [(row["cluster"], row["scenario"], row["nodes"]) for row in rows] == [("small", "surge", 6)]
+    assert "duration_seconds" in format_table(rows)